@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module is the entry point for the batch version of the
+snf-image-creator program. It creates multiple images out of a manifest file
+using a pool of worker processes.
+"""
+
+from image_creator import __version__ as version
+from image_creator.util import FatalError, ensure_root, free_space, \
+    get_command, JOBS_ENV
+from image_creator.disk import get_tmp_dir
+from image_creator.output.cli import SimpleOutput
+from image_creator.kamaki_wrapper import Kamaki, ClientError, \
+    DEFAULT_UPLOAD_WORKERS
+from image_creator import main as mkimage
+
+import sys
+import os
+import stat
+import json
+import time
+import optparse
+import multiprocessing
+
+PROGNAME = os.path.basename(sys.argv[0])
+
+# The authenticated cloud account. It is set by the parent process before the
+# worker processes are forked, so that they all share it.
+_account = None
+
+
+def parse_options(input_args):
+    """Parse input parameters"""
+    usage = "Usage: %prog [options] <manifest>"
+    parser = optparse.OptionParser(version=version, usage=usage)
+
+    parser.add_option("-a", "--authentication-url", dest="url", type="string",
+                      default=None, help="use this authentication URL when "
+                      "uploading/registering images")
+
+    parser.add_option("-c", "--cloud", dest="cloud", type="string",
+                      default=None, help="use this saved cloud account to "
+                      "authenticate against a cloud when "
+                      "uploading/registering images")
+
+    parser.add_option("-f", "--force", dest="force", default=False,
+                      action="store_true",
+                      help="overwrite output files if they exist")
+
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=None,
+                      metavar="N", help="create at most N images in parallel. "
+                      "By default this is bounded by the number of CPUs and "
+                      "the free space in the temporary directory")
+
+    parser.add_option("--log-dir", dest="log_dir", type="string",
+                      default=None, metavar="DIR", help="write the output of "
+                      "each image creation to a log file under DIR. By "
+                      "default the logs are written next to the manifest")
+
+    parser.add_option("--results", dest="results", type="string",
+                      default=None, metavar="FILE", help="write the JSON "
+                      "summary of the results to FILE instead of the "
+                      "standard output")
+
+    parser.add_option("-t", "--token", dest="token", type="string",
+                      default=None, help="use this authentication token when "
+                      "uploading/registering images")
+
+    parser.add_option("--tmpdir", dest="tmp", type="string", default=None,
+                      help="create large temporary image files under DIR",
+                      metavar="DIR")
+
+    parser.add_option("--upload-workers", dest="upload_workers", type="int",
+                      default=DEFAULT_UPLOAD_WORKERS, metavar="N",
+                      help="use N threads per image for computing the block "
+                      "hashes and uploading the missing blocks [default: "
+                      "%default]")
+
+    options, args = parser.parse_args(input_args)
+
+    if len(args) != 1:
+        parser.error('Wrong number of arguments')
+
+    options.manifest = args[0]
+    if not os.path.isfile(options.manifest):
+        parser.error("Manifest file `%s' is not accessible" %
+                     options.manifest)
+
+    if options.jobs is not None and options.jobs < 1:
+        parser.error("The number of jobs must be a positive integer")
+
+    if options.tmp is not None and not os.path.isdir(options.tmp):
+        parser.error("The directory `%s' specified with --tmpdir is not valid"
+                     % options.tmp)
+
+    if options.log_dir is None:
+        options.log_dir = os.path.dirname(os.path.abspath(options.manifest))
+    elif not os.path.isdir(options.log_dir):
+        parser.error("The directory `%s' specified with --log-dir is not "
+                     "valid" % options.log_dir)
+
+    return options
+
+
+def entry_args(entry, options):
+    """Convert a manifest entry into snf-mkimage command line arguments.
+
+    An entry is a dictionary with a mandatory `source' key and the optional
+    `outfile', `upload', `register', `public', `metadata', `sysprep_params',
+    `enable_syspreps', `disable_syspreps' and `args' keys. The latter is a
+    list of extra snf-mkimage arguments.
+    """
+    if 'source' not in entry:
+        raise FatalError("Manifest entry without a `source'")
+
+    args = []
+    if options.cloud is not None:
+        args += ['-c', options.cloud]
+    if options.url is not None:
+        args += ['-a', options.url]
+    if options.token is not None:
+        args += ['-t', options.token]
+    if options.tmp is not None:
+        args += ['--tmpdir', options.tmp]
+    if options.force:
+        args.append('-f')
+    args += ['--upload-workers', str(options.upload_workers)]
+
+    for key, opt in (('outfile', '-o'), ('upload', '-u'),
+                     ('register', '-r')):
+        if key in entry:
+            args += [opt, entry[key]]
+
+    if entry.get('public', False):
+        args.append('--public')
+
+    for key, value in entry.get('metadata', {}).items():
+        args += ['-m', '%s=%s' % (key, value)]
+
+    for key, value in entry.get('sysprep_params', {}).items():
+        args += ['--sysprep-param', '%s=%s' % (key, value)]
+
+    for name in entry.get('enable_syspreps', []):
+        args += ['--enable-sysprep', name]
+
+    for name in entry.get('disable_syspreps', []):
+        args += ['--disable-sysprep', name]
+
+    args += entry.get('args', [])
+    args.append(entry['source'])
+
+    return [str(a) for a in args]
+
+
+def source_size(source):
+    """Returns the size of a source medium"""
+    try:
+        mode = os.stat(source).st_mode
+    except OSError:
+        # This will be reported by the worker handling the source
+        return 0
+
+    if stat.S_ISBLK(mode):
+        return int(get_command('blockdev')('--getsize64', source))
+    elif stat.S_ISREG(mode):
+        return os.path.getsize(source)
+
+    # For directories we cannot tell in advance
+    return 0
+
+
+def pool_size(sources, options):
+    """Compute the number of worker processes. Each worker may need as much
+    temporary space as its source medium for the snapshot.
+    """
+    size = min(len(sources), multiprocessing.cpu_count())
+    if options.jobs is not None:
+        size = min(size, options.jobs)
+
+    largest = max([source_size(s) for s in sources] + [0])
+    if largest > 0:
+        available = free_space(get_tmp_dir(options.tmp))
+        size = min(size, available // largest)
+
+    return max(1, size)
+
+
+def build(job):
+    """Create an image in a worker process. Returns a result dictionary."""
+    index, args, log = job
+
+    result = {'index': index, 'log': log, 'status': 'failed'}
+    start = time.time()
+    with open(log, 'w') as f:
+        out = SimpleOutput(colored=False, stdout=f, stderr=f)
+        try:
+            # parse_options() calls sys.exit() on invalid arguments
+            sys.stderr = f
+            try:
+                options = mkimage.parse_options(args)
+            except SystemExit:
+                raise FatalError("Invalid arguments: %s" % " ".join(args))
+            finally:
+                sys.stderr = sys.__stderr__
+
+            result['source'] = options.source
+            if options.outfile is not None:
+                result['outfile'] = options.outfile
+            if options.upload:
+                result['upload'] = options.upload
+
+            kamaki = None
+            if _account is not None:
+                kamaki = Kamaki(_account, out, options.upload_workers)
+            mkimage.image_creator(options, out, kamaki, result)
+            result['status'] = 'success'
+        except FatalError as e:
+            out.error(e)
+            result['error'] = str(e)
+        except ClientError as e:
+            out.error(e)
+            result['error'] = "Service client: %d %s" % (e.status, e.message)
+        except Exception as e:
+            out.error(e)
+            result['error'] = "%s: %s" % (type(e).__name__, e)
+
+    result['duration'] = time.time() - start
+    result['stats'] = out.stats
+    return result
+
+
+def batch(options, out):
+    """snf-mkimage-batch main function"""
+    global _account
+
+    ensure_root(PROGNAME)
+
+    try:
+        with open(options.manifest) as f:
+            entries = json.load(f)
+    except ValueError as e:
+        raise FatalError("Unable to parse manifest `%s': %s" %
+                         (options.manifest, e))
+
+    if not isinstance(entries, list) or not len(entries):
+        raise FatalError("The manifest should contain a list of images")
+
+    jobs = []
+    for i, entry in enumerate(entries):
+        log = os.path.join(options.log_dir, "image-%d.log" % i)
+        jobs.append((i, entry_args(entry, options), log))
+
+    # Authenticate once. The worker processes inherit the account.
+    kamaki = mkimage.get_kamaki(options, out)
+    if kamaki is not None:
+        _account = kamaki.account
+
+    size = pool_size([item['source'] for item in entries], options)
+    out.info("Creating %d image(s) using %d worker process(es) ..." %
+             (len(jobs), size))
+
+    # Let the workers know how many images share the host resources
+    os.environ[JOBS_ENV] = str(size)
+
+    pool = multiprocessing.Pool(size)
+    try:
+        results = []
+        for result in pool.imap_unordered(build, jobs):
+            if result['status'] == 'success':
+                out.success("Image %d (%s): done" %
+                            (result['index'], result['source']))
+            else:
+                out.warn("Image %d (%s): failed (see %s)" %
+                         (result['index'], result.get('source', '-'),
+                          result['log']))
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    results.sort(key=lambda r: r['index'])
+    summary = json.dumps(results, indent=4, ensure_ascii=False)
+    if options.results is not None:
+        with open(options.results, 'w') as f:
+            f.write(summary)
+    else:
+        out.result(summary)
+
+    failed = len([r for r in results if r['status'] != 'success'])
+    if failed:
+        out.warn("%d out of %d image(s) failed" % (failed, len(results)))
+        return 1
+
+    out.success("snf-image-creator exited without errors")
+    return 0
+
+
+def main():
+    """Main entry point"""
+    options = parse_options(sys.argv[1:])
+
+    out = SimpleOutput(colored=sys.stderr.isatty())
+
+    title = 'snf-image-creator %s (batch mode)' % version
+    out.info(title)
+    out.info('=' * len(title))
+
+    try:
+        sys.exit(batch(options, out))
+    except FatalError as e:
+        out.error(e)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -190,10 +190,19 @@ class Disk(object):
 
         return self._file
 
-    def snapshot(self):
+    def snapshot(self, sparse=False):
         """Creates a snapshot of the original source medium of the Disk
         instance.
+
+        If sparse is True, raw image files are snapshotted with a qcow2
+        overlay instead of a device-mapper snapshot, so that the data regions
+        of the snapshot can be queried.
         """
+        with self.out.phase('snapshot'):
+            return self._snapshot(sparse)
+
+    def _snapshot(self, sparse):
+        """Do the actual snapshotting of the source medium"""
 
         if self.source == '/':
             self.out.warn("Snapshotting ignored for host bundling mode.")
@@ -204,15 +213,18 @@ class Disk(object):
 
         self.out.info("Snapshotting medium source ...", False)
 
-        # Create a qcow2 snapshot for image files that are not raw
-        if info['format'] != 'raw':
-            snapshot = create_snapshot(self.file, self.tmp)
+        mode = os.stat(self.file).st_mode
+
+        # Create a qcow2 snapshot for image files that are not raw. In sparse
+        # mode do the same for raw image files.
+        if info['format'] != 'raw' or (sparse and stat.S_ISREG(mode)):
+            backing_fmt = 'raw' if info['format'] == 'raw' else None
+            snapshot = create_snapshot(self.file, self.tmp, backing_fmt)
             self._add_cleanup(os.unlink, snapshot)
             self.out.success('done')
             return snapshot
 
         # Create a device-mapper snapshot for raw image files and block devices
-        mode = os.stat(self.file).st_mode
         device = self.file if stat.S_ISBLK(mode) else self._losetup(self.file)
         size = int(blockdev('--getsz', device))
 
@@ -242,7 +254,8 @@ class Disk(object):
     def get_image(self, medium, **kwargs):
         """Returns a newly created Image instance."""
         info = image_info(medium)
-        image = Image(medium, self.out, format=info['format'], **kwargs)
+        image = Image(medium, self.out, format=info['format'],
+                      source=self.source, **kwargs)
         self._images.append(image)
         image.enable()
         return image
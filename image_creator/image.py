@@ -17,24 +17,89 @@
 
 """Module hosting the Image class."""
 
-from image_creator.util import FatalError, QemuNBD, get_command
+from image_creator import __version__ as version
+from image_creator.util import FatalError, QemuNBD, get_command, \
+    data_extents, image_info, get_cache_dir
 from image_creator.gpt import GPTPartitionTable
 from image_creator.os_type import os_cls
 
-import os
-# Make sure libguestfs runs qemu directly to launch an appliance.
-os.environ['LIBGUESTFS_BACKEND'] = 'direct'
-import guestfs
-
 import re
+import stat
+import json
 import hashlib
+import tempfile
+import posixpath
 from sendfile import sendfile
 import threading
+import time
+import logging
+
+import os
+# Make sure libguestfs runs qemu directly to launch an appliance, unless a
+# backend has been explicitly selected. The libvirt backend allows reusing the
+# helper VM across the Windows VM boots.
+os.environ.setdefault('LIBGUESTFS_BACKEND', 'direct')
+import guestfs
+
+log = logging.getLogger(__name__)
+
+
+def _to_str(obj):
+    """Convert the unicode strings of a decoded JSON object to str"""
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    elif isinstance(obj, list):
+        return [_to_str(o) for o in obj]
+    elif isinstance(obj, dict):
+        return dict((_to_str(k), _to_str(v)) for k, v in obj.items())
+    return obj
+
+
+class InspectedGuestFS(object):
+    """Wraps a guestfs handle, serving the inspect_* calls from a record of
+    their results.
+
+    The results of the calls that are missing from the record are added to
+    it. If the medium has not been inspected yet, inspect_os() is called
+    first. This way a record loaded from the inspection cache can replace
+    the inspection of the medium.
+    """
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.calls = {}
+        self.inspected = False
+
+    def inspect_os(self):
+        """Inspect the medium"""
+        self.inspected = True
+        return self.handle.inspect_os()
+
+    def _call(self, name, *args):
+        """Returns the result of an inspect_* call"""
+        key = json.dumps(args)
+        results = self.calls.setdefault(name, {})
+        if key not in results:
+            if not self.inspected:
+                self.inspect_os()
+            results[key] = getattr(self.handle, name)(*args)
+        return results[key]
+
+    def __getattr__(self, name):
+        if name.startswith('inspect_'):
+            return lambda *args: self._call(name, *args)
+        return getattr(self.handle, name)
 
 
 class Image(object):
     """The instances of this class can create images out of block devices."""
 
+    # The inspection cache file of a source medium with a given fingerprint
+    INSPECTION_FILE = 'inspection-%s.json'
+
+    # The label of the medium when it is attached to the helper VM
+    DRIVE_LABEL = 'medium'
+
     def __init__(self, device, output, **kwargs):
         """Create a new Image instance"""
 
@@ -42,18 +107,42 @@ class Image(object):
         self.out = output
         self.format = kwargs['format'] if 'format' in kwargs else 'raw'
 
+        self.sparse = kwargs['sparse'] if 'sparse' in kwargs else False
+        self.fast_shrink = \
+            kwargs['fast_shrink'] if 'fast_shrink' in kwargs else False
         self.meta = kwargs['meta'] if 'meta' in kwargs else {}
         self.sysprep_params = \
             kwargs['sysprep_params'] if 'sysprep_params' in kwargs else {}
+        self.source = kwargs['source'] if 'source' in kwargs else None
+        # In read-only mode the medium is attached to the helper VM read-only
+        # and any changes are discarded
+        self.readonly = kwargs['readonly'] if 'readonly' in kwargs else False
 
         self.progress_bar = None
+        self.ntfs_shrink_support = False
         self.guestfs_device = None
         self.size = 0
 
-        self.g = guestfs.GuestFS()
+        # True if the blocks discarded by the helper VM read as zeros
+        self.discard = False
+
+        self.g = InspectedGuestFS(guestfs.GuestFS())
         self.guestfs_enabled = False
         self.guestfs_version = self.g.version()
 
+        # True if the helper VM is running, even if the medium is detached
+        self._appliance_running = False
+        self._hotplug = False
+
+        # The inspection cache file of the source medium and the entry loaded
+        # from it, if any
+        self._inspection_file = None
+        self._inspection = None
+
+        # Cached directory listings of the mounted file systems
+        self._dir_cache = {}
+        self._dir_cache_stats = {'lookups': 0, 'calls': 0}
+
         # This is needed if the image format is not raw
         self.nbd = QemuNBD(device)
 
@@ -89,8 +178,15 @@ class Image(object):
 
         self.enable_guestfs()
 
+        self.ntfs_shrink_support = self._check_ntfs_shrink_support()
+
         self.out.info('Inspecting Operating System ...', False)
-        roots = self.g.inspect_os()
+        with self.out.phase('inspection') as phase:
+            phase['cached'] = self._load_inspection()
+            if phase['cached']:
+                roots = self._inspection['roots']
+            else:
+                roots = self.g.inspect_os()
 
         if len(roots) == 0 or len(roots) > 1:
             self.root = None
@@ -105,6 +201,7 @@ class Image(object):
                 reason = "Unable to detect any operating system on the medium."
 
             self.set_unsupported(reason)
+            self._save_inspection(roots)
             return
 
         self.root = roots[0]
@@ -119,7 +216,126 @@ class Image(object):
             self.ostype if self.distro == "unknown" else self.distro)
 
         # Inspect the OS
-        self.os.inspect()
+        if self._inspection is None:
+            self.os.inspect()
+            self._save_inspection(roots)
+        elif self._inspection['unsupported'] is not None:
+            self.set_unsupported(self._inspection['unsupported'])
+
+    def _fingerprint(self):
+        """Returns a fingerprint of the source medium, or None if the medium
+        cannot be fingerprinted.
+
+        The fingerprint covers the identity of the source medium, which is
+        the size and the modification time for image files and the device
+        number for block devices, and the content of the partition table and
+        the beginning of each partition, where the file system superblocks
+        live.
+        """
+        if self.source is None:
+            return None
+
+        try:
+            st = os.stat(self.source)
+        except OSError:
+            return None
+
+        if stat.S_ISREG(st.st_mode):
+            ident = ['file', st.st_dev, st.st_ino, st.st_size, st.st_mtime]
+        elif stat.S_ISBLK(st.st_mode):
+            ident = ['block', st.st_rdev]
+        else:
+            return None
+
+        # Newer versions may collect more info
+        ident += [version, self.guestfs_version['major'],
+                  self.guestfs_version['minor'],
+                  self.guestfs_version['release']]
+
+        fingerprint = hashlib.sha1(json.dumps(ident))
+
+        MB = 2 ** 20
+        device = '/dev/sda'
+        size = self.g.blockdev_getsize64(device)
+
+        # The primary partition table, the backup GPT and the superblocks
+        regions = [(0, MB), (size - MB, MB)]
+        try:
+            for part in self.g.part_list(device):
+                regions.append((part['part_start'], MB // 4))
+        except RuntimeError:
+            # No partition table
+            pass
+
+        fingerprint.update(str(size))
+        for offset, length in regions:
+            offset = max(0, offset)
+            length = min(length, size - offset)
+            if length > 0:
+                fingerprint.update(
+                    self.g.pread_device(device, length, offset))
+
+        return fingerprint.hexdigest()
+
+    def _load_inspection(self):
+        """Look up the inspection cache for the results of a previous
+        inspection of the source medium. Returns True if they were found.
+
+        The cached results are only used if the medium is attached read-only.
+        A build modifies the medium based on the results of the inspection,
+        so it always inspects the medium itself. It still saves the results
+        for the read-only runs that follow.
+        """
+        fingerprint = self._fingerprint()
+        if fingerprint is None:
+            return False
+
+        self._inspection_file = os.path.join(
+            get_cache_dir(), self.INSPECTION_FILE % fingerprint)
+
+        if not self.readonly:
+            return False
+
+        try:
+            with open(self._inspection_file) as f:
+                entry = _to_str(json.load(f))
+        except (IOError, ValueError):
+            return False
+
+        log.debug("Using cached inspection results: `%s'",
+                  self._inspection_file)
+        self._inspection = entry
+        self.g.calls = entry['calls']
+        return True
+
+    def _save_inspection(self, roots):
+        """Save the results of the inspection of the source medium and the
+        collected metadata in the inspection cache
+        """
+        if self._inspection_file is None or self._inspection is not None:
+            return
+
+        entry = {'roots': roots, 'calls': self.g.calls, 'meta': self.meta,
+                 'unsupported': getattr(self, '_unsupported', None)}
+
+        # Write to a temporary file and rename it, so that concurrent image
+        # creations never read a partially written entry.
+        directory = os.path.dirname(self._inspection_file)
+        try:
+            fd, tmp = tempfile.mkstemp(dir=directory)
+        except OSError as e:
+            log.debug("Unable to save the inspection results `%s': %s",
+                      self._inspection_file, e)
+            return
+
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.rename(tmp, self._inspection_file)
+        except (IOError, OSError, ValueError) as e:
+            os.unlink(tmp)
+            log.debug("Unable to save the inspection results `%s': %s",
+                      self._inspection_file, e)
 
     def set_unsupported(self, reason):
         """Flag this image as unsupported"""
@@ -132,6 +348,87 @@ class Image(object):
         """Returns if this image is unsupported"""
         return hasattr(self, '_unsupported')
 
+    def _hotplug_supported(self):
+        """Checks if drives can be added to and removed from the helper VM
+        after it has been launched. This is only supported by the libvirt
+        backend of libguestfs 1.19.49 or newer.
+        """
+        if self.check_guestfs_version(1, 19, 49) < 0:
+            return False
+
+        try:
+            backend = self.g.get_backend()
+        except AttributeError:
+            # get_backend was introduced in version 1.21.26
+            backend = self.g.get_attach_method()
+
+        return backend.startswith('libvirt')
+
+    def _attach_medium(self):
+        """Hot-add the medium to a running helper VM. Returns False if the
+        medium did not show up as /dev/sda.
+        """
+        self.out.info('Reattaching medium to the helper VM ...', False)
+        start = time.time()
+        try:
+            with self.out.phase('guestfs-attach'):
+                self._add_drive(label=self.DRIVE_LABEL)
+        except RuntimeError as e:
+            self.out.warn("failed: %s" % str(e))
+            return False
+
+        if self.g.list_devices() != ['/dev/sda']:
+            self.out.warn("medium not found on /dev/sda")
+            self.g.remove_drive(self.DRIVE_LABEL)
+            return False
+
+        self.guestfs_enabled = True
+        self.out.success('done (%.1fs)' % (time.time() - start))
+        return True
+
+    def _add_drive(self, **kwargs):
+        """Add the medium to the guestfs handler. The discard requests of the
+        helper VM are passed to the medium, if possible.
+        """
+        if self.readonly:
+            self.g.add_drive_opts(self.device, readonly=1, **kwargs)
+            self.discard = False
+            return
+
+        try:
+            self.g.add_drive_opts(self.device, readonly=0,
+                                  discard='besteffort', **kwargs)
+        except TypeError:
+            # Older libguestfs versions lack the discard option
+            self.g.add_drive_opts(self.device, readonly=0, **kwargs)
+            self.discard = False
+            return
+
+        self.discard = self._discard_zeroes()
+
+    def _discard_zeroes(self):
+        """Check if the discarded regions of the medium read as zeros"""
+
+        # Block devices, like device-mapper snapshots, may silently ignore the
+        # discard requests.
+        if not os.path.isfile(self.device):
+            return False
+
+        # QEMU punches holes in raw image files
+        if self.format == 'raw':
+            return True
+
+        # In qcow2 v2 images the discarded clusters fall through to the
+        # backing file
+        if self.format == 'qcow2':
+            info = image_info(self.device)
+            if 'backing-filename' not in info:
+                return True
+            specific = info.get('format-specific', {}).get('data', {})
+            return specific.get('compat', '0.10') != '0.10'
+
+        return False
+
     def enable_guestfs(self):
         """Enable the guestfs handler"""
 
@@ -139,20 +436,34 @@ class Image(object):
             self.out.warn("Guestfs is already enabled")
             return
 
+        # If the helper VM is still running, there is no need to relaunch it.
+        # Just attach the medium to it again.
+        if self._appliance_running:
+            if self._attach_medium():
+                return
+            self._shutdown_appliance()
+
         # Before version 1.18.4 the behavior of kill_subprocess was different
         # and you need to reset the guestfs handler to relaunch a previously
         # shut down QEMU backend
         if self.check_guestfs_version(1, 18, 4) < 0:
-            self.g = guestfs.GuestFS()
+            self.g.handle = guestfs.GuestFS()
+            self.g.inspected = False
 
-        self.g.add_drive_opts(self.device, readonly=0)
+        self._hotplug = self._hotplug_supported()
+        if self._hotplug:
+            # Hot-removing a drive requires a label
+            self._add_drive(label=self.DRIVE_LABEL)
+        else:
+            self._add_drive()
 
         # Before version 1.17.14 the recovery process, which is a fork of the
         # original process that called libguestfs, did not close its inherited
         # file descriptors. This can cause problems especially if the parent
         # process has opened pipes. Since the recovery process is an optional
-        # feature of libguestfs, it's better to disable it.
-        if self.check_guestfs_version(1, 17, 14) >= 0:
+        # feature of libguestfs, it's better to disable it. In read-only mode
+        # a stray helper VM cannot harm the medium, so don't bother forking it.
+        if not self.readonly and self.check_guestfs_version(1, 17, 14) >= 0:
             self.out.info("Enabling recovery process ...", False)
             self.g.set_recovery_proc(1)
             self.out.success('done')
@@ -167,14 +478,17 @@ class Image(object):
         #                                     "percent")
         # eh = self.g.set_event_callback(self.progress_callback,
         #                               guestfs.EVENT_PROGRESS)
+        start = time.time()
         try:
-            self.g.launch()
+            with self.out.phase('guestfs-launch'):
+                self.g.launch()
         except RuntimeError as e:
             raise FatalError(
                 "Launching libguestfs's helper VM failed!\nReason: %s.\n\n"
                 "Please run `libguestfs-test-tool' for more info." % str(e))
 
         self.guestfs_enabled = True
+        self._appliance_running = True
         # self.g.delete_event_callback(eh)
         # self.progressbar.success('done')
         # self.progressbar = None
@@ -182,17 +496,11 @@ class Image(object):
         if self.check_guestfs_version(1, 18, 4) < 0:
             self.g.inspect_os()  # some calls need this
 
-        self.out.success('done')
-
-    def disable_guestfs(self):
-        """Disable the guestfs handler"""
+        self.out.success('done (%.1fs)' % (time.time() - start))
 
-        if not self.guestfs_enabled:
-            self.out.warn("Guestfs is already disabled")
-            return
+    def _shutdown_appliance(self):
+        """Shut down the helper VM"""
 
-        self.out.info("Shutting down helper VM ...", False)
-        self.g.sync()
         # guestfs_shutdown which is the preferred way to shutdown the backend
         # process was introduced in version 1.19.16
         if self.check_guestfs_version(1, 19, 16) >= 0:
@@ -204,9 +512,87 @@ class Image(object):
         if self.check_guestfs_version(1, 18, 4) < 0:
             self.g.close()
 
+        self._appliance_running = False
+
+    def disable_guestfs(self):
+        """Disable the guestfs handler.
+
+        If the libguestfs backend supports hot-plugging, the medium is just
+        detached from the helper VM, which is kept running to be reused by
+        the next enable_guestfs() call.
+        """
+
+        if not self.guestfs_enabled:
+            self.out.warn("Guestfs is already disabled")
+            return
+
+        self.invalidate_dir_cache()
+
+        if self._hotplug:
+            self.out.info("Detaching medium from the helper VM ...", False)
+            self.g.umount_all()
+            self.g.sync()
+            self.g.drop_caches(3)
+            try:
+                self.g.remove_drive(self.DRIVE_LABEL)
+                self.guestfs_enabled = False
+                self.out.success('done')
+                return
+            except RuntimeError as e:
+                self.out.warn("failed: %s" % str(e))
+
+        self.out.info("Shutting down helper VM ...", False)
+        self.g.sync()
+        self._shutdown_appliance()
+
         self.guestfs_enabled = False
         self.out.success('done')
 
+    def _ftype(self, path):
+        """Returns the type of a file of the mounted file systems, as returned
+        by readdir, or None if the file does not exist. Symbolic links are not
+        followed. The directory listings are cached.
+        """
+        self._dir_cache_stats['lookups'] += 1
+
+        path = posixpath.normpath('/' + path)
+        if path == '/':
+            return 'd'
+
+        directory, name = posixpath.split(path)
+        if directory not in self._dir_cache:
+            self._dir_cache_stats['calls'] += 1
+            try:
+                entries = dict((e['name'], e['ftyp'])
+                               for e in self.g.readdir(directory))
+            except RuntimeError:
+                entries = {}
+            self._dir_cache[directory] = entries
+
+        return self._dir_cache[directory].get(name)
+
+    def is_file(self, path):
+        """Check if a path of the mounted file systems is a regular file, like
+        guestfs is_file() does, using the directory listing cache
+        """
+        return self._ftype(path) == 'r'
+
+    def is_dir(self, path):
+        """Check if a path of the mounted file systems is a directory, like
+        guestfs is_dir() does, using the directory listing cache
+        """
+        return self._ftype(path) == 'd'
+
+    def invalidate_dir_cache(self):
+        """Empty the directory listing cache. This needs to be called whenever
+        the mounted file systems may get modified.
+        """
+        if len(self._dir_cache):
+            log.debug("Directory cache: %(lookups)d lookups served with "
+                      "%(calls)d appliance calls", self._dir_cache_stats)
+        self._dir_cache = {}
+        self._dir_cache_stats = {'lookups': 0, 'calls': 0}
+
     @property
     def os(self):
         """Return an OS class instance for this image"""
@@ -219,7 +605,10 @@ class Image(object):
         cls = os_cls(self.distro, self.ostype)
         self._os = cls(self, sysprep_params=self.sysprep_params)
 
-        self._os.collect_metadata()
+        if self._inspection is not None:
+            self.meta.update(self._inspection['meta'])
+        else:
+            self._os.collect_metadata()
 
         return self._os
 
@@ -293,15 +682,190 @@ class Image(object):
 
         return last_partition
 
-    def shrink(self, silent=False):
+    def shrink(self, silent=False, resize=True):
         """Shrink the image.
 
         This is accomplished by shrinking the last file system of the
         image and then updating the partition table. The new disk size
         (in bytes) is returned.
 
+        If resize is False, the file system of the last partition is left
+        intact and only the empty space after the last partition is dropped.
+
         ATTENTION: make sure unmount is called before shrink
         """
+        with self.out.phase('shrink') as phase:
+            phase['bytes'] = self.size
+            return self._shrink(silent, resize)
+
+    def _tune2fs_l(self, part_dev):
+        """Returns the superblock info of an ext[234] file system as a
+        dictionary
+        """
+        # Depending on the version of the bindings, this is either a
+        # dictionary or a list of tuples
+        return dict(self.g.tune2fs_l(part_dev))
+
+    def _is_fs_clean(self, part_dev):
+        """Checks if an ext[234] file system is known to be clean. This is
+        true if the file system state is clean, which is the case after a
+        clean unmount, and no errors have been recorded. Such a file system
+        does not need a forced check before it gets resized.
+        """
+        info = self._tune2fs_l(part_dev)
+
+        if info.get('Filesystem state', '').strip() != 'clean':
+            return False
+
+        try:
+            return int(info.get('FS Error count', '0')) == 0
+        except ValueError:
+            return False
+
+    @staticmethod
+    def _fsck_needed(error):
+        """Checks if resize2fs failed because it wants a forced check of the
+        file system first
+        """
+        return 'e2fsck -f' in str(error)
+
+    def _e2fsck(self, part_dev):
+        """Run a forced file system check on an ext[234] file system"""
+        try:
+            if self.check_guestfs_version(1, 15, 17) >= 0:
+                self.g.e2fsck(part_dev, forceall=1)
+            else:
+                self.g.e2fsck_f(part_dev)
+        except RuntimeError as e:
+            # There is a bug in some versions of libguestfs and a RuntimeError
+            # is thrown although the command has successfully corrected the
+            # found file system errors.
+            if e.message.find('***** FILE SYSTEM WAS MODIFIED *****') == -1:
+                raise
+
+    def _resize2fs(self, part_dev):
+        """Shrink an ext[234] file system.
+
+        In fast shrink mode, the file system is resized to a size estimated
+        from its free block count. If this fails, or the mode is not enabled,
+        resize2fs computes the minimum size of the file system itself, which
+        takes considerably longer on large file systems.
+        """
+        if self.fast_shrink:
+            info = self._tune2fs_l(part_dev)
+            block_size = int(info['Block size'])
+            block_cnt = int(info['Block count'])
+            used = block_cnt - int(info['Free blocks'])
+
+            # Leave space for the file system metadata and the files that
+            # will be created when the image is deployed
+            margin = max(used // 10, (256 * 2 ** 20) // block_size)
+            target = used + margin
+            if target >= block_cnt:
+                return
+
+            try:
+                self.g.resize2fs_size(part_dev, target * block_size)
+                return
+            except RuntimeError as e:
+                if self._fsck_needed(e):
+                    raise
+                self.out.warn("Fast shrinking failed: %s. Falling back to "
+                              "computing the minimum file system size" % e)
+
+        self.g.resize2fs_M(part_dev)
+
+    def _shrink_ext(self, part_dev):
+        """Shrink an ext[234] file system. Returns its new size in bytes"""
+
+        # The medium has been cleanly unmounted before shrinking, so the
+        # forced check is only needed if errors have been recorded
+        with self.out.phase('shrink:e2fsck') as phase:
+            phase['skipped'] = self._is_fs_clean(part_dev)
+            if not phase['skipped']:
+                self._e2fsck(part_dev)
+
+        try:
+            with self.out.phase('shrink:resize2fs'):
+                self._resize2fs(part_dev)
+        except RuntimeError as e:
+            # Older versions of resize2fs insist on a forced check if the file
+            # system has been mounted after it was last checked
+            if not phase['skipped'] or not self._fsck_needed(e):
+                raise
+            with self.out.phase('shrink:e2fsck'):
+                self._e2fsck(part_dev)
+            with self.out.phase('shrink:resize2fs'):
+                self._resize2fs(part_dev)
+
+        info = self._tune2fs_l(part_dev)
+        return int(info['Block size']) * int(info['Block count'])
+
+    def _check_ntfs_shrink_support(self):
+        """Checks if NTFS file systems can be shrunk by the helper VM"""
+
+        # vfs_minimum_size was introduced in version 1.31.18
+        if self.check_guestfs_version(1, 31, 18) < 0:
+            return False
+
+        try:
+            self.g.available(['ntfsprogs'])
+        except RuntimeError:
+            return False
+
+        return True
+
+    def _shrink_ntfs(self, part_dev):
+        """Shrink an NTFS file system offline. Returns its new size in bytes or
+        None if the file system cannot be shrunk.
+        """
+        MB = 2 ** 20
+
+        with self.out.phase('shrink:ntfs-minimum-size'):
+            current = self.g.blockdev_getsize64(part_dev)
+            try:
+                minimum = self.g.vfs_minimum_size(part_dev)
+            except RuntimeError as e:
+                # This fails if the file system is not clean
+                self.out.warn("Unable to shrink the NTFS file system: %s" % e)
+                return None
+
+        # From ntfsresize:
+        # Practically the smallest shrunken size generally is at around
+        # "used space" + (20-200 MB). Please also take into account that
+        # Windows might need about 50-100 MB free space left to boot safely.
+        # Give 100MB extra space just to be sure.
+        target = (minimum + 100 * MB + MB - 1) // MB * MB
+        if target >= current:
+            return None
+
+        with self.out.phase('shrink:ntfsresize'):
+            self.g.ntfsresize(part_dev, size=target)
+
+        with self.out.phase('shrink:ntfsfix'):
+            if not self._clear_ntfs_dirty(part_dev):
+                self.out.warn("Unable to clear the dirty flag of the NTFS "
+                              "file system. Windows will check it on the "
+                              "first boot of each instance.")
+
+        return target
+
+    def _clear_ntfs_dirty(self, part_dev):
+        """ntfsresize marks the NTFS file system as dirty, which makes
+        Windows run chkdsk on the first boot of every instance deployed from
+        the image. Clear the flag with ntfsfix, which is not exposed by the
+        libguestfs API and runs in the helper VM. Returns False if this fails.
+        """
+        try:
+            self.g.debug('sh', ['ntfsfix', '-d', part_dev])
+        except RuntimeError as e:
+            log.debug("ntfsfix -d %s failed: %s", part_dev, e)
+            return False
+
+        return True
+
+    def _shrink(self, silent=False, resize=True):
+        """Do the actual shrinking of the image"""
         get_fstype = lambda p: \
             self.g.vfs_type("%s%d" % (self.guestfs_device, p['part_num']))
         is_logical = lambda p: \
@@ -353,34 +917,26 @@ class Image(object):
             self.size = min(self.size, new_size)
             break
 
-        if not re.match("ext[234]", fstype):
-            if not silent:
-                self.out.warn(
-                    "Don't know how to shrink %s partitions." % fstype)
+        if not resize:
             return self.size
 
         part_dev = "%s%d" % (self.guestfs_device, last_part['part_num'])
 
-        try:
-            if self.check_guestfs_version(1, 15, 17) >= 0:
-                self.g.e2fsck(part_dev, forceall=1)
-            else:
-                self.g.e2fsck_f(part_dev)
-        except RuntimeError as e:
-            # There is a bug in some versions of libguestfs and a RuntimeError
-            # is thrown although the command has successfully corrected the
-            # found file system errors.
-            if e.message.find('***** FILE SYSTEM WAS MODIFIED *****') == -1:
-                raise
-
-        self.g.resize2fs_M(part_dev)
+        if re.match("ext[234]", fstype):
+            fs_size = self._shrink_ext(part_dev)
+        elif fstype == 'ntfs' and self.ntfs_shrink_support:
+            fs_size = self._shrink_ntfs(part_dev)
+        else:
+            if not silent:
+                self.out.warn(
+                    "Don't know how to shrink %s partitions." % fstype)
+            return self.size
 
-        out = self.g.tune2fs_l(part_dev)
-        block_size = int(filter(lambda x: x[0] == 'Block size', out)[0][1])
-        block_cnt = int(filter(lambda x: x[0] == 'Block count', out)[0][1])
+        if fs_size is None:
+            return self.size
 
         start = last_part['part_start'] / sector_size
-        end = start + (block_size * block_cnt) / sector_size - 1
+        end = start + (fs_size + sector_size - 1) / sector_size - 1
 
         if is_logical(last_part):
             partitions = self.g.part_list(self.guestfs_device)
@@ -410,9 +966,16 @@ class Image(object):
                 part_set_id(l['num'], l['id'])
                 part_set_bootable(l['num'], l['bootable'])
         else:
-            # Recreate the last partition
+            # Recreate the last partition. The partition type GUID of GPT
+            # partitions was introduced in version 1.21.1
+            gpt_type = self.meta['PARTITION_TABLE'] == 'gpt' and \
+                self.check_guestfs_version(1, 21, 1) >= 0
+
             if self.meta['PARTITION_TABLE'] == 'msdos':
                 last_part['id'] = part_get_id(last_part['part_num'])
+            elif gpt_type:
+                last_part['type'] = self.g.part_get_gpt_type(
+                    self.guestfs_device, last_part['part_num'])
 
             last_part['bootable'] = part_get_bootable(last_part['part_num'])
             part_del(last_part['part_num'])
@@ -421,6 +984,10 @@ class Image(object):
 
             if self.meta['PARTITION_TABLE'] == 'msdos':
                 part_set_id(last_part['part_num'], last_part['id'])
+            elif gpt_type:
+                self.g.part_set_gpt_type(self.guestfs_device,
+                                         last_part['part_num'],
+                                         last_part['type'])
 
         new_size = (end + 1) * sector_size
 
@@ -503,59 +1070,140 @@ class Image(object):
         self._mount_thread = None
         return True
 
+    def extents(self):
+        """Returns a list of (offset, length) tuples with the regions of the
+        image payload that may contain data. The rest of the payload is known
+        to read as zeros. If the image is not in sparse mode, the whole
+        payload is considered data.
+        """
+        if not self.sparse:
+            return [(0, self.size)]
+
+        # Make sure everything is written back to the medium
+        if self.guestfs_enabled:
+            self.g.umount_all()
+            self.g.sync()
+
+        return data_extents(self.device, self.format, self.size)
+
+    def _regions(self):
+        """Yields (offset, length, is_data) tuples that cover the whole image
+        payload.
+        """
+        offset = 0
+        for start, length in self.extents():
+            if start > offset:
+                yield offset, start - offset, False
+            yield start, length, True
+            offset = start + length
+
+        if offset < self.size:
+            yield offset, self.size - offset, False
+
     def dump(self, outfile):
         """Dumps the content of the image into a file.
 
         This method will only dump the actual payload, found by reading the
         partition table. Empty space in the end of the device will be ignored.
+        In sparse mode, holes are not written to the output file.
         """
         MB = 2 ** 20
         blocksize = 2 ** 22  # 4MB
         progr_size = (self.size + MB - 1) // MB  # in MB
         progressbar = self.out.Progress(progr_size, "Dumping image file", 'mb')
 
-        with self.raw_device() as raw:
+        regions = list(self._regions())
+        with self.out.phase('dump', self.size), self.raw_device() as raw:
             with open(raw, 'rb') as src:
                 with open(outfile, "wb") as dst:
-                    left = self.size
-                    offset = 0
                     progressbar.next()
-                    while left > 0:
-                        length = min(left, blocksize)
-                        sent = sendfile(dst.fileno(), src.fileno(), offset,
-                                        length)
-
-                        # Workaround for python-sendfile API change. In
-                        # python-sendfile 1.2.x (py-sendfile) the returning
-                        # value of sendfile is a tuple, where in version 2.x
-                        # (pysendfile) it is just a single integer.
-                        if isinstance(sent, tuple):
-                            sent = sent[1]
-
-                        offset += sent
-                        left -= sent
-                        progressbar.goto((self.size - left) // MB)
+                    for offset, length, is_data in regions:
+                        if not is_data:
+                            progressbar.goto((offset + length) // MB)
+                            continue
+
+                        dst.seek(offset)
+                        left = length
+                        while left > 0:
+                            sent = sendfile(dst.fileno(), src.fileno(),
+                                            offset, min(left, blocksize))
+
+                            # Workaround for python-sendfile API change. In
+                            # python-sendfile 1.2.x (py-sendfile) the
+                            # returning value of sendfile is a tuple, where in
+                            # version 2.x (pysendfile) it is just a single
+                            # integer.
+                            if isinstance(sent, tuple):
+                                sent = sent[1]
+
+                            offset += sent
+                            left -= sent
+                            progressbar.goto(offset // MB)
+
+                    # Extend the file if it ends with a hole
+                    dst.truncate(self.size)
 
         progressbar.success('image file %s was successfully created' % outfile)
 
+    def _blocks(self, progressbar):
+        """Yields the payload of the image in 4MB blocks, moving the progress
+        bar forward as the blocks are read. In sparse mode, the holes are not
+        read. Blocks full of zeros are yielded for them instead.
+        """
+        MB = 2 ** 20
+        blocksize = 2 ** 22  # 4MB
+        zeros = '\x00' * blocksize
+
+        regions = list(self._regions())
+        with self.raw_device() as raw:
+            with open(raw, "rb") as src:
+                for offset, length, is_data in regions:
+                    if is_data:
+                        src.seek(offset)
+                    end = offset + length
+                    while offset < end:
+                        size = min(end - offset, blocksize)
+                        # Keep the blocks aligned to blocksize
+                        size = min(size, blocksize - offset % blocksize)
+                        if is_data:
+                            yield src.read(size)
+                        else:
+                            yield zeros if size == blocksize else zeros[:size]
+                        offset += size
+                        progressbar.goto(offset // MB)
+
+    def tee(self, consumers, title="Processing image"):
+        """Reads the image payload once and feeds every block to all the
+        consumers.
+
+        Each consumer is a callable that accepts a data block. The blocks are
+        fed to the consumers in the order they are found on the device. This
+        can be used to compute the md5sum, dump the image and calculate the
+        block hashes needed for uploading it, in a single pass.
+        """
+
+        MB = 2 ** 20
+        progr_size = ((self.size + MB - 1) // MB)  # in MB
+        progressbar = self.out.Progress(progr_size, title, 'mb')
+
+        with self.out.phase('single-pass', self.size):
+            for data in self._blocks(progressbar):
+                for consumer in consumers:
+                    consumer(data)
+
+        progressbar.success('done')
+
     def md5(self):
         """Computes the MD5 checksum of the image"""
 
         MB = 2 ** 20
-        blocksize = 2 ** 22  # 4MB
         progr_size = ((self.size + MB - 1) // MB)  # in MB
         progressbar = self.out.Progress(progr_size, "Calculating md5sum", 'mb')
         md5 = hashlib.md5()
 
-        with self.raw_device() as raw:
-            with open(raw, "rb") as src:
-                left = self.size
-                while left > 0:
-                    length = min(left, blocksize)
-                    data = src.read(length)
-                    md5.update(data)
-                    left -= length
-                    progressbar.goto((self.size - left) // MB)
+        with self.out.phase('md5sum', self.size):
+            for data in self._blocks(progressbar):
+                md5.update(data)
 
         checksum = md5.hexdigest()
         progressbar.success(checksum)
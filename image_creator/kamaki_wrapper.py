@@ -21,9 +21,16 @@ deployment.
 """
 
 import sys
+import os
+import stat
+import json
 import logging
+import time
+import hashlib
+import threading
 
 from os.path import basename
+from multiprocessing.pool import ThreadPool
 
 from kamaki.cli.config import Config
 from kamaki.clients import ClientError
@@ -31,6 +38,8 @@ from kamaki.clients.image import ImageClient
 from kamaki.clients.pithos import PithosClient
 from kamaki.clients.astakos import CachedAstakosClient as AstakosClient
 
+from image_creator.util import get_cache_dir
+
 try:
     from kamaki.clients.utils import https
     https.patch_ignore_ssl()
@@ -45,6 +54,205 @@ except Exception as e:
     sys.stderr.write("Kamaki config error: %s\n" % str(e))
     sys.exit(1)
 
+log = logging.getLogger(__name__)
+
+DEFAULT_UPLOAD_WORKERS = 4
+# The manifest of a file with a given fingerprint, hosted in the cache
+# directory
+MANIFEST_FILE = 'hashmap-%s.json'
+# Manifests older than this (in seconds) are pruned from the cache
+MANIFEST_MAX_AGE = 7 * 24 * 3600
+
+
+def _block_hash(blockhash, block):
+    """Compute the Pithos+ hash of a block"""
+    h = hashlib.new(blockhash)
+    h.update(block.rstrip('\x00'))
+    return h.hexdigest()
+
+
+class BlockHasher(object):
+    """Computes the Pithos+ hashmap of a stream of data.
+
+    The data may be fed in chunks of any size. Every block is hashed after
+    stripping its trailing zeros, the same way the storage service does.
+    """
+
+    def __init__(self, blocksize, blockhash):
+        """Create a BlockHasher instance"""
+        self.blocksize = blocksize
+        self.blockhash = blockhash
+        self.hashes = []
+        self.size = 0
+        self._buf = []
+        self._buflen = 0
+        self._offsets = None
+
+    def _hash(self, block):
+        """Append the hash of a block to the hashmap"""
+        self.hashes.append(_block_hash(self.blockhash, block))
+
+    def update_blocks(self, blocks, pool):
+        """Feed the hasher with a list of full blocks, hashing them in
+        parallel using a pool of threads. Returns an AsyncResult that needs
+        to be passed to update_blocks_finish() when it is ready.
+        """
+        assert self._buflen == 0, "Hasher contains unaligned data"
+        blockhash = self.blockhash
+        return pool.map_async(lambda b: _block_hash(blockhash, b), blocks)
+
+    def update_blocks_finish(self, result, size):
+        """Append the hashes computed by an update_blocks() call for blocks
+        of the given total size to the hashmap
+        """
+        self.hashes.extend(result.get())
+        self.size += size
+
+    def update(self, data):
+        """Feed the hasher with more data"""
+        self.size += len(data)
+
+        # Fast path: The data are block aligned
+        if self._buflen == 0 and len(data) == self.blocksize:
+            self._hash(data)
+            return
+
+        self._buf.append(data)
+        self._buflen += len(data)
+        if self._buflen < self.blocksize:
+            return
+
+        data = "".join(self._buf)
+        offset = 0
+        while len(data) - offset >= self.blocksize:
+            self._hash(data[offset:offset + self.blocksize])
+            offset += self.blocksize
+
+        self._buf = [data[offset:]] if offset < len(data) else []
+        self._buflen = len(data) - offset
+
+    def finalize(self):
+        """Hash the last, partial block. Returns the hashmap"""
+        if self._buflen:
+            self._hash("".join(self._buf))
+            self._buf = []
+            self._buflen = 0
+
+        return {'bytes': self.size, 'hashes': self.hashes}
+
+    def stats(self):
+        """Returns the number of blocks of the hashmap, the number of unique
+        blocks and the number of blocks full of zeros
+        """
+        zero = _block_hash(self.blockhash, '')
+        return {'blocks': len(self.hashes),
+                'unique_blocks': len(set(self.hashes)),
+                'zero_blocks': self.hashes.count(zero)}
+
+    def _manifest(self, file_obj):
+        """Returns the path of the manifest of a file, or None if the file has
+        no manifest.
+
+        Only regular files have a manifest. It is keyed on the identity of the
+        file, which is the path, the device and inode numbers, the size and
+        the modification time, and can be computed without reading the file.
+        The contents of other files, like the snapshot devices, may change
+        without any change in their identity.
+        """
+        try:
+            st = os.fstat(file_obj.fileno())
+        except (AttributeError, ValueError, OSError):
+            return None
+
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        ident = [os.path.abspath(file_obj.name), st.st_dev, st.st_ino,
+                 st.st_size, st.st_mtime, self.blocksize, self.blockhash]
+        fingerprint = hashlib.sha1(json.dumps(ident)).hexdigest()
+        return os.path.join(get_cache_dir(), MANIFEST_FILE % fingerprint)
+
+    def load(self, file_obj, size):
+        """Load the block hashes of the first size bytes of a file from the
+        file's manifest. Returns True if a valid manifest was found.
+        """
+        try:
+            fname = self._manifest(file_obj)
+            if fname is None:
+                return False
+
+            with open(fname) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+
+        if manifest.get('bytes') != size:
+            log.debug("Ignoring stale manifest: `%s'", fname)
+            return False
+
+        assert self.size == 0, "Hasher already contains data"
+        self.hashes = manifest['hashes']
+        self.size = size
+        self._offsets = None
+        return True
+
+    def save(self, file_obj):
+        """Save the computed block hashes in the manifest of file_obj, if it
+        has one, so that they can be reused if the upload fails and is
+        retried. The expired manifests of other files are pruned.
+        """
+        fname = None
+        try:
+            fname = self._manifest(file_obj)
+            if fname is None:
+                return
+
+            manifest = {'bytes': self.size, 'hashes': self.hashes}
+            with open(fname + '.tmp', 'w') as f:
+                json.dump(manifest, f)
+            os.rename(fname + '.tmp', fname)
+
+            self._prune(os.path.dirname(fname))
+        except (IOError, OSError) as e:
+            # The manifest is just an optimization
+            log.debug("Unable to save manifest `%s': %s", fname, e)
+
+    def remove(self, file_obj):
+        """Remove the manifest of file_obj, if any. This is called after the
+        file has been uploaded.
+        """
+        fname = None
+        try:
+            fname = self._manifest(file_obj)
+            if fname is not None and os.path.exists(fname):
+                os.unlink(fname)
+        except OSError as e:
+            log.debug("Unable to remove manifest `%s': %s", fname, e)
+
+    @staticmethod
+    def _prune(directory):
+        """Remove the manifests of a directory that have expired"""
+        prefix, suffix = MANIFEST_FILE.split('%s')
+        expired = time.time() - MANIFEST_MAX_AGE
+        for name in os.listdir(directory):
+            if not (name.startswith(prefix) and name.endswith(suffix)):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    def offset(self, blockhash):
+        """Returns the offset of the first block with this hash"""
+        if self._offsets is None:
+            self._offsets = {}
+            for i in xrange(len(self.hashes) - 1, -1, -1):
+                self._offsets[self.hashes[i]] = i * self.blocksize
+
+        return self._offsets[blockhash]
+
 
 class Kamaki(object):
     """Wrapper class for the ./kamaki library"""
@@ -124,40 +332,213 @@ class Kamaki(object):
 
         return Kamaki.create_account(cloud['url'], cloud['token'])
 
-    def __init__(self, account, output):
+    def __init__(self, account, output, workers=DEFAULT_UPLOAD_WORKERS):
         """Create a Kamaki instance"""
         self.account = account
         self.out = output
+        self.workers = workers
 
-        self.pithos = PithosClient(
+        self._pithos_args = (
             self.account.get_service_endpoints('object-store')['publicURL'],
             self.account.token,
             self.account.user_info()['id'],
             self.CONTAINER)
+        self.pithos = PithosClient(*self._pithos_args)
+        self._local = threading.local()
 
         self.image = ImageClient(
             self.account.get_service_endpoints('image')['publicURL'],
             self.account.token)
 
-    def upload(self, file_obj, size=None, remote_path=None, hp=None, up=None):
-        """Upload a file to Pithos+"""
-
-        path = basename(file_obj.name) if remote_path is None else remote_path
+    def _thread_pithos(self):
+        """Returns a PithosClient instance private to the calling thread.
+        Each instance keeps its own HTTP connections open between requests.
+        """
+        if not hasattr(self._local, 'pithos'):
+            self._local.pithos = PithosClient(*self._pithos_args)
+        return self._local.pithos
 
+    def _create_container(self):
+        """Create the container that hosts the images, if missing"""
         try:
             self.pithos.create_container(self.CONTAINER)
         except ClientError as e:
             if e.status != 202:  # Ignore container already exists errors
                 raise e
 
+    def hasher(self):
+        """Returns a BlockHasher instance that computes block hashes suitable
+        for uploading data to the container that hosts the images
+        """
+        self._create_container()
+        info = self.pithos.get_container_info()
+
+        return BlockHasher(int(info['x-container-block-size']),
+                           info['x-container-block-hash'])
+
+    def upload(self, file_obj, size=None, remote_path=None, hp=None, up=None,
+               hasher=None):
+        """Upload a file to Pithos+
+
+        The block hashes are computed and the missing blocks are uploaded in
+        parallel by a pool of worker threads. If hasher is defined, it should
+        be a BlockHasher instance that has already been fed with the file's
+        data. In this case the block hashes are not recalculated and only the
+        missing blocks are read from the file.
+
+        For regular files, the block hashes are saved in a manifest in the
+        cache directory before any block is uploaded. If the upload fails, a
+        later upload of the same, unmodified file will reuse the manifest
+        instead of reading the file again. The manifest is removed after a
+        successful upload.
+        """
+
+        path = basename(file_obj.name) if remote_path is None else remote_path
+
         hash_cb = self.out.progress_generator(hp) if hp is not None else None
         upload_cb = self.out.progress_generator(up) if up is not None else None
 
-        self.pithos.upload_object(path, file_obj, size, hash_cb, upload_cb)
+        pool = ThreadPool(max(1, self.workers))
+        try:
+            if hasher is None:
+                hasher = self.hasher()
+                if size is None:
+                    file_obj.seek(0, 2)
+                    size = file_obj.tell()
+                    file_obj.seek(0)
+                if hasher.load(file_obj, size):
+                    if hp is not None:
+                        self.out.info("%s ... reused from manifest" % hp)
+                else:
+                    with self.out.phase('hash', size):
+                        self._hash_file(file_obj, size, hasher, pool,
+                                        hash_cb)
+                    hasher.finalize()
+                    hasher.save(file_obj)
+            else:
+                self._create_container()
+                hasher.finalize()
+                hasher.save(file_obj)
+
+            with self.out.phase('upload:%s' % path) as phase:
+                phase['bytes'] = self._upload_hashmap(path, file_obj, hasher,
+                                                      pool, upload_cb)
+                phase.update(hasher.stats())
+
+            hasher.remove(file_obj)
+
+            if up is not None:
+                self.out.info("\t%(blocks)d blocks, %(unique_blocks)d unique, "
+                              "%(zero_blocks)d full of zeros" % phase)
+        finally:
+            pool.close()
+            pool.join()
 
         return "pithos://%s/%s/%s" % (self.account.user_info()['id'],
                                       self.CONTAINER, path)
 
+    def _hash_file(self, file_obj, size, hasher, pool, hash_cb=None):
+        """Compute the block hashes of a file using a pool of threads. The
+        next batch of blocks is read while the previous one is hashed.
+        """
+
+        blocksize = hasher.blocksize
+        nblocks = (size + blocksize - 1) // blocksize
+
+        progress = None
+        if hash_cb is not None:
+            progress = hash_cb(nblocks)
+            progress.next()
+
+        left = size
+        pending = None
+        while True:
+            blocks = []
+            length = 0
+            while left > 0 and len(blocks) < self.workers:
+                block = file_obj.read(min(blocksize, left))
+                if not block:
+                    raise IOError("Unexpected end of file")
+                blocks.append(block)
+                length += len(block)
+                left -= len(block)
+
+            if pending is not None:
+                result, length_done, count = pending
+                hasher.update_blocks_finish(result, length_done)
+                if progress is not None:
+                    for _ in xrange(count):
+                        progress.next()
+
+            if not len(blocks):
+                break
+
+            pending = (hasher.update_blocks(blocks, pool), length,
+                       len(blocks))
+
+    def _upload_block(self, args):
+        """Upload a block to the container, if it matches its hash"""
+        blockhash, data = args
+        r = self._thread_pithos().container_post(
+            update=True, content_type='application/octet-stream',
+            content_length=len(data), data=data, format='json')
+        assert r.json[0] == blockhash, 'Local hash does not match server'
+
+    def _upload_hashmap(self, path, file_obj, hasher, pool, upload_cb=None):
+        """Create a remote object out of a precomputed hashmap, uploading only
+        the blocks that are missing from the storage service. Returns the
+        number of bytes uploaded.
+        """
+
+        hashmap = hasher.finalize()
+        ctype = 'application/octet-stream'
+
+        r = self.pithos.object_put(path, format='json', hashmap=True,
+                                   content_type=ctype, json=hashmap,
+                                   success=(201, 409))
+        missing = [] if r.status_code == 201 else r.json
+
+        # The service may report the same block more than once
+        seen = set()
+        missing = [h for h in missing if not (h in seen or seen.add(h))]
+
+        progress = None
+        if upload_cb is not None:
+            progress = upload_cb(len(missing))
+            progress.next()
+
+        # Read the next batch of missing blocks while the workers upload the
+        # previous one.
+        pending = None
+        uploaded = 0
+        for i in xrange(0, len(missing) + self.workers, self.workers):
+            batch = []
+            for blockhash in missing[i:i + self.workers]:
+                offset = hasher.offset(blockhash)
+                file_obj.seek(offset)
+                length = min(hasher.blocksize, hasher.size - offset)
+                batch.append((blockhash, file_obj.read(length)))
+
+            if pending is not None:
+                result, count = pending
+                result.get()
+                if progress is not None:
+                    for _ in xrange(count):
+                        progress.next()
+
+            if not len(batch):
+                break
+
+            pending = (pool.map_async(self._upload_block, batch), len(batch))
+            uploaded += sum(len(b[1]) for b in batch)
+
+        if len(missing):
+            self.pithos.object_put(path, format='json', hashmap=True,
+                                   content_type=ctype, json=hashmap,
+                                   success=201)
+
+        return uploaded
+
     def register(self, name, location, metadata, public=False):
         """Register an image with Cyclades"""
 
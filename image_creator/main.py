@@ -27,7 +27,8 @@ from image_creator.output.cli import SilentOutput, SimpleOutput, \
     OutputWthProgress
 from image_creator.output.composite import CompositeOutput
 from image_creator.output.syslog import SyslogOutput
-from image_creator.kamaki_wrapper import Kamaki, ClientError
+from image_creator.kamaki_wrapper import Kamaki, ClientError, \
+    DEFAULT_UPLOAD_WORKERS
 import sys
 import os
 import optparse
@@ -38,6 +39,7 @@ import textwrap
 import tempfile
 import subprocess
 import time
+import hashlib
 
 PROGNAME = os.path.basename(sys.argv[0])
 
@@ -86,6 +88,12 @@ def parse_options(input_args):
                       action="store_true",
                       help="overwrite output files if they exist")
 
+    parser.add_option("--fast-shrink", dest="fast_shrink", default=False,
+                      help="shrink the last file system to a size estimated "
+                      "from its free blocks instead of its minimum size. "
+                      "This is faster but leaves some free space in the file "
+                      "system", action="store_true")
+
     parser.add_option("--host-run", dest="host_run", default=[],
                       help="mount the medium in the host and run a script "
                       "against the guest medium. This option may be defined "
@@ -136,12 +144,33 @@ def parse_options(input_args):
                       default=False, metavar="IMAGENAME",
                       help="register the image with a cloud as IMAGENAME")
 
+    parser.add_option("--single-pass", dest="single_pass", default=None,
+                      help="read the image only once to compute its md5sum, "
+                      "dump it and calculate the block hashes needed for "
+                      "uploading it. This is the default if both -o and -u "
+                      "are set", action="store_true")
+
+    parser.add_option("--no-single-pass", dest="single_pass",
+                      help="read the image separately for computing its "
+                      "md5sum, dumping it and uploading it",
+                      action="store_false")
+
+    parser.add_option("--sparse", dest="sparse", default=False,
+                      help="skip the unallocated regions of the image when "
+                      "dumping it and computing its md5sum. The holes are "
+                      "not written to the output file", action="store_true")
+
     parser.add_option("-s", "--silent", dest="silent", default=False,
                       help="output only errors", action="store_true")
 
     parser.add_option('--syslog', dest="syslog", default=False,
                       help="log to syslog", action="store_true")
 
+    parser.add_option("--stats-file", dest="stats_file", type="string",
+                      default=None, metavar="FILE", help="write the wall "
+                      "time, bytes processed and throughput of each phase of "
+                      "the image creation to FILE in JSON format")
+
     parser.add_option("--sysprep-param", dest="sysprep_params", default=[],
                       help="add KEY=VALUE system preparation parameter",
                       action="append")
@@ -158,6 +187,12 @@ def parse_options(input_args):
                       default=False, metavar="FILENAME",
                       help="upload the image to the cloud with name FILENAME")
 
+    parser.add_option("--upload-workers", dest="upload_workers", type="int",
+                      default=DEFAULT_UPLOAD_WORKERS, metavar="N",
+                      help="use N threads for computing the block hashes and "
+                      "uploading the missing blocks of the image [default: "
+                      "%default]")
+
     options, args = parser.parse_args(input_args)
 
     if len(args) != 1:
@@ -211,6 +246,14 @@ def parse_options(input_args):
                      "`--print-sysprep-params' or `--print-metadata' must be "
                      "set")
 
+    if options.upload_workers < 1:
+        parser.error("The number of upload workers must be a positive "
+                     "integer")
+
+    if options.single_pass is None:
+        options.single_pass = options.outfile is not None and \
+            bool(options.upload)
+
     if not options.force and options.outfile is not None:
         for extension in ('', '.meta', '.md5sum'):
             filename = "%s%s" % (options.outfile, extension)
@@ -221,11 +264,55 @@ def parse_options(input_args):
     return options
 
 
-def image_creator(options, out):
-    """snf-mkimage main function"""
+def single_pass(image, outfile=None, kamaki=None):
+    """Read the image once to compute the md5sum, dump the image to outfile
+    and compute the block hashes needed for uploading it with kamaki.
 
-    ensure_root(PROGNAME)
+    Returns the md5sum and a BlockHasher instance, if kamaki is defined.
+    """
+
+    md5 = hashlib.md5()
+    consumers = [md5.update]
+
+    hasher = None
+    if kamaki is not None:
+        hasher = kamaki.hasher()
+        consumers.append(hasher.update)
+
+    dst = open(outfile, 'wb') if outfile is not None else None
+
+    def write(data):
+        """Write a block to the output file, leaving a hole for zero blocks in
+        sparse mode
+        """
+        if image.sparse and not data.strip('\x00'):
+            dst.seek(len(data), os.SEEK_CUR)
+        else:
+            dst.write(data)
+
+    try:
+        if dst is not None:
+            consumers.append(write)
+        image.tee(consumers, "Reading image")
+        if dst is not None:
+            # Extend the file if it ends with a hole
+            dst.truncate(image.size)
+    finally:
+        if dst is not None:
+            dst.close()
+
+    checksum = md5.hexdigest()
+    image.out.info("Image md5sum: %s" % checksum)
+    if outfile is not None:
+        image.out.info("Image file %s was successfully created" % outfile)
+
+    return checksum, hasher
 
+
+def get_kamaki(options, out):
+    """Returns a Kamaki instance for the cloud account defined by the
+    command line options, or None if no account is defined.
+    """
     # Check if the authentication info is valid. The earlier the better
     if options.token is not None and options.url is not None:
         try:
@@ -234,7 +321,7 @@ def image_creator(options, out):
                 raise FatalError("The authentication token and/or URL you "
                                  "provided is not valid!")
             else:
-                kamaki = Kamaki(account, out)
+                return Kamaki(account, out, options.upload_workers)
         except ClientError as e:
             raise FatalError("Astakos client: %d %s" % (e.status, e.message))
     elif options.cloud:
@@ -249,10 +336,29 @@ def image_creator(options, out):
                 raise FatalError(
                     "Cloud: `%s' exists but is not valid!" % options.cloud)
             else:
-                kamaki = Kamaki(account, out)
+                return Kamaki(account, out, options.upload_workers)
         except ClientError as e:
             raise FatalError("Astakos client: %d %s" % (e.status, e.message))
 
+    return None
+
+
+def image_creator(options, out, kamaki=None, result=None):
+    """snf-mkimage main function
+
+    If kamaki is None, a Kamaki instance is created out of the authentication
+    options. If result is a dictionary, it is populated with information about
+    the created image.
+    """
+
+    ensure_root(PROGNAME)
+
+    if kamaki is None:
+        kamaki = get_kamaki(options, out)
+
+    if result is None:
+        result = {}
+
     if options.upload and not options.force:
         if kamaki.object_exists(options.upload):
             raise FatalError("Remote storage service object: `%s' exists "
@@ -275,10 +381,16 @@ def image_creator(options, out):
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     try:
-        # There is no need to snapshot the medium if it was created by the Disk
-        # instance as a temporary object.
-        device = disk.file if not options.snapshot else disk.snapshot()
-        image = disk.get_image(device, sysprep_params=options.sysprep_params)
+        # If the medium is only inspected, it is attached read-only and does
+        # not need a snapshot. The same holds for a medium that was created by
+        # the Disk instance as a temporary object.
+        readonly = options.outfile is None and not options.upload
+        device = disk.file if readonly or not options.snapshot else \
+            disk.snapshot(options.sparse)
+        image = disk.get_image(device, sysprep_params=options.sysprep_params,
+                               sparse=options.sparse,
+                               fast_shrink=options.fast_shrink,
+                               readonly=readonly)
 
         if image.is_unsupported() and not options.allow_unsupported:
             raise FatalError(
@@ -334,7 +446,10 @@ def image_creator(options, out):
 
         if options.virtio is not None and \
                 hasattr(image.os, 'install_virtio_drivers'):
-            image.os.install_virtio_drivers()
+            # If the system preparation follows, install the drivers in the
+            # same VM boot. The host scripts expect them to be installed.
+            image.os.install_virtio_drivers(
+                defer=options.sysprep and len(options.host_run) == 0)
 
         if len(options.host_run) != 0:
             out.info("Running scripts on the input medium:")
@@ -365,6 +480,12 @@ def image_creator(options, out):
 
         if options.sysprep:
             image.os.do_sysprep()
+        elif image.ostype == 'windows' and image.ntfs_shrink_support and \
+                not image.is_unsupported():
+            # NTFS file systems are shrunk offline, without booting Windows
+            out.info("Shrinking file system on the last partition ...", False)
+            image.shrink()
+            image.os.shrinked = True
 
         if image.is_unsupported():
             image.meta['EXCLUDE_ALL_TASKS'] = "yes"
@@ -372,14 +493,26 @@ def image_creator(options, out):
         # Add command line metadata to the collected ones...
         image.meta.update(options.metadata)
 
-        checksum = image.md5()
+        result['size'] = image.size
+        result['metadata'] = image.meta
+
+        hasher = None
+        if options.single_pass:
+            checksum, hasher = single_pass(
+                image, options.outfile,
+                kamaki if options.upload else None)
+        else:
+            checksum = image.md5()
+
+        result['md5sum'] = checksum
 
         metastring = unicode(json.dumps(
             {'properties': image.meta,
              'disk-format': 'diskdump'}, ensure_ascii=False))
 
         if options.outfile is not None:
-            image.dump(options.outfile)
+            if not options.single_pass:
+                image.dump(options.outfile)
 
             out.info('Dumping metadata file ...', False)
             with open('%s.%s' % (options.outfile, 'meta'), 'w') as f:
@@ -394,7 +527,26 @@ def image_creator(options, out):
 
         out.info()
         try:
-            if options.upload:
+            if options.upload and hasher is not None:
+                out.info("Uploading image to the storage service:")
+                # The block hashes are already computed. Read the missing
+                # blocks from the dumped image file if present.
+                if options.outfile is not None:
+                    with open(options.outfile, 'rb') as f:
+                        remote = kamaki.upload(
+                            f, image.size, options.upload,
+                            up="(1/2)  Uploading missing blocks",
+                            hasher=hasher)
+                else:
+                    with image.raw_device() as raw:
+                        with open(raw, 'rb') as f:
+                            remote = kamaki.upload(
+                                f, image.size, options.upload,
+                                up="(1/2)  Uploading missing blocks",
+                                hasher=hasher)
+
+                out.info("(2/2)  Uploading md5sum file ...", False)
+            elif options.upload:
                 out.info("Uploading image to the storage service:")
                 with image.raw_device() as raw:
                     with open(raw, 'rb') as f:
@@ -404,6 +556,9 @@ def image_creator(options, out):
                             "(2/3)  Uploading missing blocks")
 
                 out.info("(3/3)  Uploading md5sum file ...", False)
+
+            if options.upload:
+                result['location'] = remote
                 md5sumstr = '%s %s\n' % (checksum,
                                          os.path.basename(options.upload))
                 kamaki.upload(StringIO.StringIO(md5sumstr),
@@ -416,12 +571,12 @@ def image_creator(options, out):
                 img_type = 'public' if options.public else 'private'
                 out.info('Registering %s image with the compute service ...'
                          % img_type, False)
-                result = kamaki.register(options.register, remote,
-                                         image.meta, options.public)
+                registration = kamaki.register(options.register, remote,
+                                               image.meta, options.public)
                 out.success('done')
                 out.info("Uploading metadata file ...", False)
-                metastring = unicode(json.dumps(result, ensure_ascii=False,
-                                                indent=4))
+                metastring = unicode(json.dumps(registration,
+                                                ensure_ascii=False, indent=4))
                 kamaki.upload(StringIO.StringIO(metastring),
                               size=len(metastring),
                               remote_path="%s.%s" % (options.upload, 'meta'))
@@ -433,7 +588,9 @@ def image_creator(options, out):
                     out.info("Sharing metadata file ...", False)
                     kamaki.share("%s.meta" % options.upload)
                     out.success('done')
-                out.result(json.dumps(result, indent=4, ensure_ascii=False))
+                result['registration'] = registration
+                out.result(json.dumps(registration, indent=4,
+                                      ensure_ascii=False))
                 out.info()
         except ClientError as e:
             raise FatalError("Service client: %d %s" % (e.status, e.message))
@@ -469,6 +626,10 @@ def main():
     except FatalError as e:
         out.error(e)
         sys.exit(1)
+    finally:
+        if options.stats_file is not None:
+            with open(options.stats_file, 'w') as f:
+                json.dump(out.stats, f, indent=4)
 
 if __name__ == '__main__':
     main()
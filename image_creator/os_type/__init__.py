@@ -23,9 +23,16 @@ from image_creator.util import FatalError
 
 import textwrap
 import re
+import os
+import stat
+import pipes
+import tempfile
 from collections import namedtuple
 from functools import wraps
 
+import logging
+log = logging.getLogger(__name__)
+
 OSTYPE_ORDER = {
     "windows": 8,
     "linux": 7,
@@ -38,6 +45,34 @@ OSTYPE_ORDER = {
 }
 
 
+# Shell commands that perform guestfs file actions on many files at once
+BULK_COMMANDS = {
+    'rm': 'rm -f -- %s',
+    'rm_rf': 'rm -rf -- %s',
+    'truncate': 'for f in %s; do : > "$f"; done'}
+
+# The guestfs file actions that remove or replace the content of the files
+# they are performed on
+REMOVE_ACTIONS = ('rm', 'rm_rf', 'truncate', 'scrub_file')
+
+# Maximum length of the arguments of a bulk command
+BULK_ARGS_MAX = 65536
+
+# Maximum number of files to stat with one call
+LSTATLIST_MAX = 1000
+
+
+def file_type(mode):
+    """Returns the file type of a stat mode, as returned by guestfs readdir"""
+    for check, ftyp in ((stat.S_ISDIR, 'd'), (stat.S_ISREG, 'r'),
+                        (stat.S_ISLNK, 'l'), (stat.S_ISCHR, 'c'),
+                        (stat.S_ISBLK, 'b'), (stat.S_ISFIFO, 'f'),
+                        (stat.S_ISSOCK, 's')):
+        if check(mode):
+            return ftyp
+    return 'u'
+
+
 def os_cls(distro, osfamily):
     """Given the distro name and the osfamily, return the appropriate OSBase
     derived class
@@ -83,6 +118,8 @@ def sysprep(message, enabled=True, **kwargs):
         method._sysprep = True
         method._sysprep_enabled = enabled
         method._sysprep_nomount = False
+        method._sysprep_offline = False
+        method._sysprep_last = False
 
         for key, val in kwargs.items():
             setattr(method, "_sysprep_%s" % key, val)
@@ -108,6 +145,7 @@ class SysprepParam(object):
         self.default = default
         self.description = description
         self.value = default
+        self.modified = False
         self.error = None
         self.check = kwargs['check'] if 'check' in kwargs else lambda x: x
         self.hidden = kwargs['hidden'] if 'hidden' in kwargs else False
@@ -134,6 +172,7 @@ class SysprepParam(object):
                 return False
 
         self.value = tmp if self.is_list else tmp[0]
+        self.modified = True
 
         return True
 
@@ -268,6 +307,16 @@ class OSBase(object):
         self._mount_warnings = []
         self._mounted = False
 
+        # If set, the file actions of _foreach_file are performed in bulk by
+        # running shell commands of the guest with guestfs sh
+        self._shell_support = False
+
+        # Overlay of guest files that are read or modified by the system
+        # preparation tasks. It maps a path to a [content, dirty] list and it
+        # is emptied whenever the medium gets (un)mounted.
+        self._files = {}
+        self._files_stats = {'accesses': 0, 'calls': 0}
+
         # Many guestfs compilations don't support scrub
         self._scrub_support = True
         try:
@@ -275,6 +324,13 @@ class OSBase(object):
         except RuntimeError:
             self._scrub_support = False
 
+        # The same holds for fstrim
+        self._fstrim_support = True
+        try:
+            self.image.g.available(['fstrim'])
+        except RuntimeError:
+            self._fstrim_support = False
+
         # Create a list of available syspreps
         self._sysprep_tasks = {}
         for name in dir(self):
@@ -322,8 +378,9 @@ class OSBase(object):
 
         self.out.info('Collecting image metadata ...', False)
 
-        with self.mount(readonly=True, silent=True):
-            self._do_collect_metadata()
+        with self.out.phase('collect-metadata'):
+            with self.mount(readonly=True, silent=True):
+                self._do_collect_metadata()
 
         self.out.success('done')
         self.out.info()
@@ -447,6 +504,15 @@ class OSBase(object):
                            else param.value))
             self.out.info()
 
+    def _exec_sysprep(self, cnt, size, task):
+        """Execute a sysprep task and record its duration"""
+        self.out.info(('(%d/%d)' % (cnt, size)).ljust(7), False)
+        # The task may modify the file systems
+        self.image.invalidate_dir_cache()
+        with self.out.phase('sysprep:%s' % self.sysprep_info(task).name):
+            task()
+        del self._sysprep_tasks[task.__name__]
+
     def do_sysprep(self):
         """Prepare system for image creation."""
 
@@ -461,19 +527,19 @@ class OSBase(object):
         size = len(enabled)
         cnt = 0
 
-        def exec_sysprep(cnt, size, task):
-            self.out.info(('(%d/%d)' % (cnt, size)).ljust(7), False)
-            task()
-            del self._sysprep_tasks[task.__name__]
+        # The tasks flagged as last run after the rest of the tasks that need
+        # the medium mounted
+        mounted = [t for t in enabled if t._sysprep_nomount is False]
+        mounted.sort(key=lambda t: t._sysprep_last)
 
         with self.mount():
-            for task in [t for t in enabled if t._sysprep_nomount is False]:
+            for task in mounted:
                 cnt += 1
-                exec_sysprep(cnt, size, task)
+                self._exec_sysprep(cnt, size, task)
 
         for task in [t for t in enabled if t._sysprep_nomount]:
             cnt += 1
-            exec_sysprep(cnt, size, task)
+            self._exec_sysprep(cnt, size, task)
 
         self.out.info()
 
@@ -503,6 +569,8 @@ class OSBase(object):
 
                 parent._mount_error = ""
                 del parent._mount_warnings[:]
+                parent.image.invalidate_dir_cache()
+                parent._forget_files()
 
                 try:
                     parent._mounted = parent._do_mount(readonly)
@@ -526,8 +594,14 @@ class OSBase(object):
 
             def __exit__(self, exc_type, exc_value, traceback):
                 output("Umounting the medium ...", False)
-                parent.image.g.umount_all()
-                parent._mounted = False
+                try:
+                    parent._flush_files()
+                    parent._do_umount()
+                finally:
+                    parent._forget_files()
+                    parent.image.invalidate_dir_cache()
+                    parent.image.g.umount_all()
+                    parent._mounted = False
                 success('done')
 
         return Mount()
@@ -559,6 +633,101 @@ class OSBase(object):
         """List the name of all files recursively under a directory"""
         return self.image.g.find(directory)
 
+    def _clear_free_space(self):
+        """Make the free space of the mounted file systems read as zeros, so
+        that it is stored only once by the storage service and left out of
+        the sparse dumps. The free space is discarded if the discarded blocks
+        of the medium read as zeros. Otherwise it is overwritten with zeros.
+        """
+        MB = 2 ** 20
+
+        # The blocks freed by the pending file writes need clearing too
+        self._flush_files()
+
+        trim = self._fstrim_support and self.image.discard
+        mpoints = dict(self.image.g.mountpoints())
+        for mpoint in sorted(mpoints.values()):
+            stats = self.image.g.statvfs(mpoint)
+            free = stats['bfree'] * stats['frsize']
+            with self.out.phase('zero-free-space:%s' % mpoint, free) as phase:
+                phase['method'] = 'zero'
+                if trim:
+                    try:
+                        self.image.g.fstrim(mpoint)
+                        phase['method'] = 'trim'
+                    except RuntimeError as e:
+                        log.debug("Unable to trim `%s': %s", mpoint, e)
+
+                if phase['method'] == 'zero':
+                    self.image.g.zero_free_space(mpoint)
+
+            self.out.info("\t%s: %s %dMB" %
+                          (mpoint, 'discarded' if phase['method'] == 'trim'
+                           else 'zeroed', free // MB))
+
+    def _read_file(self, path):
+        """Returns the content of a guest file. The file is only read once
+        per mount and any changes made with _write_file() are visible.
+        """
+        self._files_stats['accesses'] += 1
+        if path not in self._files:
+            self._files_stats['calls'] += 1
+            self._files[path] = [self.image.g.cat(path), False]
+        return self._files[path][0]
+
+    def _write_file(self, path, content):
+        """Replace the content of a guest file. The file is written back when
+        the medium gets unmounted or when _flush_files() is called.
+        """
+        self._files_stats['accesses'] += 1
+        self._files[path] = [content, True]
+
+    def _flush_files(self):
+        """Write back all the modified guest files. This needs to be called
+        before accessing those files without using the overlay (e.g. with
+        augeas).
+        """
+        for path in sorted(self._files):
+            entry = self._files[path]
+            if entry[1]:
+                self._files_stats['calls'] += 1
+                self.image.g.write(path, entry[0])
+                entry[1] = False
+
+    def _drop_files(self, paths):
+        """Drop the overlay entries of guest files that are removed, along
+        with the entries of the files under removed directories, so that they
+        are not written back.
+        """
+        if not len(self._files):
+            return
+
+        for path in paths:
+            prefix = path.rstrip('/') + '/'
+            for name in [n for n in self._files
+                         if n == path or n.startswith(prefix)]:
+                del self._files[name]
+
+    def _rm(self, path):
+        """Remove a guest file"""
+        self._drop_files([path])
+        self.image.g.rm(path)
+
+    def _rm_rf(self, path):
+        """Remove a guest file or directory recursively"""
+        self._drop_files([path])
+        self.image.g.rm_rf(path)
+
+    def _forget_files(self):
+        """Empty the guest file overlay, dropping any unsaved changes"""
+        stats = self._files_stats
+        if stats['accesses']:
+            log.debug("File overlay: %d accesses served with %d appliance "
+                      "calls (%d saved)", stats['accesses'], stats['calls'],
+                      stats['accesses'] - stats['calls'])
+        self._files = {}
+        self._files_stats = {'accesses': 0, 'calls': 0}
+
     def _foreach_file(self, directory, action, **kwargs):
         """Perform an action recursively on all files under a directory.
 
@@ -574,41 +743,155 @@ class OSBase(object):
         * exclude: Exclude all files that follow this pattern.
 
         * include: Only include files that follow this pattern.
+
+        The directory tree is listed with a few appliance calls and the rm,
+        rm_rf and truncate guestfs actions are performed in bulk if possible.
+        Returns the number of files the action was performed on.
         """
         if not self.image.g.is_dir(directory):
             self.out.warn("Directory: `%s' does not exist!" % directory)
-            return
+            return 0
 
         maxdepth = None if 'maxdepth' not in kwargs else kwargs['maxdepth']
         if maxdepth == 0:
-            return
+            return 0
 
-        # maxdepth -= 1
-        maxdepth = None if maxdepth is None else maxdepth - 1
-        kwargs['maxdepth'] = maxdepth
+        exclude = None if 'exclude' not in kwargs else \
+            re.compile(kwargs['exclude'])
+        include = None if 'include' not in kwargs else \
+            re.compile(kwargs['include'])
+        ftyp = None if 'ftype' not in kwargs else kwargs['ftype']
 
-        exclude = None if 'exclude' not in kwargs else kwargs['exclude']
-        include = None if 'include' not in kwargs else kwargs['include']
-        ftype = None if 'ftype' not in kwargs else kwargs['ftype']
-        has_ftype = lambda x, y: y is None and True or x['ftyp'] == y
+        tree = self._list_tree(directory, maxdepth)
 
-        for f in self.image.g.readdir(directory):
-            if f['name'] in ('.', '..'):
-                continue
+        # Files are collected in the order the recursive traversal would
+        # perform the action on them: the content of a directory comes before
+        # the directory itself.
+        targets = []
 
-            full_path = "%s/%s" % (directory, f['name'])
+        def walk(dirname, depth):
+            if maxdepth is not None and depth > maxdepth:
+                return
 
-            if exclude and re.match(exclude, full_path):
-                continue
+            for name, f_type in tree.get(dirname, []):
+                full_path = "%s/%s" % (dirname, name)
 
-            if include and not re.match(include, full_path):
-                continue
+                if exclude and exclude.match(full_path):
+                    continue
+
+                if include and not include.match(full_path):
+                    continue
+
+                if f_type == 'd':
+                    walk(full_path, depth + 1)
+
+                if ftyp is None or f_type == ftyp:
+                    targets.append(full_path)
+
+        walk(directory, 1)
+        self._bulk_action(action, targets)
+
+        log.debug("%s: performed %s on %d files", directory,
+                  getattr(action, '__name__', 'action'), len(targets))
+        return len(targets)
+
+    def _list_tree(self, directory, maxdepth=None):
+        """Returns a dictionary that maps each directory under a directory to
+        a list of (name, ftype) tuples for the files it hosts.
+        """
+        g = self.image.g
+
+        # A single readdir is enough
+        if maxdepth == 1:
+            return {directory: [(e['name'], e['ftyp']) for e in
+                                g.readdir(directory)
+                                if e['name'] not in ('.', '..')]}
+
+        fd, tmp = tempfile.mkstemp()
+        try:
+            os.close(fd)
+            g.find0(directory, tmp)
+            with open(tmp) as f:
+                names = [n for n in f.read().split('\0') if len(n)]
+        finally:
+            os.unlink(tmp)
+
+        # The older lstatlist returns the stat structure with the st_ prefix
+        # stripped from the field names
+        if hasattr(g, 'lstatnslist'):
+            lstat, key = g.lstatnslist, 'st_mode'
+        else:
+            lstat, key = g.lstatlist, 'mode'
+
+        modes = []
+        for i in xrange(0, len(names), LSTATLIST_MAX):
+            modes.extend(
+                st[key] for st in lstat(directory, names[i:i + LSTATLIST_MAX]))
+
+        tree = {}
+        for name, mode in zip(names, modes):
+            parent, _, base = name.rpartition('/')
+            dirname = "%s/%s" % (directory, parent) if parent else directory
+            tree.setdefault(dirname, []).append((base, file_type(mode)))
 
-            if has_ftype(f, 'd'):
-                self._foreach_file(full_path, action, **kwargs)
+        return tree
 
-            if has_ftype(f, ftype):
-                action(full_path)
+    def _bulk_action(self, action, paths):
+        """Perform a file action on a list of paths. The guestfs rm, rm_rf and
+        truncate actions are performed with as few shell commands as possible
+        if the shell and the rm command of the guest can run in the helper VM.
+        """
+        # The guestfs methods are bound to the handle wrapped by image.g
+        handle = getattr(self.image.g, 'handle', self.image.g)
+        guestfs_action = getattr(action, '__self__', None) is handle
+
+        # Pending writes must not bring back the removed files
+        if guestfs_action and action.__name__ in REMOVE_ACTIONS:
+            self._drop_files(paths)
+
+        command = None
+        if self._shell_support and guestfs_action:
+            command = BULK_COMMANDS.get(action.__name__)
+
+        if command is None:
+            for path in paths:
+                action(path)
+            return
+
+        def run(batch):
+            try:
+                self.image.g.sh(
+                    command % " ".join(pipes.quote(p) for p in batch))
+            except RuntimeError as e:
+                # Fall back to performing the action file by file
+                log.debug("Bulk %s failed: %s", action.__name__, e)
+                for path in batch:
+                    action(path)
+
+        batch = []
+        length = 0
+        for path in paths:
+            size = len(pipes.quote(path)) + 1
+            if len(batch) and length + size > BULK_ARGS_MAX:
+                run(batch)
+                batch = []
+                length = 0
+            batch.append(path)
+            length += size
+
+        if len(batch):
+            run(batch)
+
+    def _native_guest(self):
+        """Check if the guest has the architecture of the host. The helper VM
+        has the architecture of the host, so only the binaries of such a guest
+        can run in it.
+        """
+        host = os.uname()[4]
+        if re.match('i[3-6]86', host):
+            host = 'i386'
+
+        return self.image.g.inspect_get_arch(self.root) == host
 
     def _do_inspect(self):
         """helper method for inspect"""
@@ -636,6 +919,12 @@ class OSBase(object):
         except KeyError:
             self.meta['SORTORDER'] = 0
 
+    def _do_umount(self):
+        """helper method for umount. It is called before the file systems
+        are unmounted.
+        """
+        pass
+
     def _do_mount(self, readonly):
         """helper method for mount"""
         try:
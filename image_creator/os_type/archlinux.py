@@ -31,7 +31,7 @@ class Archlinux(Linux):
 
         local_be = '/var/lib/pacman/local'
 
-        if not self.image.g.is_dir(local_be):
+        if not self.image.is_dir(local_be):
             self.out.warn("Directory: `%s' does not exist!" % local_be)
             return
 
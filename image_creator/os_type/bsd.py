@@ -53,7 +53,7 @@ class Bsd(Unix):
             '/etc/master.passwd', "\n".join(master_passwd) + '\n')
 
         # Make sure no one can login on the system
-        self.image.g.rm_rf('/etc/spwd.db')
+        self._rm_rf('/etc/spwd.db')
 
     def _check_enabled_sshd(self):
         """Check if the ssh daemon is enabled at boot"""
@@ -19,10 +19,8 @@
 
 from image_creator.os_type.unix import Unix, sysprep, add_sysprep_param
 
-import os
 import re
 import pkg_resources
-import tempfile
 
 X2GO_DESKTOPSESSIONS = {
     'CINNAMON': 'cinnamon',
@@ -67,6 +65,9 @@ class Linux(Unix):
         "The action that should be executed if the power button is pressed")
     def __init__(self, image, **kwargs):
         super(Linux, self).__init__(image, **kwargs)
+        # The shell of a Linux guest can run in the libguestfs appliance, as
+        # long as the guest binaries are native to the host
+        self._shell_support = self._native_guest()
         self._uuid = dict()
         self._persistent = re.compile('/dev/[hsv]d[a-z][1-9]*')
 
@@ -80,7 +81,7 @@ class Linux(Unix):
         if self.image.g.is_file('/etc/passwd'):
             passwd = []
             metadata_users = self.meta['USERS'].split()
-            for line in self.image.g.cat('/etc/passwd').splitlines():
+            for line in self._read_file('/etc/passwd').splitlines():
                 fields = line.split(':')
                 if int(fields[2]) > 1000:
                     removed_users[fields[0]] = fields
@@ -96,7 +97,7 @@ class Linux(Unix):
             if not len(self.meta['USERS']):
                 del self.meta['USERS']
 
-            self.image.g.write('/etc/passwd', '\n'.join(passwd) + '\n')
+            self._write_file('/etc/passwd', '\n'.join(passwd) + '\n')
         else:
             self.out.warn("File: `/etc/passwd' is missing. "
                           "No users were deleted")
@@ -105,28 +106,28 @@ class Linux(Unix):
         if self.image.g.is_file('/etc/shadow'):
             # Remove the corresponding /etc/shadow entries
             shadow = []
-            for line in self.image.g.cat('/etc/shadow').splitlines():
+            for line in self._read_file('/etc/shadow').splitlines():
                 fields = line.split(':')
                 if fields[0] not in removed_users:
                     shadow.append(':'.join(fields))
-            self.image.g.write('/etc/shadow', "\n".join(shadow) + '\n')
+            self._write_file('/etc/shadow', "\n".join(shadow) + '\n')
         else:
             self.out.warn("File: `/etc/shadow' is missing.")
 
         if self.image.g.is_file('/etc/group'):
             # Remove the corresponding /etc/group entries
             group = []
-            for line in self.image.g.cat('/etc/group').splitlines():
+            for line in self._read_file('/etc/group').splitlines():
                 fields = line.split(':')
                 # Remove groups tha have the same name as the removed users
                 if fields[0] not in removed_users:
                     group.append(':'.join(fields))
-            self.image.g.write('/etc/group', '\n'.join(group) + '\n')
+            self._write_file('/etc/group', '\n'.join(group) + '\n')
 
         # Remove home directories
         for home in [field[5] for field in removed_users.values()]:
             if self.image.g.is_dir(home) and home.startswith('/home/'):
-                self.image.g.rm_rf(home)
+                self._rm_rf(home)
 
     @sysprep('Cleaning up password & locking all user accounts')
     def _cleanup_passwords(self):
@@ -134,17 +135,17 @@ class Linux(Unix):
 
         shadow = []
 
-        for line in self.image.g.cat('/etc/shadow').splitlines():
+        for line in self._read_file('/etc/shadow').splitlines():
             fields = line.split(':')
             if fields[1] not in ('*', '!'):
                 fields[1] = '!'
 
             shadow.append(":".join(fields))
 
-        self.image.g.write('/etc/shadow', "\n".join(shadow) + '\n')
+        self._write_file('/etc/shadow', "\n".join(shadow) + '\n')
 
         # Remove backup file for /etc/shadow
-        self.image.g.rm_rf('/etc/shadow-')
+        self._rm_rf('/etc/shadow-')
 
     @sysprep('Fixing acpid powerdown action')
     def _fix_acpid(self):
@@ -168,7 +169,7 @@ class Linux(Unix):
             event = -1
             action = -1
             fullpath = "%s/%s" % (events_dir, events_file['name'])
-            content = self.image.g.cat(fullpath).splitlines()
+            content = self._read_file(fullpath).splitlines()
             for i in xrange(len(content)):
                 if event_exp.match(content[i]):
                     event = i
@@ -185,7 +186,7 @@ class Linux(Unix):
             entry = content[event].split('=')[1].strip()
             if entry in ("button[ /]power", "button/power.*"):
                     content[action] = "action=%s" % powerbtn_action
-                    self.image.g.write(
+                    self._write_file(
                         fullpath, "\n".join(content) +
                         '\n\n### Edited by snf-image-creator ###\n')
                     return
@@ -208,7 +209,7 @@ class Linux(Unix):
 
         rule_file = '/etc/udev/rules.d/70-persistent-net.rules'
         if self.image.g.is_file(rule_file):
-            self.image.g.rm(rule_file)
+            self._rm(rule_file)
 
     @sysprep('Removing swap entry from fstab')
     def _remove_swap_entry(self):
@@ -223,7 +224,7 @@ class Linux(Unix):
             return
 
         new_fstab = ""
-        fstab = self.image.g.cat('/etc/fstab')
+        fstab = self._read_file('/etc/fstab')
         for line in fstab.splitlines():
 
             entry = line.split('#')[0].strip().split()
@@ -232,7 +233,7 @@ class Linux(Unix):
 
             new_fstab += "%s\n" % line
 
-        self.image.g.write('/etc/fstab', new_fstab)
+        self._write_file('/etc/fstab', new_fstab)
 
     @sysprep('Change boot menu timeout to %(bootmenu_timeout)s seconds')
     def _change_bootmenu_timeout(self):
@@ -253,19 +254,12 @@ class Linux(Unix):
 
         def replace_timeout(remote, regexp, timeout):
             """Replace the timeout value from a config file"""
-            tmpfd, tmp = tempfile.mkstemp()
-            try:
-                for line in self.image.g.cat(remote).splitlines():
-                    if regexp.match(line):
-                        line = re.sub('\d+', str(timeout), line)
-                    os.write(tmpfd, line + '\n')
-                os.close(tmpfd)
-                tmpfd = None
-                self.image.g.upload(tmp, remote)
-            finally:
-                if tmpfd is not None:
-                    os.close(tmpfd)
-                os.unlink(tmp)
+            content = ""
+            for line in self._read_file(remote).splitlines():
+                if regexp.match(line):
+                    line = re.sub('\d+', str(timeout), line)
+                content += line + '\n'
+            self._write_file(remote, content)
 
         grub1_config = '/boot/grub/menu.lst'
         grub2_config = '/boot/grub/grub.cfg'
@@ -341,6 +335,10 @@ class Linux(Unix):
         else:
             return
 
+        # Augeas will edit the file behind the back of the file overlay
+        self._flush_files()
+        self._files.pop(grub1, None)
+
         self.image.g.aug_init('/', 0)
         try:
             roots = self.image.g.aug_match(
@@ -369,20 +367,13 @@ class Linux(Unix):
             return
 
         # There is no augeas lense for syslinux :-(
-        tmpfd, tmp = tempfile.mkstemp()
-        try:
-            for line in self.image.g.cat(config).splitlines():
-                if append_regexp.match(line):
-                    line = re.sub(r'\broot=/dev/[hsv]d[a-z][1-9]*\b',
-                                  'root=%s' % new_root, line)
-                os.write(tmpfd, line + '\n')
-            os.close(tmpfd)
-            tmpfd = None
-            self.image.g.upload(tmp, config)
-        finally:
-            if tmpfd is not None:
-                os.close(tmpfd)
-            os.unlink(tmp)
+        content = ""
+        for line in self._read_file(config).splitlines():
+            if append_regexp.match(line):
+                line = re.sub(r'\broot=/dev/[hsv]d[a-z][1-9]*\b',
+                              'root=%s' % new_root, line)
+            content += line + '\n'
+        self._write_file(config, content)
 
     def _persistent_fstab(self):
         """Replaces non-persistent device name occurrences in /etc/fstab with
@@ -396,7 +387,7 @@ class Linux(Unix):
 
         root_dev = None
         new_fstab = ""
-        fstab = self.image.g.cat('/etc/fstab')
+        fstab = self._read_file('/etc/fstab')
         for line in fstab.splitlines():
 
             line, dev, mpoint = self._convert_fstab_line(line, device_dict)
@@ -405,7 +396,7 @@ class Linux(Unix):
             if mpoint == '/':
                 root_dev = dev
 
-        self.image.g.write('/etc/fstab', new_fstab)
+        self._write_file('/etc/fstab', new_fstab)
         if root_dev is None:
             pass  # TODO: error handling
 
@@ -506,10 +497,10 @@ class Linux(Unix):
             x2go_installed = False
             desktops = set()
             for path in ('/bin', '/usr/bin', '/usr/local/bin'):
-                if self.image.g.is_file("%s/%s" % (path, X2GO_EXECUTABLE)):
+                if self.image.is_file("%s/%s" % (path, X2GO_EXECUTABLE)):
                     x2go_installed = True
                 for name, exe in X2GO_DESKTOPSESSIONS.items():
-                    if self.image.g.is_file("%s/%s" % (path, exe)):
+                    if self.image.is_file("%s/%s" % (path, exe)):
                         desktops.add(name)
 
             if x2go_installed:
@@ -527,7 +518,7 @@ class Linux(Unix):
 
         systemd_services = '/etc/systemd/system/multi-user.target.wants'
         exec_start = re.compile(r'^\s*ExecStart=.+bin/%s\s?' % service)
-        if self.image.g.is_dir(systemd_services):
+        if self.image.is_dir(systemd_services):
             for entry in self.image.g.readdir(systemd_services):
                 if entry['ftyp'] not in ('l', 'f'):
                     continue
@@ -550,7 +541,7 @@ class Linux(Unix):
 
         # Check upstart config files under /etc/init
         # Only examine *.conf files
-        if self.image.g.is_dir('/etc/init'):
+        if self.image.is_dir('/etc/init'):
             self._foreach_file('/etc/init', check_file, maxdepth=1,
                                include=r'.+\.conf$')
             if len(found):
@@ -584,7 +575,7 @@ class Linux(Unix):
         users = []
         regexp = re.compile(r'(\S+):((?:!\S+)|(?:[^!*]\S+)|):(?:\S*:){6}')
 
-        for line in self.image.g.cat('/etc/shadow').splitlines():
+        for line in self._read_file('/etc/shadow').splitlines():
             match = regexp.match(line)
             if not match:
                 continue
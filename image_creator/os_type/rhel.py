@@ -29,7 +29,7 @@ class Rhel(Linux):
 
         # Check if the image is Oracle Linux
         oracle = '/etc/oracle-release'
-        if self.image.g.is_file(oracle):
+        if self.image.is_file(oracle):
             self.meta['OS'] = 'oraclelinux'
             self.meta['DESCRIPTION'] = self.image.g.head_n(1, oracle)[0]
 
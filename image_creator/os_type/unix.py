@@ -155,7 +155,7 @@ class Unix(OSBase):
 
         paths = ['%s/bin/%s' % (p, X11_EXECUTABLE) for p in bin_prefixes]
         for path in paths:
-            if self.image.g.is_file(path):
+            if self.image.is_file(path):
                 gui = True
                 break
 
@@ -168,7 +168,7 @@ class Unix(OSBase):
         for exe, session in DESKTOPSESSIONS.items():
             paths = ["%s/bin/%s" % (p, e) for p in bin_prefixes for e in exe]
             for path in paths:
-                if self.image.g.is_file(path):
+                if self.image.is_file(path):
                     desktop.append(session)
                     break
         if gui and len(desktop) != 0:
@@ -251,8 +251,19 @@ class Unix(OSBase):
             for data in sensitive_userdata:
                 fname = "%s/%s" % (homedir, data)
                 if self.image.g.is_file(fname):
+                    self._drop_files([fname])
                     action(fname)
                 elif self.image.g.is_dir(fname):
                     self._foreach_file(fname, action, ftype='r')
 
+    @sysprep('Zeroing the free space of the file systems (may take a while)',
+             enabled=False, last=True)
+    def _zero_free_space(self):
+        """Discard the free space of the file systems or fill it with zeros.
+        Blocks full of zeros are stored only once by the storage service and
+        are not written to sparse dumps. This runs after the rest of the
+        system preparation tasks that modify the file systems.
+        """
+        self._clear_free_space()
+
 # vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -19,19 +19,25 @@
 Windows OSes."""
 
 from image_creator.os_type import OSBase, sysprep, add_sysprep_param
-from image_creator.util import FatalError
-from image_creator.os_type.windows.vm import VM, RANDOM_TOKEN as TOKEN
+from image_creator.util import FatalError, get_cache_dir
+from image_creator.os_type.windows.vm import VM, RANDOM_TOKEN as TOKEN, \
+    vm_profile_check
 from image_creator.os_type.windows.registry import Registry
 from image_creator.os_type.windows.winexe import WinEXE
 from image_creator.os_type.windows import powershell
 
 import tempfile
+import tarfile
 import re
 import os
 import uuid
 import time
+import json
 from collections import namedtuple
 
+import logging
+log = logging.getLogger(__name__)
+
 # For more info see: http://technet.microsoft.com/en-us/library/jj612867.aspx
 KMS_CLIENT_SETUP_KEYS = {
     "Windows 8.1 Professional": "GCRJD-8NW9H-F2CDX-CCM8D-9D6T9",
@@ -199,19 +205,100 @@ def virtio_dir_check(dirname):
     if not dirname:
         return ""  # value not set
 
-    # Check files in a case insensitive manner
-    files = set(os.listdir(dirname))
-
-    for inf in [f for f in files if f.lower().endswith('.inf')]:
-        with open(os.path.join(dirname, inf)) as content:
-            driver, _, _ = parse_inf(content)
-            if driver:
-                return dirname
+    for driver, _, _ in InfIndex().scan(dirname).values():
+        if driver:
+            return dirname
 
     raise ValueError("Could not find any VirtIO driver in this directory. "
                      "Please select another one.")
 
 
+class InfIndex(object):
+    """A persistent index of the parsed INF files of local directories.
+
+    The entries are keyed by the path of the INF files and are only valid as
+    long as the size and the modification time of the files do not change.
+    """
+
+    FILENAME = 'inf-index.json'
+
+    def __init__(self, path=None):
+        self.path = os.path.join(get_cache_dir(), self.FILENAME) \
+            if path is None else path
+        self._dirty = False
+
+        try:
+            with open(self.path) as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError):
+            self._entries = {}
+
+    def _lookup(self, path):
+        """Returns the parsed content of an INF file. The file is only parsed
+        if the index has no valid entry for it.
+        """
+        st = os.stat(path)
+        entry = self._entries.get(path)
+        if entry is not None and entry['size'] == st.st_size and \
+                entry['mtime'] == st.st_mtime:
+            return entry['driver'], set(entry['target']), \
+                dict(entry['version'])
+
+        with open(path) as content:
+            driver, target, version = parse_inf(content)
+
+        self._entries[path] = {'size': st.st_size, 'mtime': st.st_mtime,
+                               'driver': driver, 'target': sorted(target),
+                               'version': version}
+        self._dirty = True
+        return driver, target, dict(version)
+
+    def scan(self, directory):
+        """Returns a dictionary with the parsed content of all the INF files
+        found in a directory. The index entries of the files that are no
+        longer present in the directory are removed.
+        """
+        directory = os.path.abspath(directory)
+        inf = re.compile(r'^.+\.inf', flags=re.IGNORECASE)
+
+        found = {}
+        for name in os.listdir(directory):
+            fullpath = os.path.join(directory, name)
+            if inf.match(name) and os.path.isfile(fullpath):
+                found[name] = self._lookup(fullpath)
+
+        for path in self._entries.keys():
+            if os.path.dirname(path) == directory and \
+                    os.path.basename(path) not in found:
+                del self._entries[path]
+                self._dirty = True
+
+        self.save()
+        return found
+
+    def save(self):
+        """Write the index back to the disk if it has been modified"""
+        if not self._dirty:
+            return
+
+        # Write to a temporary file and rename it, so that concurrent image
+        # creations never read a partially written index.
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        except OSError as e:
+            log.debug("Unable to save the INF index `%s': %s", self.path, e)
+            return
+
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._entries, f)
+            os.rename(tmp, self.path)
+            self._dirty = False
+        except (IOError, OSError, ValueError) as e:
+            os.unlink(tmp)
+            log.debug("Unable to save the INF index `%s': %s", self.path, e)
+
+
 DESCR = {
     "boot_timeout":
     "Time in seconds to wait for the Windows customization VM to boot.",
@@ -220,12 +307,24 @@ DESCR = {
     "after the initial command is given.",
     "connection_retries":
     "Number of times to try to connect to the Windows customization VM after "
-    "it has booted, before giving up.",
+    "its SMB service answers, before giving up. Set it to 0 to skip the "
+    "connectivity check altogether, including connection_timeout.",
+    "connection_timeout":
+    "Time in seconds to wait for the SMB service of the Windows customization "
+    "VM to answer after it has booted. This time covers all the connection "
+    "attempts. The check fails as soon as either this time passes or "
+    "connection_retries attempts fail.",
     "smp": "Number of CPUs to use for the Windows customization VM.",
     "mem": "Virtual RAM size in MiB for the Windows customization VM.",
     "virtio": "Directory hosting the Windows virtio drivers.",
     "virtio_timeout":
-    "Time in seconds to wait for the installation of the VirtIO drivers."}
+    "Time in seconds to wait for the installation of the VirtIO drivers.",
+    "vm_profile":
+    "Performance profile of the Windows customization VM. The `compatible' "
+    "profile uses emulated devices. The `performance' profile uses a VirtIO "
+    "network card if the driver is installed, the host CPU model and I/O "
+    "threads, and sizes the CPUs and the memory of the VM from the host "
+    "resources, unless the smp and mem parameters are set."}
 
 
 class Windows(OSBase):
@@ -234,6 +333,8 @@ class Windows(OSBase):
     @add_sysprep_param('smp', "posint", 1, DESCR['smp'])
     @add_sysprep_param(
         'connection_retries', "posint", 5, DESCR['connection_retries'])
+    @add_sysprep_param(
+        'connection_timeout', "posint", 300, DESCR['connection_timeout'])
     @add_sysprep_param(
         'shutdown_timeout', "posint", 300, DESCR['shutdown_timeout'])
     @add_sysprep_param('boot_timeout', "posint", 600, DESCR['boot_timeout'])
@@ -241,6 +342,8 @@ class Windows(OSBase):
                        check=virtio_dir_check, hidden=True)
     @add_sysprep_param(
         'virtio_timeout', 'posint', 900, DESCR['virtio_timeout'])
+    @add_sysprep_param('vm_profile', 'string', 'compatible',
+                       DESCR['vm_profile'], check=vm_profile_check)
     def __init__(self, image, **kwargs):
         super(Windows, self).__init__(image, **kwargs)
 
@@ -264,6 +367,12 @@ class Windows(OSBase):
 
         self.last_part_num = self.image.g.part_list(device)[-1]['part_num']
 
+        # If set, the last file system is shrunk after the VM shuts down
+        self._offline_shrink = False
+
+        # VirtIO drivers to install during the sysprep boot
+        self._virtio_pending = None
+
         self.product_name = self.image.g.inspect_get_product_name(self.root)
         self.systemroot = self.image.g.inspect_get_windows_systemroot(
             self.root)
@@ -339,13 +448,11 @@ class Windows(OSBase):
 
         self.vm.rexec('netsh firewall set icmpsetting 8')
 
-    @sysprep('Setting the system clock to UTC', display="UTC")
+    @sysprep('Setting the system clock to UTC', display="UTC", offline=True)
     def _utc(self):
         """Set the hardware clock to UTC"""
 
-        path = r'HKLM\SYSTEM\CurrentControlSet\Control\TimeZoneInformation'
-        self.vm.rexec(
-            r'REG ADD %s /v RealTimeIsUniversal /t REG_DWORD /d 1 /f' % path)
+        self.registry.update_realtime_is_universal(1)
 
     @sysprep('Clearing the event logs')
     def _clear_logs(self):
@@ -389,10 +496,16 @@ class Windows(OSBase):
 
     @sysprep('Shrinking file system on the last partition')
     def _shrink(self):
-        """Shrink the last file system. Please make sure the file system is
-        defragged.
+        """Shrink the last file system. If the installed libguestfs can
+        shrink NTFS file systems, this is done offline after Windows shuts
+        down. Otherwise, please make sure the file system is defragged.
         """
 
+        if self.image.ntfs_shrink_support:
+            self.out.info("\tDeferred until the VM shuts down")
+            self._offline_shrink = True
+            return
+
         # Query for the maximum number of reclaimable bytes
         cmd = (
             r'cmd /Q /V:ON /C "SET SCRIPT=%TEMP%\QUERYMAX_%RANDOM%.TXT & ' +
@@ -477,98 +590,278 @@ class Windows(OSBase):
 
         self.shrinked = True
 
+    @sysprep('Removing the paging, swap & hibernation files', last=True)
+    def _remove_page_files(self):
+        """Remove the paging file, the swap file and the hibernation file
+        after the Windows VM shuts down. Windows creates the former two again
+        when it boots. Hibernation gets disabled.
+        """
+
+        MB = 2 ** 20
+
+        self.registry.update_hibernate_enabled(0)
+
+        reclaimed = 0
+        for entry in self.image.g.readdir('/'):
+            if entry['ftyp'] != 'r' or entry['name'].lower() not in \
+                    ('pagefile.sys', 'swapfile.sys', 'hiberfil.sys'):
+                continue
+            path = '/' + entry['name']
+            size = self.image.g.filesize(path)
+            self.image.g.rm(path)
+            self.out.info("\tRemoved %s (%dMB)" % (entry['name'], size // MB))
+            reclaimed += size
+
+        self.out.info("\tReclaimed %dMB" % (reclaimed // MB))
+
+    @sysprep('Zeroing the free space of the file system (may take a while)',
+             enabled=False, last=True)
+    def _zero_free_space(self):
+        """Discard the free space of the NTFS file system or fill it with
+        zeros, after the Windows VM shuts down. Blocks full of zeros are
+        stored only once by the storage service and are not written to sparse
+        dumps.
+        """
+        self._clear_free_space()
+
+    def _do_umount(self):
+        """Upload the modified registry hives before unmounting"""
+        self.registry.flush()
+
+    def _forget_files(self):
+        """Empty the guest file overlay and the registry hive cache, dropping
+        any unsaved changes
+        """
+        super(Windows, self)._forget_files()
+        self.registry.forget()
+
+    def _vm_needed(self, tasks):
+        """Check if any of the tasks needs the Windows VM to be booted"""
+
+        for task in tasks:
+            if task._sysprep_offline:
+                continue
+            if self.sysprep_info(task).name == 'shrink' and \
+                    self.image.ntfs_shrink_support:
+                continue
+            return True
+
+        return False
+
     def do_sysprep(self):
         """Prepare system for image creation."""
 
         self.out.info('Preparing system for image creation:')
 
+        if self.sysprepped:
+            raise FatalError(
+                "Microsoft's System Preparation Tool has ran on the medium. "
+                "Further image customization is not possible.")
+
+        enabled = [t for t in self.list_syspreps() if self.sysprep_enabled(t)]
+        size = len(enabled)
+
+        # The tasks flagged as last run offline when everything else is done.
+        # Make sure the free space gets zeroed after the files get removed.
+        last = [t for t in enabled if t._sysprep_last]
+        last.sort(key=lambda t: self.sysprep_info(t).name == 'zero-free-space')
+        enabled = [t for t in enabled if not t._sysprep_last]
+        offline = [t for t in enabled if t._sysprep_offline]
+        online = [t for t in enabled if not t._sysprep_offline]
+
+        boot = self._vm_needed(online)
+
+        virtio = self._virtio_pending
+        self._virtio_pending = None
+        if virtio is not None and not boot:
+            # No sysprep boot to merge the driver installation with
+            self._install_virtio(virtio)
+            virtio = None
+
+        if boot:
+            self._check_vm_support(virtio['types'] if virtio else ())
+
+        # On older Windows the drivers get installed and the sysprep tasks get
+        # executed in the same VM run. On newer ones the safe mode boot needed
+        # after installing the drivers reboots in normal mode for the sysprep.
+        old_windows = self.check_version(6, 1) <= 0
+        boots = self.vm.boots
+        try:
+            if virtio is not None:
+                self.out.info("Installing VirtIO drivers ...")
+                self._update_driver_database('virtio', merge=True, **virtio)
+                if not old_windows:
+                    self._boot_virtio_vm(safeboot=False)
+
+            cnt = 0
+            v_val = None
+            if len(offline) or boot:
+                with self.mount(readonly=False, silent=True):
+                    # The offline tasks only edit the medium. Run them before
+                    # the medium gets prepared for boot.
+                    for task in offline:
+                        cnt += 1
+                        self._exec_sysprep(cnt, size, task)
+
+                    if boot:
+                        self.out.info("Preparing medium for boot ...", False)
+                        v_val = self._prepare_boot(
+                            runonce=virtio is None or not old_windows)
+                        self.out.success('done')
+
+            if boot:
+                self._sysprep_vm(online, cnt, size, v_val, virtio is not None)
+                cnt += len(online)
+        finally:
+            if virtio is not None:
+                self._revert_virtio()
+
+        if virtio is not None:
+            # Installing the drivers separately would take one VM boot on
+            # older Windows and two on newer ones, plus the sysprep boot.
+            boots = self.vm.boots - boots
+            separate = 2 if old_windows else 3
+            self.out.success(
+                "VirtIO drivers installed and system prepared with %d VM "
+                "boot(s). Saved %d VM boot(s)" % (boots, separate - boots))
+
+        if not boot:
+            for task in online:
+                cnt += 1
+                self._exec_sysprep(cnt, size, task)
+
+        if len(last):
+            with self.mount(readonly=False, silent=True):
+                for task in last:
+                    cnt += 1
+                    self._exec_sysprep(cnt, size, task)
+
+        if self._offline_shrink:
+            self.out.info("Shrinking file system on the last partition ...",
+                          False)
+            self.image.shrink()
+            self.shrinked = True
+        else:
+            self.image.shrink(silent=True, resize=False)
+
+    def _check_vm_support(self, staged=()):
+        """Check if the Windows VM can be booted and accessed. The staged list
+        hosts the types of the VirtIO drivers that will be installed before
+        the sysprep tasks run.
+        """
+
         # Check if winexe is installed
         if not WinEXE.is_installed():
             raise FatalError(
                 "Winexe not found! In order to be able to customize a Windows "
                 "image you need to have Winexe installed.")
 
-        if self.sysprepped:
-            raise FatalError(
-                "Microsoft's System Preparation Tool has ran on the medium. "
-                "Further image customization is not possible.")
-
-        if len(self.virtio_state['viostor']) == 0:
+        if len(self.virtio_state['viostor']) == 0 and 'viostor' not in staged:
             raise FatalError(
                 "The medium has no VirtIO SCSI controller driver installed. "
                 "Further image customization is not possible.")
 
-        if len(self.virtio_state['netkvm']) == 0:
+        if len(self.virtio_state['netkvm']) == 0 and 'netkvm' not in staged:
             raise FatalError(
                 "The medium has no VirtIO Ethernet Adapter driver installed. "
                 "Further image customization is not possible.")
 
-        timeout = self.sysprep_params['boot_timeout'].value
-        shutdown_timeout = self.sysprep_params['shutdown_timeout'].value
-
-        self.out.info("Preparing medium for boot ...", False)
-
-        with self.mount(readonly=False, silent=True):
+    def _prepare_boot(self, runonce=True):
+        """Prepare the mounted medium for booting the Windows VM. Returns the
+        old V field of the admin user.
+        """
 
-            if not self.registry.reset_account(self.vm.admin.rid):
-                self._add_cleanup('sysprep', self.registry.reset_account,
-                                  self.vm.admin.rid, False)
+        if not self.registry.reset_account(self.vm.admin.rid):
+            self._add_cleanup('sysprep', self.registry.reset_account,
+                              self.vm.admin.rid, False)
 
-            old = self.registry.update_uac(0)
-            if old != 0:
-                self._add_cleanup('sysprep', self.registry.update_uac, old)
+        old = self.registry.update_uac(0)
+        if old != 0:
+            self._add_cleanup('sysprep', self.registry.update_uac, old)
 
-            old = self.registry.update_uac_remote_setting(1)
-            if old != 1:
-                self._add_cleanup('sysprep',
-                                  self.registry.update_uac_remote_setting, old)
+        old = self.registry.update_uac_remote_setting(1)
+        if old != 1:
+            self._add_cleanup('sysprep',
+                              self.registry.update_uac_remote_setting, old)
 
-            def if_not_sysprepped(task, *args):
-                """Only perform this if the image is not sysprepped"""
-                if not self.sysprepped:
-                    task(*args)
+        def if_not_sysprepped(task, *args):
+            """Only perform this if the image is not sysprepped"""
+            if not self.sysprepped:
+                task(*args)
 
-            # The next 2 registry values get completely removed by Microsoft
-            # Sysprep. They should not be reverted if Sysprep gets executed.
-            old = self.registry.update_noautoupdate(1)
-            if old != 1:
-                self._add_cleanup('sysprep', if_not_sysprepped,
-                                  self.registry.update_noautoupdate, old)
+        # The next 2 registry values get completely removed by Microsoft
+        # Sysprep. They should not be reverted if Sysprep gets executed.
+        old = self.registry.update_noautoupdate(1)
+        if old != 1:
+            self._add_cleanup('sysprep', if_not_sysprepped,
+                              self.registry.update_noautoupdate, old)
 
-            old = self.registry.update_auoptions(1)
-            if old != 1:
-                self._add_cleanup('sysprep', if_not_sysprepped,
-                                  self.registry.update_auoptions, old)
+        old = self.registry.update_auoptions(1)
+        if old != 1:
+            self._add_cleanup('sysprep', if_not_sysprepped,
+                              self.registry.update_auoptions, old)
 
-            # disable the firewalls
-            self._add_cleanup('sysprep', self.registry.update_firewalls,
-                              *self.registry.update_firewalls(0, 0, 0))
+        # disable the firewalls
+        self._add_cleanup('sysprep', self.registry.update_firewalls,
+                          *self.registry.update_firewalls(0, 0, 0))
 
-            v_val = self.registry.reset_passwd(self.vm.admin.rid)
+        v_val = self.registry.reset_passwd(self.vm.admin.rid)
 
-            self._add_boot_scripts()
+        self._add_boot_scripts(runonce)
 
-            # Delete the pagefile. It will be recreated when the system boots
-            try:
-                pagefile = "%s/pagefile.sys" % self.systemroot
-                self.image.g.rm_rf(self.image.g.case_sensitive_path(pagefile))
-            except RuntimeError:
-                pass
+        # Delete the pagefile. It will be recreated when the system boots
+        try:
+            pagefile = "%s/pagefile.sys" % self.systemroot
+            self.image.g.rm_rf(self.image.g.case_sensitive_path(pagefile))
+        except RuntimeError:
+            pass
+
+        return v_val
+
+    def _sysprep_vm(self, tasks, cnt, size, v_val, virtio=False):
+        """Boot the Windows VM, execute the sysprep tasks that need it and
+        revert the boot preparations after the VM shuts down. If virtio is
+        True, the VM will install the staged VirtIO drivers (older Windows) or
+        boot in safe mode (newer Windows) before rebooting for the sysprep.
+        """
 
-        self.out.success('done')
+        timeout = self.sysprep_params['boot_timeout'].value
+        shutdown_timeout = self.sysprep_params['shutdown_timeout'].value
+        virtio_timeout = self.sysprep_params['virtio_timeout'].value
+        old_windows = self.check_version(6, 1) <= 0
 
         self.image.disable_guestfs()
         booted = False
         try:
             self.out.info("Starting windows VM ...", False)
-            self.vm.start()
+            self._start_vm()
             try:
                 self.out.success("started (console on VNC display: %d)" %
                                  self.vm.display)
 
+                if virtio and old_windows:
+                    self.out.info("Waiting for Windows to boot ...", False)
+                    with self._vm_phase('vm-boot'):
+                        if not self.vm.wait_on_serial(timeout):
+                            raise FatalError("Windows VM booting timed out!")
+                    self.out.success('done')
+                    booted = True
+                    self.out.info("Installing new drivers ...", False)
+                    with self._vm_phase('virtio-install'):
+                        if not self.vm.wait_on_serial(virtio_timeout):
+                            raise FatalError(
+                                "Windows VirtIO installation timed out!")
+                    self.out.success('done')
+                    self.out.info("Rebooting Windows VM ...")
+                elif virtio:
+                    # The VM boots in safe mode and then reboots
+                    self.out.info("Booting Windows VM in safe mode first ...")
+                    timeout += timeout + shutdown_timeout
+
                 self.out.info("Waiting for OS to boot ...", False)
-                if not self.vm.wait_on_serial(timeout):
-                    raise FatalError("Windows VM booting timed out!")
+                with self._vm_phase('vm-boot'):
+                    if not self.vm.wait_on_serial(timeout):
+                        raise FatalError("Windows VM booting timed out!")
                 self.out.success('done')
                 booted = True
 
@@ -581,14 +874,14 @@ class Windows(OSBase):
                 self._check_connectivity()
                 # self.out.success('done')
 
-                # self.out.info("Disabling automatic logon ...", False)
-                self._disable_autologon()
-                self.out.success('done')
-
-                self._exec_sysprep_tasks()
+                # Run all the commands through one remote shell
+                with self.vm.session():
+                    with self._vm_phase('vm-sysprep'):
+                        self._exec_sysprep_tasks(tasks, cnt, size)
 
                 self.out.info("Waiting for windows to shut down ...", False)
-                (_, stderr, rc) = self.vm.wait(shutdown_timeout)
+                with self._vm_phase('vm-shutdown'):
+                    (_, stderr, rc) = self.vm.wait(shutdown_timeout)
                 if rc != 0 or "terminating on signal" in stderr:
                     raise FatalError("Windows VM died unexpectedly!\n\n"
                                      "(rc=%d)\n%s" % (rc, stderr))
@@ -613,36 +906,31 @@ class Windows(OSBase):
                         self.registry.reset_passwd(self.vm.admin.rid, v_val)
 
                     self._cleanup('sysprep')
+                    if virtio:
+                        self.virtio_state = self.compute_virtio_state()
                     self.out.success("done")
 
-        self.image.shrink(silent=True)
-
-    def _exec_sysprep_tasks(self):
-        """This function hosts the actual code for executing the enabled
-        sysprep tasks. At the end of this method the VM is shut down if needed.
+    def _exec_sysprep_tasks(self, tasks, cnt, size):
+        """This function hosts the actual code for executing the sysprep tasks
+        that need the VM. At the end of this method the VM is shut down if
+        needed.
         """
-        tasks = self.list_syspreps()
-        enabled = [t for t in tasks if self.sysprep_enabled(t)]
-        size = len(enabled)
 
         # Make sure shrink runs in the end, before ms sysprep
-        enabled = [t for t in enabled if self.sysprep_info(t).name != 'shrink']
-        if len(enabled) != size:
+        enabled = [t for t in tasks if self.sysprep_info(t).name != 'shrink']
+        if len(enabled) != len(tasks):
             enabled.append(self._shrink)
 
         # Make sure the ms sysprep is the last task to run if it is enabled
         enabled = [t for t in enabled
                    if self.sysprep_info(t).name != 'microsoft-sysprep']
 
-        if len(enabled) != size:
+        if len(enabled) != len(tasks):
             enabled.append(self._microsoft_sysprep)
 
-        cnt = 0
         for task in enabled:
             cnt += 1
-            self.out.info(('(%d/%d)' % (cnt, size)).ljust(7), False)
-            task()
-            del self._sysprep_tasks[task.__name__]
+            self._exec_sysprep(cnt, size, task)
 
         self.out.info("Sending shut down command ...", False)
         if not self.sysprepped:
@@ -653,19 +941,9 @@ class Windows(OSBase):
         """Shuts down the windows VM"""
         self.vm.rexec(r'shutdown /s /t 5', uninstall=True)
 
-    def _disable_autologon(self):
-        """Disable automatic logon on the windows image"""
-
-        winlogon = \
-            r'"HKLM\SOFTWARE\Microsoft\Windows NT\CurrentVersion\Winlogon"'
-
-        self.vm.rexec('REG DELETE %s /v DefaultUserName /f' % winlogon)
-        self.vm.rexec('REG DELETE %s /v DefaultPassword /f' % winlogon)
-        self.vm.rexec('REG DELETE %s /v AutoAdminLogon /f' % winlogon)
-
-    def _add_boot_scripts(self):
-        """Add various scripts in the registry that will be executed during the
-        next boot.
+    def _boot_commands(self):
+        """Returns the commands that need to be executed when the VM boots for
+        the system preparation
         """
 
         commands = {}
@@ -692,7 +970,16 @@ class Windows(OSBase):
              r'\policies\system /v LocalAccountTokenFilterPolicy'
              r' /t REG_DWORD /d 1 /f')
 
-        self.registry.runonce(commands)
+        return commands
+
+    def _add_boot_scripts(self, runonce=True):
+        """Add various scripts in the registry that will be executed during the
+        next boot. If runonce is False, the boot commands are not added. This
+        is the case if a script running on a previous boot adds them.
+        """
+
+        if runonce:
+            self.registry.runonce(self._boot_commands())
 
         # Enable automatic logon.
         # This is needed in order for the scripts we added in the RunOnce
@@ -711,6 +998,9 @@ class Windows(OSBase):
 
         self.registry.enable_autologon(self.vm.admin.name)
 
+        # The automatic logon is disabled offline, after the VM shuts down
+        self._add_cleanup('sysprep', self.registry.disable_autologon)
+
     def _do_collect_metadata(self):
         """Collect metadata about the OS"""
         super(Windows, self)._do_collect_metadata()
@@ -744,20 +1034,38 @@ class Windows(OSBase):
         self.meta['SORTORDER'] += (100 * major + minor) * 100
         self.meta['GUI'] = 'Windows'
 
+    def _start_vm(self, **kwargs):
+        """Start the Windows VM"""
+        self.vm.virtio_net = len(self.virtio_state['netkvm']) > 0
+        self.vm.start(**kwargs)
+
+    def _vm_phase(self, name):
+        """Returns a context manager that records a phase of the Windows VM
+        along with the VM performance profile
+        """
+        phase = self.out.phase(name)
+        phase.record['vm_profile'] = self.vm.profile
+        return phase
+
     def _check_connectivity(self):
         """Check if winexe works on the Windows VM"""
 
         retries = self.sysprep_params['connection_retries'].value
-        timeout = [5]
-        for i in xrange(1, retries - 1):
-            timeout.insert(0, timeout[0] * 2)
 
         # If the connection_retries parameter is set to 0 disable the
         # connectivity check
         if retries == 0:
             return True
 
+        timeout = self.sysprep_params['connection_timeout'].value
+        deadline = time.time() + timeout
+
         for i in xrange(retries):
+            # Only try winexe after the SMB service of the VM answers
+            if not self.vm.wait_for_smb(max(0, deadline - time.time())):
+                raise FatalError("The SMB service of the Windows VM did not "
+                                 "answer within %d seconds" % timeout)
+
             (stdout, stderr, rc) = self.vm.rexec('cmd /C', fatal=False,
                                                  debug=True)
             if rc == 0:
@@ -771,12 +1079,12 @@ class Windows(OSBase):
                 log.close()
             self.out.info("failed! See: `%s' for the full output" % log.name)
             if i < retries - 1:
-                wait = timeout.pop()
-                self.out.info("retrying in %d seconds ..." % wait, False)
-                time.sleep(wait)
+                self.out.info("retrying ...", False)
+                # Give the service some time to settle
+                time.sleep(1)
 
-        raise FatalError("Connection to the Windows VM failed after %d retries"
-                         % retries)
+        raise FatalError("Connection to the Windows VM failed after %d "
+                         "attempt(s)" % retries)
 
     def compute_virtio_state(self, directory=None):
         """Returns information about the VirtIO drivers found either in a
@@ -790,24 +1098,17 @@ class Windows(OSBase):
             """Parse oem*.inf files under the %SystemRoot%/Inf directory"""
             path = self.image.g.case_sensitive_path("%s/inf" % self.systemroot)
             oem = re.compile(r'^oem\d+\.inf', flags=re.IGNORECASE)
-            for name in [f['name'] for f in self.image.g.readdir(path)]:
-                if not oem.match(name):
-                    continue
-                yield name, \
-                    self.image.g.cat("%s/%s" % (path, name)).splitlines()
+            for name, txt in self._fetch_files(path, oem):
+                yield name, parse_inf(txt.splitlines())
 
         def local_files():
             """Parse *.inf files under a local directory"""
             assert os.path.isdir(directory)
-            inf = re.compile(r'^.+\.inf', flags=re.IGNORECASE)
-            for name in os.listdir(directory):
-                fullpath = os.path.join(directory, name)
-                if inf.match(name) and os.path.isfile(fullpath):
-                    with open(fullpath, 'r') as content:
-                        yield name, content
+            return InfIndex().scan(directory).items()
 
-        for name, txt in oem_files() if directory is None else local_files():
-            driver, target, content = parse_inf(txt)
+        for name, parsed in oem_files() if directory is None else \
+                local_files():
+            driver, target, content = parsed
 
             if driver:
                 content['TargetOSVersions'] = target
@@ -815,6 +1116,52 @@ class Windows(OSBase):
 
         return state
 
+    def _fetch_files(self, directory, pattern):
+        """Returns a list with the names and the contents of the files of a
+        medium directory whose names match a pattern. The files are fetched
+        with one tar transfer, instead of one transfer per file.
+        """
+        entries = self.image.g.readdir(directory)
+        names = [e['name'] for e in entries if e['ftyp'] == 'r' and
+                 pattern.match(e['name'])]
+        if not len(names):
+            return []
+
+        # tar_out can only exclude entries. Exclude everything except the
+        # matching files with a pattern for the names that start with a
+        # different character than the matching ones and the exact names of
+        # the rest. The entries of tar start with "./".
+        initials = set(n[0].lower() for n in names)
+        initials |= set(i.upper() for i in initials)
+        excludes = ['[!.%s]*' % ''.join(sorted(initials))]
+        excludes.extend(
+            e['name'].replace('[', '[[]') for e in entries
+            if e['name'] not in ('.', '..') and e['name'][0] in initials and
+            e['name'] not in names)
+
+        files = []
+        fd, tmp = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            try:
+                self.image.g.tar_out(directory, tmp, excludes=excludes)
+                with tarfile.open(tmp) as tar:
+                    for member in tar:
+                        name = os.path.basename(member.name)
+                        if member.isfile() and name in names:
+                            files.append(
+                                (name, tar.extractfile(member).read()))
+            except (RuntimeError, TypeError, tarfile.TarError) as e:
+                # Older libguestfs versions do not support the excludes
+                # argument
+                log.debug("Bulk transfer of %s failed: %s", directory, e)
+                files = [(name, self.image.g.cat("%s/%s" % (directory, name)))
+                         for name in names]
+        finally:
+            os.unlink(tmp)
+
+        return files
+
     def _fetch_virtio_drivers(self, dirname):
         """Examines a directory for VirtIO drivers and returns only the drivers
         that are suitable for this medium.
@@ -862,11 +1209,17 @@ class Windows(OSBase):
                       (num, "s" if num != 1 else ""))
         return collection
 
-    def install_virtio_drivers(self, upgrade=True):
+    def install_virtio_drivers(self, upgrade=True, **kwargs):
         """Install new VirtIO drivers on the input medium. If upgrade is True,
         then the old drivers found in the medium will be removed.
+
+        If defer is True, the installation is postponed until the system
+        preparation, so that the drivers get installed in the same VM run with
+        the sysprep tasks.
         """
 
+        defer = kwargs['defer'] if 'defer' in kwargs else False
+
         dirname = self.sysprep_params['virtio'].value
         if not dirname:
             raise FatalError('No directory hosting the VirtIO drivers defined')
@@ -905,21 +1258,45 @@ class Windows(OSBase):
             else:
                 add.extend([d for d in valid_drvs[dtype]])
 
+        drivers = {'upload': dirname, 'certs': certs, 'add': add,
+                   'install': install, 'remove': remove,
+                   'types': valid_drvs.keys()}
+
+        if defer:
+            self._virtio_pending = drivers
+            self.out.info("Deferred until the system preparation")
+            self.out.info()
+            return
+
+        self._install_virtio(drivers)
+
+    def _install_virtio(self, drivers):
+        """Boot the Windows VM to install the VirtIO drivers"""
+
         try:
-            self._update_driver_database('virtio', upload=dirname, certs=certs,
-                                         add=add, install=install,
-                                         remove=remove)
+            self._update_driver_database('virtio', **drivers)
+            self._boot_virtio_vm()
         finally:
-            with self.mount(readonly=False, silent=True, fatal=False):
-                if not self.ismounted:
-                    self.out.warn("The boot changes cannot be reverted. "
-                                  "The image may be in a corrupted state.")
-                else:
-                    self._cleanup('virtio')
+            self._revert_virtio()
 
         self.out.success("VirtIO drivers were successfully installed")
         self.out.info()
 
+    def _revert_virtio(self):
+        """Revert the changes made to the medium for installing the VirtIO
+        drivers, if they are not already reverted.
+        """
+
+        if 'virtio' not in self._cleanup_jobs:
+            return
+
+        with self.mount(readonly=False, silent=True, fatal=False):
+            if not self.ismounted:
+                self.out.warn("The boot changes cannot be reverted. "
+                              "The image may be in a corrupted state.")
+            else:
+                self._cleanup('virtio')
+
     def _update_driver_database(self, namespace, **kwargs):
         """Upload a directory that contains the VirtIO drivers and add scripts
         for installing and removing specific drivers.
@@ -930,6 +1307,7 @@ class Windows(OSBase):
         add     -- List of drivers to add to the driver database
         install -- List of drivers to install to the system
         remove  -- List of drivers to remove from the system
+        merge   -- Continue with the sysprep boot after installing the drivers
         """
 
         upload = kwargs['upload'] if 'upload' in kwargs else None
@@ -937,6 +1315,7 @@ class Windows(OSBase):
         install = kwargs['install'] if 'install' in kwargs else []
         certs = kwargs['certs'] if 'certs' in kwargs else []
         remove = kwargs['remove'] if 'remove' in kwargs else []
+        merge = kwargs['merge'] if 'merge' in kwargs else False
 
         assert len(add) == 0 or upload is not None
         assert len(install) == 0 or upload is not None
@@ -966,7 +1345,8 @@ class Windows(OSBase):
                 self._add_cleanup(namespace,
                                   self.registry.update_auoptions, old)
 
-            # We disable this with powershell scripts
+            # We disable this with powershell scripts. If the sysprep boot
+            # follows, it is disabled offline when the VM shuts down.
             self.registry.enable_autologon(self.vm.admin.name)
 
             # Disable first logon animation (if needed)
@@ -1014,14 +1394,26 @@ class Windows(OSBase):
                 old = self.registry.update_devices_dirs("%SystemRoot%\\" + tmp)
                 self._add_cleanup(
                     namespace, self.registry.update_devices_dirs, old, False)
-                drvs_install += powershell.DISABLE_AUTOLOGON
+                if merge:
+                    # Register the sysprep boot scripts for the logon that
+                    # follows the reboot. If they were added in the registry
+                    # now, they would run along with the driver installation.
+                    for name, cmd in self._boot_commands().items():
+                        drvs_install += powershell.RUNONCE % \
+                            (name, cmd.replace("'", "''"))
+                    drvs_install += powershell.DRVINST_REBOOT_TAIL
+                else:
+                    drvs_install += powershell.DISABLE_AUTOLOGON
+                    drvs_install += powershell.DRVINST_TAIL
             else:
                 # In newer windows, in order to reduce the boot process the
                 # boot drivers are cached. To be able to boot with viostor, we
-                # need to reboot in safe mode.
-                drvs_install += powershell.SAFEBOOT
-
-            drvs_install += powershell.DRVINST_TAIL
+                # need to reboot in safe mode. If the sysprep boot follows,
+                # the safe mode boot reboots in normal mode instead of
+                # shutting down.
+                drvs_install += powershell.SAFEBOOT_REBOOT if merge else \
+                    powershell.SAFEBOOT
+                drvs_install += powershell.DRVINST_TAIL
 
             target = "%s/%s/InstallDrivers.ps1" % (self.systemroot, tmp)
             self.image.g.write(target, drvs_install.replace('\n', '\r\n'))
@@ -1044,11 +1436,10 @@ class Windows(OSBase):
             # (*) to force the program to run even in Safe mode.
             self.registry.runonce({'*InstallDrivers': cmd})
 
-        # Boot the Windows VM to update the driver's database
-        self._boot_virtio_vm()
-
-    def _boot_virtio_vm(self):
-        """Boot the medium and install the VirtIO drivers"""
+    def _boot_virtio_vm(self, safeboot=True):
+        """Boot the medium and install the VirtIO drivers. On newer Windows,
+        the VM is rebooted in safe mode afterwards, unless safeboot is False.
+        """
 
         old_windows = self.check_version(6, 1) <= 0
         self.image.disable_guestfs()
@@ -1060,25 +1451,29 @@ class Windows(OSBase):
             booted = False
             try:
                 if old_windows:
-                    self.vm.start()
+                    self._start_vm()
                 else:
                     self.vm.interface = 'ide'
-                    self.vm.start(extra_disk=('/dev/null', 'virtio'))
+                    self._start_vm(extra_disk=('/dev/null', 'virtio'))
                     self.vm.interface = 'virtio'
 
                 self.out.success("started (console on VNC display: %d)" %
                                  self.vm.display)
                 self.out.info("Waiting for Windows to boot ...", False)
-                if not self.vm.wait_on_serial(timeout):
-                    raise FatalError("Windows VM booting timed out!")
+                with self._vm_phase('vm-boot'):
+                    if not self.vm.wait_on_serial(timeout):
+                        raise FatalError("Windows VM booting timed out!")
                 self.out.success('done')
                 booted = True
                 self.out.info("Installing new drivers ...", False)
-                if not self.vm.wait_on_serial(virtio_timeout):
-                    raise FatalError("Windows VirtIO installation timed out!")
+                with self._vm_phase('virtio-install'):
+                    if not self.vm.wait_on_serial(virtio_timeout):
+                        raise FatalError(
+                            "Windows VirtIO installation timed out!")
                 self.out.success('done')
                 self.out.info('Shutting down ...', False)
-                (_, stderr, rc) = self.vm.wait(shutdown_timeout)
+                with self._vm_phase('vm-shutdown'):
+                    (_, stderr, rc) = self.vm.wait(shutdown_timeout)
                 if rc != 0 or "terminating on signal" in stderr:
                     raise FatalError("Windows VM died unexpectedly!\n\n"
                                      "(rc=%d)\n%s" % (rc, stderr))
@@ -1095,12 +1490,12 @@ class Windows(OSBase):
         if not (len(self.virtio_state['viostor']) and viostor_service_found):
             raise FatalError("viostor was not successfully installed")
 
-        if self.check_version(6, 1) > 0:
+        if self.check_version(6, 1) > 0 and safeboot:
             # Hopefully restart in safe mode. Newer windows will not boot from
             # a viostor device unless we initially start them in safe mode
             try:
                 self.out.info('Rebooting Windows VM in safe mode ...', False)
-                self.vm.start()
+                self._start_vm()
                 (_, stderr, rc) = self.vm.wait(timeout + shutdown_timeout)
                 if rc != 0 or "terminating on signal" in stderr:
                     raise FatalError("Windows VM died unexpectedly!\n\n"
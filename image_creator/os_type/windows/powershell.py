@@ -75,6 +75,10 @@ DRVINST_TAIL = COM1_WRITE + """
 shutdown /s /t 0
 """
 
+DRVINST_REBOOT_TAIL = COM1_WRITE + """
+shutdown /r /t 0
+"""
+
 DISABLE_AUTOLOGON = r"""
 Remove-ItemProperty -Path `
     'HKLM:\Software\Microsoft\Windows NT\CurrentVersion\Winlogon\' `
@@ -87,16 +91,19 @@ Remove-ItemProperty -Path `
     AutoAdminLogon
 """
 
-# Reboots system in safe mode
-SAFEBOOT = r"""
+# Makes the next boot a safe mode boot
+SAFEBOOT_HEAD = r"""
 bcdedit /set safeboot minimal
 
-$winlogon = 'HKLM\SOFTWARE\Microsoft\Windows NT\CurrentVersion\Winlogon'
 New-ItemProperty `
     -Path HKLM:\SOFTWARE\Microsoft\Windows\CurrentVersion\RunOnce `
     -Name *1snf-image-creator-safeboot -PropertyType String `
     -Value 'bcdedit /deletevalue safeboot'
+"""
 
+# Disables automatic logon in safe mode
+SAFEBOOT_AUTOLOGON = r"""
+$winlogon = 'HKLM\SOFTWARE\Microsoft\Windows NT\CurrentVersion\Winlogon'
 New-ItemProperty `
     -Path HKLM:\SOFTWARE\Microsoft\Windows\CurrentVersion\RunOnce `
     -Name *2snf-image-creator-safeboot -PropertyType String `
@@ -109,11 +116,28 @@ New-ItemProperty `
     -Path HKLM:\SOFTWARE\Microsoft\Windows\CurrentVersion\RunOnce `
     -Name *4snf-image-creator-safeboot -PropertyType String `
     -Value "reg delete `"$winlogon`" /v AutoAdminLogon /f"
+"""
 
+SAFEBOOT_SHUTDOWN = r"""
 New-ItemProperty `
     -Path HKLM:\SOFTWARE\Microsoft\Windows\CurrentVersion\RunOnce `
     -Name *5snf-image-creator-safeboot -PropertyType String `
-    -Value 'shutdown /s /t 5'
+    -Value 'shutdown /%s /t 5'
+"""
+
+# Reboots system in safe mode
+SAFEBOOT = SAFEBOOT_HEAD + SAFEBOOT_AUTOLOGON + SAFEBOOT_SHUTDOWN % 's'
+
+# Reboots system in safe mode and then reboots again in normal mode. The
+# automatic logon is left enabled for the normal mode boot.
+SAFEBOOT_REBOOT = SAFEBOOT_HEAD + SAFEBOOT_SHUTDOWN % 'r'
+
+# Adds a command that will be executed in the next logon. The single quotes in
+# the command need to be doubled.
+RUNONCE = r"""
+New-ItemProperty `
+    -Path HKLM:\SOFTWARE\Microsoft\Windows\CurrentVersion\RunOnce `
+    -Name '%s' -PropertyType String -Value '%s'
 """
 
 # vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -23,6 +23,10 @@ import hivex
 import tempfile
 import os
 import struct
+import time
+
+import logging
+log = logging.getLogger(__name__)
 
 # The Administrators group RID
 ADMINS = 0x00000220
@@ -77,45 +81,96 @@ class Registry(object):
         self.image = image
         self.root = image.root
 
-    def open_hive(self, hive, write=False):
-        """Returns a context manager for opening a hive file of the image for
-        reading or writing.
+        # The hives that have been downloaded from the image
+        self._hives = {}
+        self._stats = {'downloads': 0, 'uploads': 0, 'requests': 0,
+                       'time': 0.0}
+
+    def _get_hive(self, name):
+        """Returns a hivex handle for a hive of the image. The hive is
+        downloaded only the first time it is requested.
         """
+        self._stats['requests'] += 1
+        if name in self._hives:
+            return self._hives[name]['hive']
+
         systemroot = self.image.g.inspect_get_windows_systemroot(self.root)
-        path = "%s/system32/config/%s" % (systemroot, hive)
+        path = "%s/system32/config/%s" % (systemroot, name)
         try:
             path = self.image.g.case_sensitive_path(path)
         except RuntimeError as err:
             raise FatalError("Unable to retrieve file: %s. Reason: %s" %
-                             (hive, str(err)))
+                             (name, str(err)))
+
+        start = time.time()
+        localfd, localpath = tempfile.mkstemp()
+        try:
+            os.close(localfd)
+            self.image.g.download(path, localpath)
+
+            # Always open the hive for writing. Changes only reach the image
+            # if flush() uploads the hive.
+            hive = hivex.Hivex(localpath, write=True)
+        except:
+            os.unlink(localpath)
+            raise
+
+        self._stats['downloads'] += 1
+        self._stats['time'] += time.time() - start
+
+        self._hives[name] = {'hive': hive, 'local': localpath, 'path': path,
+                             'dirty': False}
+        return hive
+
+    def open_hive(self, hive, write=False):
+        """Returns a context manager for opening a hive file of the image for
+        reading or writing.
+
+        The hives are cached. A hive that is opened for writing is marked as
+        modified and will be uploaded back to the image by flush().
+        """
 
         # OpenHive class needs this since 'self' gets overwritten
-        g = self.image.g
+        registry = self
 
         class OpenHive(object):
             """The OpenHive context manager"""
             def __enter__(self):
-                localfd, self.localpath = tempfile.mkstemp()
-                try:
-                    os.close(localfd)
-                    g.download(path, self.localpath)
-
-                    hive = hivex.Hivex(self.localpath, write=write)
-                except:
-                    os.unlink(self.localpath)
-                    raise
-
-                return hive
+                return registry._get_hive(hive)
 
             def __exit__(self, exc_type, exc_value, traceback):
-                try:
-                    if write:
-                        g.upload(self.localpath, path)
-                finally:
-                    os.unlink(self.localpath)
+                if write and exc_type is None:
+                    registry._hives[hive]['dirty'] = True
 
         return OpenHive()
 
+    def flush(self):
+        """Upload the modified hives back to the image and empty the hive
+        cache. This needs to be called before the medium is unmounted.
+        """
+        start = time.time()
+        try:
+            for entry in self._hives.values():
+                if entry['dirty']:
+                    self.image.g.upload(entry['local'], entry['path'])
+                    self._stats['uploads'] += 1
+        finally:
+            self.forget()
+
+        self._stats['time'] += time.time() - start
+        log.debug("Registry hives: %(requests)d requests, %(downloads)d "
+                  "downloads, %(uploads)d uploads, %(time).2fs spent "
+                  "transferring", self._stats)
+
+    def forget(self):
+        """Empty the hive cache, dropping any changes that have not been
+        uploaded back to the image
+        """
+        for entry in self._hives.values():
+            del entry['hive']
+            os.unlink(entry['local'])
+        self._hives = {}
+
     @property
     def current_control_set(self):
         """Returns the current control set of the registry"""
@@ -263,6 +318,62 @@ class Registry(object):
 
             hive.commit(None)
 
+    def disable_autologon(self):
+        """Disable automatic logon by removing the values added by
+        enable_autologon()
+        """
+
+        remove = ('defaultusername', 'defaultpassword', 'autoadminlogon')
+
+        with self.open_hive('SOFTWARE', write=True) as hive:
+            winlogon = traverse(
+                hive, 'Microsoft/Windows NT/CurrentVersion/Winlogon')
+
+            values = []
+            for value in hive.node_values(winlogon):
+                key = hive.value_key(value)
+                if key.lower() in remove:
+                    continue
+                t, data = hive.value_value(value)
+                values.append({'key': key, 't': t, 'value': data})
+
+            if len(values) != len(hive.node_values(winlogon)):
+                hive.node_set_values(winlogon, values)
+                hive.commit(None)
+
+    def update_realtime_is_universal(self, value):
+        """Updates the RealTimeIsUniversal value of the TimeZoneInformation
+        registry key.
+
+        value = 0 will make Windows treat the hardware clock as local time
+        value = 1 will make Windows treat the hardware clock as UTC
+
+        Returns:
+            The old value of the field
+        """
+
+        key = 'SYSTEM/%s/Control/TimeZoneInformation' % \
+            self.current_control_set
+        valuename = 'RealTimeIsUniversal'
+
+        return self._update_dword(key, valuename, value, 0, (0, 1))
+
+    def update_hibernate_enabled(self, value):
+        """Updates the HibernateEnabled value of the Power registry key.
+
+        value = 0 will disable hibernation and the hibernation file will not
+        be created again when Windows boots
+        value = 1 will enable hibernation
+
+        Returns:
+            The old value of the field
+        """
+
+        key = 'SYSTEM/%s/Control/Power' % self.current_control_set
+        valuename = 'HibernateEnabled'
+
+        return self._update_dword(key, valuename, value, 1, (0, 1))
+
     def update_firewalls(self, domain, public, standard):
         """Enables or disables the firewall for the Domain, the Public and the
         Standard profile. Returns a triple with the old values.
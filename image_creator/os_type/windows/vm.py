@@ -18,20 +18,126 @@
 """This module provides an interface for launching windows VMs."""
 
 import random
+import re
 import subprocess
-import signal
 import tempfile
 import os
 import time
 import errno
+import select
+import socket
+import shutil
+import json
+import struct
+import stat
+import multiprocessing
 from string import lowercase, uppercase, digits
 
-from image_creator.util import FatalError, get_kvm_binary
-from image_creator.os_type.windows.winexe import WinEXE, WinexeTimeout
+from image_creator.util import FatalError, get_kvm_binary, \
+    concurrent_jobs
+from image_creator.os_type.windows.winexe import WinEXE, WinexeSession, \
+    WinexeTimeout
 
 # Just a random 16 character long token
 RANDOM_TOKEN = "".join(random.choice(lowercase + uppercase) for _ in range(16))
 
+# The dialects offered in the SMB negotiate request. Servers supporting SMB2
+# will answer with an SMB2 negotiate response.
+SMB_DIALECTS = ('NT LM 0.12', 'SMB 2.002', 'SMB 2.???')
+
+# Interval in seconds for polling the SMB service of the VM
+SMB_POLL_INTERVAL = 0.25
+
+# The compatible profile uses emulated devices and the CPUs and memory defined
+# by the sysprep parameters. The performance profile uses paravirtualized
+# devices, passes the host CPU through and sizes the VM from the host
+# resources.
+VM_PROFILES = ('compatible', 'performance')
+
+# Upper limit in MiB for the automatically sized memory of the VM
+MAX_AUTO_MEM = 4096
+
+# Number of times the VM is started with different ports if the ones picked
+# get bound by another process first
+START_RETRIES = 5
+
+# QEMU errors printed when a forwarded port or a VNC display is in use
+BIND_ERRORS = re.compile(r'host forwarding rule|Failed to bind socket|'
+                         r'Address already in use')
+
+
+def vm_profile_check(profile):
+    """Check if a VM performance profile is valid"""
+    if profile not in VM_PROFILES:
+        raise ValueError("Invalid VM profile: `%s'. Valid profiles are: %s" %
+                         (profile, ", ".join(VM_PROFILES)))
+    return profile
+
+
+def smb_negotiate_request():
+    """Returns an SMB Negotiate Protocol request packet, prefixed with the
+    Direct TCP transport header.
+    """
+    dialects = ''.join('\x02%s\x00' % d for d in SMB_DIALECTS)
+
+    # Protocol, Command, Status, Flags, Flags2, PIDHigh, Signature, Reserved,
+    # TID, PIDLow, UID, MID
+    header = struct.pack('<4sBIBHH8sHHHHH', '\xffSMB', 0x72, 0, 0x18, 0xc853,
+                         0, '\x00' * 8, 0, 0, 0xfeff, 0, 0)
+    # WordCount, ByteCount, Dialects
+    body = struct.pack('<BH', 0, len(dialects)) + dialects
+
+    message = header + body
+    return struct.pack('>I', len(message)) + message
+
+
+def smb_probe(port, host='127.0.0.1', timeout=1):
+    """Check if an SMB server answers on a TCP port. The port may accept
+    connections without a server behind it (e.g. if it is forwarded by QEMU),
+    so the SMB negotiate response is checked.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect((host, port))
+        sock.sendall(smb_negotiate_request())
+
+        response = ""
+        while len(response) < 8:
+            data = sock.recv(8 - len(response))
+            if not data:
+                return False
+            response += data
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+    # A session message followed by an SMB1 or SMB2 header
+    return response[0] == '\x00' and response[4:8] in ('\xffSMB', '\xfeSMB')
+
+
+def is_port_free(port, host=''):
+    """Check if a TCP port can be bound on the host"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((host, port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def free_port(host='127.0.0.1'):
+    """Returns a TCP port that is currently free on the host"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
 
 class VM(object):
     """Windows Virtual Machine"""
@@ -43,9 +149,15 @@ class VM(object):
         self.admin = admin
         self.interface = 'virtio'
 
+        # Set if the VirtIO network driver is installed on the medium
+        self.virtio_net = False
+
         # expected number of token occurrences in serial port
         self._ntokens = 0
 
+        # number of times the VM has been started
+        self.boots = 0
+
         kvm, needed_args = get_kvm_binary()
         if kvm is None:
             raise FatalError("Can't find the kvm binary")
@@ -92,11 +204,19 @@ class VM(object):
 
         self.password = random_password()
 
-        # Use Ganeti's VNC port range for a random vnc port
-        self.display = random.randint(11000, 14999) - 5900
+        self.display = None
+        self.smb_port = None
 
-        self.serial = None
         self.process = None
+        self._session = None
+        self._tmpdir = None
+        self._stderr = None
+        self._serial = None
+        self._serial_buf = ""
+        self._serial_tokens = 0
+        self._qmp = None
+        self._qmp_buf = ""
+        self._qmp_events = []
 
     def isalive(self):
         """Check if the VM is alive"""
@@ -106,22 +226,40 @@ class VM(object):
         """Start the windows VM"""
 
         self._ntokens = 0
+        self.boots += 1
+
+        performance = self.profile == 'performance'
 
         args = []
         args.extend(self.kvm)
 
-        if 'smp' in self.params:
-            args.extend(['-smp', str(self.params['smp'].value)])
-
-        if 'mem' in self.params:
-            args.extend(['-m', str(self.params['mem'].value)])
-
-        args.extend(['-drive', 'file=%s,cache=unsafe,if=%s' %
-                     (self.disk, self.interface)])
-
-        args.extend(
-            ['-netdev', 'type=user,hostfwd=tcp::445-:445,id=netdev0',
-             '-device', 'rtl8139,mac=%s,netdev=netdev0' % self.mac])
+        smp, mem = self._resources()
+        if smp is not None:
+            args.extend(['-smp', '%d,sockets=1,cores=%d' % (smp, smp)
+                         if performance else str(smp)])
+
+        if mem is not None:
+            args.extend(['-m', str(mem)])
+
+        if performance:
+            args.extend(['-cpu', 'host'])
+
+        if performance and self.interface == 'virtio':
+            # Native AIO needs O_DIRECT, which is not supported by all the
+            # file systems that may host a snapshot file
+            cache = 'cache=none,aio=native' \
+                if stat.S_ISBLK(os.stat(self.disk).st_mode) else 'cache=unsafe'
+            args.extend(['-object', 'iothread,id=iothread0',
+                         '-drive', 'file=%s,%s,if=none,id=disk0' %
+                         (self.disk, cache),
+                         '-device', 'virtio-blk-pci,drive=disk0,'
+                         'iothread=iothread0'])
+        else:
+            args.extend(['-drive', 'file=%s,cache=unsafe,if=%s' %
+                         (self.disk, self.interface)])
+
+        nic = 'virtio-net-pci' if performance and self.virtio_net \
+            else 'rtl8139'
 
         if 'extra_disk' in kwargs:
             fname, iftype = kwargs['extra_disk']
@@ -129,28 +267,234 @@ class VM(object):
                          'file=%s,format=raw,cache=unsafe,if=%s' %
                          (fname, iftype)])
 
-        args.extend(['-vnc', ":%d" % self.display])
+        # Forward a free local port to the SMB port of the VM and use a free
+        # VNC display, so that many VMs can run on the same host. Another
+        # process may bind them before the VM does. In this case the VM exits
+        # and is started again with other ones.
+        for attempt in xrange(START_RETRIES):
+            self.smb_port = free_port()
+            self.display = self._free_display()
+            ports = ['-netdev', 'type=user,hostfwd=tcp:127.0.0.1:%d-:445,'
+                     'id=netdev0' % self.smb_port,
+                     '-device', '%s,mac=%s,netdev=netdev0' % (nic, self.mac),
+                     '-vnc', ":%d" % self.display]
+            try:
+                self._launch(args + ports)
+                break
+            except FatalError:
+                if self.isalive() or attempt == START_RETRIES - 1 or \
+                        not BIND_ERRORS.search(self._reap()[1]):
+                    raise
+                self._close()
+
+    def _launch(self, args):
+        """Start the VM process and connect to its serial port and its QMP
+        monitor
+        """
+        # The serial port and the QMP monitor are exposed as unix sockets
+        self._tmpdir = tempfile.mkdtemp(prefix='snf-image-creator-vm.')
+        serial = os.path.join(self._tmpdir, 'serial')
+        qmp = os.path.join(self._tmpdir, 'qmp')
+        args.extend(['-serial', 'unix:%s,server,nowait' % serial])
+        args.extend(['-qmp', 'unix:%s,server,nowait' % qmp])
+        args.extend(['-monitor', 'none'])
+
+        self._stderr = tempfile.TemporaryFile()
+        with open(os.devnull, 'r+') as devnull:
+            self.process = subprocess.Popen(args, stdin=devnull,
+                                            stdout=devnull,
+                                            stderr=self._stderr)
+
+        self._serial = self._connect(serial)
+        self._serial_buf = ""
+        self._serial_tokens = 0
+
+        self._qmp = self._connect(qmp)
+        self._qmp_buf = ""
+        self._qmp_events = []
+        self._qmp_recv(time.time() + 10)  # The greeting message
+        self._qmp_command('qmp_capabilities')
+
+    @property
+    def profile(self):
+        """The performance profile of the VM"""
+        return self.params['vm_profile'].value \
+            if 'vm_profile' in self.params else 'compatible'
+
+    def _resources(self):
+        """Returns the number of CPUs and the memory in MiB of the VM. In the
+        performance profile, the parameters that are not explicitly set are
+        computed by sharing the host resources among the concurrent jobs.
+        """
+        smp = self.params['smp'].value if 'smp' in self.params else None
+        mem = self.params['mem'].value if 'mem' in self.params else None
 
-        # The serial port
-        serialfd, self.serial = tempfile.mkstemp()
-        os.close(serialfd)
-        args.extend(['-serial', 'file:%s' % self.serial])
+        if self.profile != 'performance':
+            return smp, mem
 
-        args.extend(['-monitor', 'stdio'])
+        jobs = concurrent_jobs()
+        if smp is None or not self.params['smp'].modified:
+            smp = max(1, multiprocessing.cpu_count() // jobs)
 
-        self.process = subprocess.Popen(args, stdin=subprocess.PIPE,
-                                        stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
+        if mem is None or not self.params['mem'].modified:
+            host = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+            mem = max(1024, min(MAX_AUTO_MEM, host // 2 ** 20 // 2 // jobs))
+
+        return smp, mem
+
+    @staticmethod
+    def _free_display():
+        """Returns a free VNC display"""
+
+        # Use Ganeti's VNC port range for a random vnc port
+        for _ in xrange(100):
+            port = random.randint(11000, 14999)
+            if is_port_free(port):
+                return port - 5900
+
+        raise FatalError("Unable to find a free VNC display")
+
+    def _connect(self, path, timeout=10):
+        """Connect to a unix socket created by the VM process"""
+
+        deadline = time.time() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+                return sock
+            except socket.error as e:
+                sock.close()
+                if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+                    raise
+
+            if not self.isalive():
+                rc, stderr = self._reap()
+                raise FatalError("Windows VM died unexpectedly!\n\n"
+                                 "(rc=%d)\n%s" % (rc, stderr))
+
+            if time.time() > deadline:
+                raise FatalError("Unable to connect to the VM socket: `%s'" %
+                                 path)
+            time.sleep(0.1)
+
+    def _qmp_recv(self, deadline=None):
+        """Receive the next message from the QMP monitor. Events are queued.
+        Returns None if the monitor is closed or the deadline is reached.
+        """
+        while True:
+            if '\n' in self._qmp_buf:
+                line, self._qmp_buf = self._qmp_buf.split('\n', 1)
+                if not line.strip():
+                    continue
+                return json.loads(line)
+
+            if self._qmp is None:
+                return None
+
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    return None
+
+            ready, _, _ = select.select([self._qmp], [], [], timeout)
+            if not ready:
+                return None
+
+            data = self._qmp.recv(4096)
+            if not data:
+                self._qmp.close()
+                self._qmp = None
+                continue
+            self._qmp_buf += data
+
+    def _qmp_command(self, command, deadline=None):
+        """Execute a QMP command and return the response"""
+        self._qmp.sendall(json.dumps({'execute': command}) + '\n')
+
+        while True:
+            msg = self._qmp_recv(deadline)
+            if msg is None:
+                return None
+            if 'event' in msg:
+                self._qmp_events.append(msg)
+                continue
+            if 'error' in msg:
+                raise FatalError("QMP command `%s' failed: %s" %
+                                 (command, msg['error'].get('desc', '')))
+            return msg
+
+    def _wait_event(self, name, deadline=None):
+        """Wait for a QMP event. Returns True if the event was received or
+        the monitor was closed, False if the deadline was reached.
+        """
+        while True:
+            for event in self._qmp_events:
+                if event['event'] == name:
+                    self._qmp_events.remove(event)
+                    return True
+
+            msg = self._qmp_recv(deadline)
+            if msg is None:
+                # The monitor is closed if the VM is gone
+                return self._qmp is None
+            if 'event' in msg:
+                self._qmp_events.append(msg)
+
+    def _wait_exit(self, deadline=None):
+        """Wait for the VM process to terminate. Returns False if the deadline
+        is reached.
+        """
+        while self.isalive():
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def _reap(self):
+        """Reap the VM process and return its exit code and standard error"""
+        rc = self.process.wait()
+
+        stderr = ""
+        if self._stderr is not None:
+            self._stderr.seek(0)
+            stderr = self._stderr.read()
+
+        return rc, stderr
+
+    def _close(self):
+        """Release the resources held for a VM run"""
+
+        for sock in (self._serial, self._qmp):
+            if sock is not None:
+                sock.close()
+        self._serial = self._qmp = None
+
+        if self._stderr is not None:
+            self._stderr.close()
+            self._stderr = None
+
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
 
     def stop(self, timeout=0, fatal=True):
         """Stop the VM"""
 
+        self.close_session()
         try:
             if not self.isalive():
                 return
 
-            def handler(signum, frame):
-                """Signal handler"""
+            deadline = time.time() + timeout
+            if self._qmp is not None:
+                try:
+                    self._qmp_command('system_powerdown', deadline)
+                except (socket.error, FatalError):
+                    pass
+
+            if not self._wait_exit(deadline):
                 self.process.terminate()
                 time.sleep(1)
                 if self.isalive():
@@ -159,55 +503,137 @@ class VM(object):
                 if fatal:
                     raise FatalError("Stopping the VM timed-out")
 
-            signal.signal(signal.SIGALRM, handler)
-
-            signal.alarm(timeout)
-            self.process.communicate(input="system_powerdown\n")
-            signal.alarm(0)
-
         finally:
-            if self.serial is not None:
-                try:
-                    os.unlink(self.serial)
-                except OSError as e:
-                    if errno.errorcode[e.errno] != 'ENOENT':  # File not found
-                        raise
+            self._close()
 
     def wait_on_serial(self, timeout):
         """Wait until the random token appears on the VM's serial port"""
 
         self._ntokens += 1
 
-        for _ in xrange(timeout):
-            time.sleep(1)
-            with open(self.serial) as f:
-                current = 0
-                for line in f:
+        deadline = time.time() + timeout
+        while self._serial_tokens < self._ntokens:
+            left = deadline - time.time()
+            if left <= 0:
+                return False
+
+            ready = []
+            if self._serial is not None:
+                # Wake up every second to check if the VM is still alive
+                ready, _, _ = select.select([self._serial], [], [],
+                                            min(left, 1))
+            else:
+                time.sleep(min(left, 1))
+
+            if ready:
+                data = self._serial.recv(4096)
+                if not data:
+                    self._serial.close()
+                    self._serial = None
+                    continue
+
+                lines = (self._serial_buf + data).split('\n')
+                self._serial_buf = lines.pop()
+                for line in lines:
                     if line.startswith(RANDOM_TOKEN):
-                        current += 1
-                        if current == self._ntokens:
-                            return True
-            if not self.isalive():
+                        self._serial_tokens += 1
+
+                # The token may arrive without a trailing new line
+                if self._serial_buf.startswith(RANDOM_TOKEN) and \
+                        self._serial_tokens + 1 == self._ntokens:
+                    self._serial_tokens += 1
+                    self._serial_buf = self._serial_buf[len(RANDOM_TOKEN):]
+
+            elif not self.isalive():
                 (stdout, stderr, rc) = self.wait()
                 raise FatalError("Windows VM died unexpectedly!\n\n"
                                  "(rc=%d)\n%s" % (rc, stderr))
 
-        return False
+        return True
 
     def wait(self, timeout=0):
         """Wait for the VM to shutdown by itself"""
 
-        def handler(signum, frame):
-            """Signal handler"""
+        deadline = time.time() + timeout if timeout else None
+
+        if self._qmp is not None:
+            if not self._wait_event('SHUTDOWN', deadline):
+                raise FatalError("VM wait timed-out.")
+
+        if not self._wait_exit(deadline):
             raise FatalError("VM wait timed-out.")
 
-        signal.signal(signal.SIGALRM, handler)
+        rc, stderr = self._reap()
+        return ("", stderr, rc)
 
-        signal.alarm(timeout)
-        stdout, stderr = self.process.communicate()
-        signal.alarm(0)
+    def wait_for_smb(self, timeout):
+        """Wait until the SMB service of the VM answers. Returns False if this
+        does not happen within timeout seconds.
+        """
+
+        deadline = time.time() + timeout
+        while True:
+            start = time.time()
+            if smb_probe(self.smb_port, timeout=SMB_POLL_INTERVAL * 4):
+                return True
+
+            if not self.isalive():
+                (stdout, stderr, rc) = self.wait()
+                raise FatalError("Windows VM died unexpectedly!\n\n"
+                                 "(rc=%d)\n%s" % (rc, stderr))
+
+            left = deadline - time.time()
+            if left <= 0:
+                return False
+
+            time.sleep(min(left, max(0, SMB_POLL_INTERVAL -
+                                     (time.time() - start))))
+
+    def _winexe(self):
+        """Returns a WinEXE instance for the VM's administrator"""
+        winexe = WinEXE(self.admin.name, '127.0.0.1', password=self.password)
+        winexe.no_pass()
+        winexe.port(self.smb_port)
+        return winexe
+
+    def session(self):
+        """Returns a context manager that keeps a remote shell open on the
+        VM. While it is active, the commands executed with rexec() and
+        rexec_batch() share the same winexe connection.
+        """
+        vm = self
+
+        class Session(object):
+            """The Session context manager"""
+            def __enter__(self):
+                vm._session = vm._winexe().session()
+                return vm._session
 
-        return (stdout, stderr, self.process.poll())
+            def __exit__(self, exc_type, exc_value, traceback):
+                vm.close_session()
+
+        return Session()
+
+    def close_session(self):
+        """Close the remote shell, if open"""
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _check_result(self, command, result, fatal):
+        """Raise a FatalError if a remote command failed"""
+        stdout, stderr, rc = result
+        if rc != 0 and fatal:
+            log = tempfile.NamedTemporaryFile(delete=False)
+            try:
+                log.file.write("STDOUT:\n%s\n" % stdout)
+                log.file.write("STDERR:\n%s\n" % stderr)
+            finally:
+                fname = log.name
+                log.close()
+
+            raise FatalError("Command: `%s' failed (rc=%d). See: %s" %
+                             (command, rc, fname))
 
     def rexec(self, command, **kwargs):
         """Remote execute a command on the windows VM
@@ -220,38 +646,64 @@ class VM(object):
 
         * uninstall: If True, the winexesvc.exe service will be uninstalled
           after the execution of the command.
+
+        If a session is open, the command is executed through it, unless
+        debug or uninstall is set or the session cannot run the command.
+        Uninstalling the service closes the session.
         """
 
         fatal = kwargs['fatal'] if 'fatal' in kwargs else True
         debug = kwargs['debug'] if 'debug' in kwargs else False
         uninstall = kwargs['uninstall'] if 'uninstall' in kwargs else False
 
-        winexe = WinEXE(self.admin.name, 'localhost', password=self.password)
-        winexe.no_pass()
-
-        if debug:
-            winexe.debug(9)
-
         if uninstall:
-            winexe.uninstall()
+            # The service cannot be removed while the session is using it
+            self.close_session()
 
         try:
-            (stdout, stderr, rc) = winexe.run(command)
+            if self._session is not None and not debug and \
+                    self._session.accepts(command):
+                result = self._session.run(command)
+            else:
+                winexe = self._winexe()
+
+                if debug:
+                    winexe.debug(9)
+
+                if uninstall:
+                    winexe.uninstall()
+
+                result = winexe.run(command)
         except WinexeTimeout:
             raise FatalError("Command: `%s' timeout out." % command)
 
-        if rc != 0 and fatal:
-            log = tempfile.NamedTemporaryFile(delete=False)
-            try:
-                log.file.write("STDOUT:\n%s\n" % stdout)
-                log.file.write("STDERR:\n%s\n" % stderr)
-            finally:
-                fname = log.name
-                log.close()
+        self._check_result(command, result, fatal)
 
-            raise FatalError("Command: `%s' failed (rc=%d). See: %s" %
-                             (command, rc, fname))
+        return result
+
+    def rexec_batch(self, commands, fatal=True):
+        """Remote execute a list of commands on the windows VM in one
+        round-trip. A session is opened for this if needed. If the session
+        cannot run some of the commands, they are all executed one by one
+        with rexec(). Returns a list of (stdout, stderr, rc) tuples.
+        """
+
+        if not all(WinexeSession.accepts(c) for c in commands):
+            return [self.rexec(c, fatal=fatal) for c in commands]
+
+        if self._session is None:
+            with self.session():
+                return self.rexec_batch(commands, fatal)
+
+        try:
+            results = self._session.batch(commands)
+        except WinexeTimeout:
+            raise FatalError("Commands: `%s' timeout out." %
+                             "', `".join(commands))
+
+        for command, result in zip(commands, results):
+            self._check_result(command, result, fatal)
 
-        return (stdout, stderr, rc)
+        return results
 
 # vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -20,6 +20,11 @@
 import subprocess
 import time
 import signal
+import select
+import tempfile
+import random
+import os
+from string import lowercase, uppercase
 from sh import which
 
 from image_creator.util import FatalError
@@ -85,6 +90,11 @@ class WinEXE(object):
         self._opts.append('--reinstall')
         return self
 
+    def port(self, port):
+        """Connect to this SMB port"""
+        self._opts.append('--option=smb ports=%d' % port)
+        return self
+
     def debug(self, level):
         """Set debug level"""
         self._opts.append('--debuglevel=%d' % level)
@@ -94,10 +104,18 @@ class WinEXE(object):
         """Send debug output to STDERR"""
         self._opts.append('--debug-stderr')
 
+    def _args(self, command):
+        """Returns the arguments for running a command with winexe"""
+        return [self._prog] + self._opts + ["//%s" % self._host] + [command]
+
+    def session(self):
+        """Open a remote shell that can run multiple commands"""
+        return WinexeSession(self._args('cmd /Q'))
+
     def run(self, command, timeout=0):
         """Run a command on a remote windows system"""
 
-        args = [self._prog] + self._opts + ["//%s" % self._host] + [command]
+        args = self._args(command)
         run = subprocess.Popen(args, stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE)
 
@@ -119,4 +137,143 @@ class WinEXE(object):
 
         return (stdout, stderr, rc)
 
+
+class WinexeSession(object):
+    """A remote command shell that is kept open for running multiple commands
+    over the same winexe connection. The standard error of each command is
+    redirected to a temporary file on the remote system and is sent back
+    after its standard output.
+    """
+
+    def __init__(self, args):
+        """Start the remote shell"""
+        self._args = args
+        self._stderr = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=self._stderr)
+        self._buf = ""
+        self._count = 0
+        # The end of each command's output is marked with this string
+        self._marker = "".join(random.choice(lowercase + uppercase)
+                               for _ in range(16))
+        self._errfile = '"%%TEMP%%\\%s.err"' % self._marker
+
+    def isalive(self):
+        """Check if the remote shell is still running"""
+        return self._proc is not None and self._proc.poll() is None
+
+    @staticmethod
+    def accepts(command):
+        """Check if a command can run in the remote shell. The shell expands
+        the environment variables of the commands it reads, in its own
+        environment and before they start. There is no way to escape this in
+        an interactive shell, so commands referencing variables cannot run in
+        it.
+        """
+        return '%' not in command
+
+    def _send(self, commands):
+        """Send a list of commands to the remote shell in one go. Returns the
+        markers that will follow their output.
+        """
+        markers = []
+        script = ""
+        for command in commands:
+            self._count += 1
+            marker = "%s:%d" % (self._marker, self._count)
+            # The command is grouped, so that the redirections apply to all of
+            # it. It should not read from the shell's standard input.
+            script += "(%s) < NUL 2> %s\r\n" % (command, self._errfile)
+            # The exit code is printed before TYPE overwrites it
+            script += "ECHO %s %%ERRORLEVEL%%\r\n" % marker
+            script += "TYPE %s\r\n" % self._errfile
+            script += "ECHO %s:err\r\n" % marker
+            markers.append(marker)
+
+        script += "DEL %s 2> NUL\r\n" % self._errfile
+
+        self._proc.stdin.write(script)
+        self._proc.stdin.flush()
+        return markers
+
+    def _recv(self, marker, deadline=None):
+        """Read the output of the remote shell up to a marker. Returns the
+        output and the rest of the line that contains the marker.
+        """
+        fd = self._proc.stdout.fileno()
+        while True:
+            pos = self._buf.find(marker)
+            if pos >= 0:
+                end = self._buf.find('\n', pos)
+                if end >= 0:
+                    output = self._buf[:pos]
+                    rest = self._buf[pos + len(marker):end].strip()
+                    self._buf = self._buf[end + 1:]
+                    return output.replace('\r\n', '\n'), rest
+
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    self.close()
+                    raise WinexeTimeout("Command timed-out in winexe session")
+
+            ready, _, _ = select.select([fd], [], [], timeout)
+            if not ready:
+                continue
+
+            data = os.read(fd, 4096)
+            if not data:
+                self._stderr.seek(0)
+                stderr = self._stderr.read()
+                self.close()
+                raise FatalError("Winexe session terminated unexpectedly:\n"
+                                 "%s" % stderr)
+            self._buf += data
+
+    def run(self, command, timeout=0):
+        """Run a command on the remote shell. Returns a (stdout, stderr, rc)
+        tuple like WinEXE.run() does.
+        """
+        return self.batch([command], timeout)[0]
+
+    def batch(self, commands, timeout=0):
+        """Run a list of commands on the remote shell, sending all of them in
+        one go. Returns a list of (stdout, stderr, rc) tuples.
+        """
+        deadline = time.time() + timeout if timeout else None
+
+        results = []
+        for marker in self._send(commands):
+            stdout, rc = self._recv(marker + ' ', deadline)
+            stderr, _ = self._recv(marker + ':err', deadline)
+            results.append((stdout, stderr, int(rc)))
+
+        return results
+
+    def close(self):
+        """Close the remote shell"""
+        if self._proc is None:
+            return
+
+        if self.isalive():
+            try:
+                self._proc.stdin.write("EXIT\r\n")
+                self._proc.stdin.close()
+            except IOError:
+                pass
+
+            # Give the shell some time to exit
+            for _ in xrange(50):
+                if not self.isalive():
+                    break
+                time.sleep(0.1)
+            else:
+                self._proc.terminate()
+
+        self._proc.wait()
+        self._proc = None
+        self._stderr.close()
+
 # vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -21,6 +21,8 @@ subclassing the Output class and assigning the derived one as the output class
 of the various parts of the image-creator package.
 """
 
+import time
+
 
 class Output(object):
     """A class for printing program output"""
@@ -52,6 +54,22 @@ class Output(object):
         """Clear the screen"""
         pass
 
+    @property
+    def stats(self):
+        """A list with the records of the phases run so far"""
+        if not hasattr(self, '_stats'):
+            self._stats = []
+        return self._stats
+
+    def phase(self, name, size=None):
+        """Returns a context manager that records the wall time of a phase.
+
+        If size is defined, the number of bytes processed and the throughput
+        of the phase are recorded too. The context manager returns the phase
+        record, a dictionary that may be updated with more info.
+        """
+        return _Phase(self.stats, name, size)
+
     def _get_progress(self):
         """Returns a new Progress object"""
         progress = self._Progress
@@ -92,4 +110,31 @@ class Output(object):
             yield
         return generator
 
+
+class _Phase(object):
+    """Context manager that records the wall time of a program phase"""
+
+    def __init__(self, stats, name, size=None):
+        self.stats = stats
+        self.record = {'name': name}
+        if size is not None:
+            self.record['bytes'] = size
+
+    def __enter__(self):
+        self.start = time.time()
+        self.record['start'] = self.start
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.time() - self.start
+        self.record['duration'] = duration
+        if exc_type is not None:
+            self.record['failed'] = True
+
+        size = self.record.get('bytes')
+        if size is not None and duration > 0:
+            self.record['throughput'] = float(size) / 2 ** 20 / duration
+
+        self.stats.append(self.record)
+
 # vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
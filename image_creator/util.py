@@ -26,6 +26,7 @@ import re
 import sys
 import json
 import tempfile
+import errno
 
 
 class FatalError(Exception):
@@ -33,6 +34,11 @@ class FatalError(Exception):
     pass
 
 
+# Environment variable hosting the number of images that are created
+# concurrently on the host
+JOBS_ENV = 'SNF_IMAGE_CREATOR_JOBS'
+
+
 def get_command(command):
     """Return a file system binary command"""
     def find_sbin_command(command, exception):
@@ -66,17 +72,105 @@ def image_info(image):
     return json.loads(str(info))
 
 
-def create_snapshot(source, target_dir):
+def create_snapshot(source, target_dir, backing_fmt=None):
     """Returns a qcow2 snapshot of an image file"""
 
     qemu_img = get_command('qemu-img')
     snapfd, snap = tempfile.mkstemp(prefix='snapshot-', dir=target_dir)
     os.close(snapfd)
-    qemu_img('create', '-f', 'qcow2', '-o',
-             'backing_file=%s' % os.path.abspath(source), snap)
+    opts = 'backing_file=%s' % os.path.abspath(source)
+    if backing_fmt is not None:
+        opts += ',backing_fmt=%s' % backing_fmt
+    try:
+        # With the qcow2 v3 format, the discarded clusters read as zeros
+        # instead of falling through to the backing file
+        qemu_img('create', '-f', 'qcow2', '-o', 'compat=1.1,' + opts, snap)
+    except sh.ErrorReturnCode:
+        # Older versions of qemu-img do not support the compat option. The
+        # free space of such a snapshot is zeroed instead of discarded.
+        qemu_img('create', '-f', 'qcow2', '-o', opts, snap)
     return snap
 
 
+# lseek(2) whence values for finding data and holes in a file. They are not
+# exported by the os module of python 2.
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+
+def _lseek_extents(path, size):
+    """Returns the data extents of a file using lseek(2) with SEEK_DATA and
+    SEEK_HOLE.
+    """
+    extents = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:  # No more data
+                    break
+                raise
+            if start >= size:
+                break
+            end = min(os.lseek(fd, start, SEEK_HOLE), size)
+            extents.append((start, end - start))
+            offset = end
+    finally:
+        os.close(fd)
+
+    return extents
+
+
+def _qemu_img_extents(path, size):
+    """Returns the data extents of an image file using qemu-img map"""
+
+    qemu_img = get_command('qemu-img')
+    try:
+        # The image may be in use by the appliance. Newer qemu-img versions
+        # need -U to open it.
+        out = qemu_img('map', '-U', '--output', 'json', path)
+    except sh.ErrorReturnCode:
+        out = qemu_img('map', '--output', 'json', path)
+
+    extents = []
+    for entry in json.loads(str(out)):
+        if not entry['data'] or entry.get('zero', False):
+            continue
+        start = entry['start']
+        if start >= size:
+            continue
+        length = min(entry['length'], size - start)
+
+        # Merge adjacent extents
+        if len(extents) and sum(extents[-1]) == start:
+            extents[-1] = (extents[-1][0], extents[-1][1] + length)
+        else:
+            extents.append((start, length))
+
+    return extents
+
+
+def data_extents(path, fmt, size):
+    """Returns a list of (offset, length) tuples with the regions of the first
+    size bytes of an image file that may contain data. Anything outside those
+    regions reads as zeros.
+
+    If the holes cannot be determined, the whole range is considered data.
+    """
+
+    try:
+        if fmt == 'raw':
+            return _lseek_extents(path, size)
+        return _qemu_img_extents(path, size)
+    except (OSError, ValueError, KeyError, sh.ErrorReturnCode):
+        # SEEK_DATA is not supported by all file systems and block devices
+        # and old qemu-img versions lack the map command.
+        return [(0, size)]
+
+
 def get_kvm_binary():
     """Returns the path to the kvm binary and some extra arguments if needed"""
 
@@ -121,6 +215,33 @@ def free_space(dirname):
     return stat.f_bavail * stat.f_frsize
 
 
+def concurrent_jobs():
+    """Returns the number of images that are created concurrently on the
+    host, as set in the JOBS_ENV environment variable by the batch mode.
+    """
+    try:
+        return max(1, int(os.environ.get(JOBS_ENV, 1)))
+    except ValueError:
+        return 1
+
+
+def get_cache_dir():
+    """Returns the directory that hosts the persistent caches of the program.
+    The directory is created if it does not exist.
+    """
+    cache = os.environ['XDG_CACHE_HOME'] if 'XDG_CACHE_HOME' in os.environ \
+        else os.path.expanduser('~/.cache')
+    path = os.path.join(cache, 'snf-image-creator')
+
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    return path
+
+
 def virtio_versions(virtio_state):
     """Returns the versions of the drivers defined by the virtio state"""
 
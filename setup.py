@@ -41,6 +41,7 @@ setup(
     entry_points={
         'console_scripts': [
                 'snf-mkimage = image_creator.main:main',
+                'snf-mkimage-batch = image_creator.batch:main',
                 'snf-image-creator = image_creator.dialog_main:main']
     },
     classifiers=[
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Image class"""
+
+import unittest
+
+from image_creator.output import Output
+from image_creator.image import Image, InspectedGuestFS
+
+FSCK_ERROR = "resize2fs_M: resize2fs 1.42.9 (4-Feb-2014)\n" \
+    "Please run 'e2fsck -f /dev/sda1' first.\n\n"
+
+
+class FakeGuestFS(object):
+    """A guestfs handle with an ext4 file system that has been mounted after
+    it was last checked. If strict is set, resize2fs refuses to resize the
+    file system before it gets checked again, like older versions do.
+    """
+    def __init__(self, state='clean', errors=0, strict=False):
+        self.state = state
+        self.errors = errors
+        self.strict = strict
+        self.checks = 0
+        self.resizes = 0
+
+    def tune2fs_l(self, device):
+        return [('Filesystem state', self.state),
+                ('FS Error count', str(self.errors)),
+                ('Last mount time', 'Sun Oct 18 10:00:00 2015'),
+                ('Last write time', 'Sun Oct 18 10:00:05 2015'),
+                ('Last checked', 'Sat Oct 17 10:00:00 2015'),
+                ('Block size', '4096'),
+                ('Block count', '1000'),
+                ('Free blocks', '500')]
+
+    def e2fsck(self, device, **kwargs):
+        self.checks += 1
+        self.strict = False
+
+    def resize2fs_M(self, device):
+        if self.strict:
+            raise RuntimeError(FSCK_ERROR)
+        self.resizes += 1
+
+
+def fake_image(g):
+    """Returns an Image instance that works on a fake guestfs handle"""
+    image = Image.__new__(Image)
+    image.g = g
+    image.out = Output()
+    image.fast_shrink = False
+    image.guestfs_version = {'major': 1, 'minor': 28, 'release': 1}
+    return image
+
+
+class ShrinkExtTestCase(unittest.TestCase):
+    """Tests for Image._shrink_ext()"""
+
+    def _phases(self, image, name):
+        return [p for p in image.out.stats if p['name'] == name]
+
+    def test_check_skipped(self):
+        """A clean file system is resized without a check, even if it has
+        been mounted after it was last checked
+        """
+        g = FakeGuestFS()
+        image = fake_image(g)
+
+        self.assertEqual(image._shrink_ext('/dev/sda1'), 4096 * 1000)
+        self.assertEqual(g.checks, 0)
+        self.assertEqual(g.resizes, 1)
+        self.assertTrue(self._phases(image, 'shrink:e2fsck')[0]['skipped'])
+
+    def test_check_not_skipped(self):
+        """File systems that are not clean or have errors get checked"""
+        for g in (FakeGuestFS(state='not clean'), FakeGuestFS(errors=2)):
+            image = fake_image(g)
+            image._shrink_ext('/dev/sda1')
+            self.assertEqual(g.checks, 1)
+            self.assertEqual(g.resizes, 1)
+            self.assertFalse(
+                self._phases(image, 'shrink:e2fsck')[0]['skipped'])
+
+    def test_check_required_by_resize2fs(self):
+        """The file system is checked if resize2fs insists on it"""
+        g = FakeGuestFS(strict=True)
+        image = fake_image(g)
+
+        image._shrink_ext('/dev/sda1')
+        self.assertEqual(g.checks, 1)
+        self.assertEqual(g.resizes, 1)
+        self.assertEqual(len(self._phases(image, 'shrink:e2fsck')), 2)
+
+    def test_unrelated_resize_error(self):
+        """Other resize2fs failures are not retried"""
+        g = FakeGuestFS()
+
+        def fail(device):
+            raise RuntimeError("resize2fs_M: No space left on device")
+        g.resize2fs_M = fail
+
+        self.assertRaises(RuntimeError, fake_image(g)._shrink_ext, '/dev/sda1')
+        self.assertEqual(g.checks, 0)
+
+
+class FakeNTFS(object):
+    """A guestfs handle with a 10GB NTFS file system that needs 2GB"""
+    def __init__(self, debug_sh=True):
+        self.debug_sh = debug_sh
+        self.size = 10 * 2 ** 30
+        self.commands = []
+
+    def blockdev_getsize64(self, device):
+        return self.size
+
+    def vfs_minimum_size(self, device):
+        return 2 * 2 ** 30
+
+    def ntfsresize(self, device, size):
+        self.size = size
+
+    def debug(self, subcmd, args):
+        if not self.debug_sh:
+            raise RuntimeError("debug: unknown subcommand")
+        self.commands.append([subcmd] + args)
+
+
+class ShrinkNTFSTestCase(unittest.TestCase):
+    """Tests for Image._shrink_ntfs()"""
+
+    def test_dirty_flag_cleared(self):
+        """The dirty flag set by ntfsresize is cleared"""
+        g = FakeNTFS()
+        size = fake_image(g)._shrink_ntfs('/dev/sda2')
+
+        self.assertEqual(size, 2 * 2 ** 30 + 100 * 2 ** 20)
+        self.assertEqual(g.size, size)
+        self.assertEqual(g.commands, [['sh', 'ntfsfix', '-d', '/dev/sda2']])
+
+    def test_dirty_flag_not_cleared(self):
+        """The user is warned if the dirty flag cannot be cleared"""
+        g = FakeNTFS(debug_sh=False)
+        image = fake_image(g)
+        warnings = []
+        image.out.warn = warnings.append
+
+        self.assertEqual(image._shrink_ntfs('/dev/sda2'), g.size)
+        self.assertEqual(len(warnings), 1)
+
+
+class FakeAppliance(object):
+    """A guestfs handle that records the launches of the helper VM and the
+    drives attached to it
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.launches = 0
+        self.running = False
+        self.drives = []
+
+    def get_backend(self):
+        return self.backend
+
+    def set_recovery_proc(self, enabled):
+        pass
+
+    def add_drive_opts(self, filename, **kwargs):
+        assert not self.running or self.backend.startswith('libvirt')
+        self.drives.append(kwargs.get('label'))
+
+    def remove_drive(self, label):
+        assert self.running and self.backend.startswith('libvirt')
+        self.drives.remove(label)
+
+    def list_devices(self):
+        return ['/dev/sd%s' % chr(ord('a') + i)
+                for i in xrange(len(self.drives))]
+
+    def launch(self):
+        assert not self.running
+        self.launches += 1
+        self.running = True
+
+    def shutdown(self):
+        self.running = False
+        self.drives = []
+
+    def umount_all(self):
+        pass
+
+    def sync(self):
+        pass
+
+    def drop_caches(self, level):
+        pass
+
+
+def fake_medium(g):
+    """Returns an Image instance whose medium can be attached to a fake
+    helper VM
+    """
+    image = Image.__new__(Image)
+    image.g = InspectedGuestFS(g)
+    image.out = Output()
+    image.device = '/dev/null'
+    image.format = 'raw'
+    image.readonly = False
+    image.guestfs_enabled = False
+    image.guestfs_version = {'major': 1, 'minor': 28, 'release': 1}
+    image._appliance_running = False
+    image._hotplug = False
+    image._dir_cache = {}
+    image._dir_cache_stats = {'lookups': 0, 'calls': 0}
+    return image
+
+
+class HelperVMTestCase(unittest.TestCase):
+    """Tests for Image.enable_guestfs() and Image.disable_guestfs()"""
+
+    def _cycle(self, backend):
+        g = FakeAppliance(backend)
+        image = fake_medium(g)
+        for _ in xrange(3):
+            image.enable_guestfs()
+            self.assertEqual(g.list_devices(), ['/dev/sda'])
+            image.disable_guestfs()
+        return g
+
+    def test_hotplug(self):
+        """With the libvirt backend the helper VM is launched once and the
+        medium is hot-removed and hot-added
+        """
+        g = self._cycle('libvirt')
+        self.assertEqual(g.launches, 1)
+        self.assertTrue(g.running)
+        self.assertEqual(g.drives, [])
+
+    def test_direct(self):
+        """With the direct backend the helper VM is relaunched"""
+        g = self._cycle('direct')
+        self.assertEqual(g.launches, 3)
+        self.assertFalse(g.running)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
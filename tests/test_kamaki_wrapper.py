@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the upload path of the kamaki_wrapper module"""
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+import StringIO
+
+from image_creator.output import Output
+from image_creator.kamaki_wrapper import Kamaki, BlockHasher, _block_hash
+
+BLOCKSIZE = 4096
+BLOCKHASH = 'sha256'
+
+
+class FakeResponse(object):
+    """A response of the fake storage service"""
+    def __init__(self, status_code, json=None):
+        self.status_code = status_code
+        self.json = json
+
+
+class FakePithos(object):
+    """An in-memory storage service container. It records the maximum number
+    of blocks that are uploaded concurrently. If gather is set, the uploads
+    block until that many of them run at the same time. If fail is set, the
+    uploads fail.
+    """
+    def __init__(self, gather=0, fail=False):
+        self.gather = gather
+        self.fail = fail
+        self.blocks = {}
+        self.objects = {}
+        self.posts = 0
+        self.active = 0
+        self.max_active = 0
+        self._cond = threading.Condition()
+
+    def create_container(self, container):
+        pass
+
+    def get_container_info(self):
+        return {'x-container-block-size': str(BLOCKSIZE),
+                'x-container-block-hash': BLOCKHASH}
+
+    def object_put(self, path, json=None, **kwargs):
+        missing = [h for h in json['hashes'] if h not in self.blocks]
+        if len(missing):
+            return FakeResponse(409, missing)
+        self.objects[path] = json
+        return FakeResponse(201)
+
+    def container_post(self, data=None, **kwargs):
+        if self.fail:
+            raise IOError("Connection reset by peer")
+        blockhash = _block_hash(BLOCKHASH, data)
+        with self._cond:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self._cond.notify_all()
+
+            # The timeout only guards against hanging if the uploads are
+            # serialized
+            deadline = time.time() + 10
+            while self.max_active < self.gather and time.time() < deadline:
+                self._cond.wait(deadline - time.time())
+
+            self.blocks[blockhash] = data
+            self.posts += 1
+            self.active -= 1
+        return FakeResponse(202, [blockhash])
+
+
+class FakeAccount(object):
+    """A cloud account"""
+    def user_info(self):
+        return {'id': 'user'}
+
+
+def fake_kamaki(pithos, workers):
+    """Returns a Kamaki instance that talks to a fake storage service"""
+    kamaki = Kamaki.__new__(Kamaki)
+    kamaki.account = FakeAccount()
+    kamaki.out = Output()
+    kamaki.workers = workers
+    kamaki.pithos = pithos
+    kamaki._local = threading.local()
+    kamaki._local.pithos = pithos
+    kamaki._thread_pithos = lambda: pithos
+    return kamaki
+
+
+class UploadTestCase(unittest.TestCase):
+    """Tests for Kamaki.upload()"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.tmp, 'cache')
+        self.path = os.path.join(self.tmp, 'image.diskdump')
+        # 20 distinct blocks, 4 blocks full of zeros and a partial block
+        with open(self.path, 'wb') as f:
+            for i in xrange(20):
+                f.write(hashlib.sha256(str(i)).digest() * (BLOCKSIZE // 32))
+            f.write('\x00' * BLOCKSIZE * 4)
+            f.write('tail')
+        with open(self.path, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        if self.cache_home is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.cache_home
+        shutil.rmtree(self.tmp)
+
+    def _hashes(self):
+        hasher = BlockHasher(BLOCKSIZE, BLOCKHASH)
+        hasher.update(self.data)
+        return hasher.finalize()['hashes']
+
+    def test_upload_without_hasher(self):
+        """The block hashes are computed by the upload itself"""
+        pithos = FakePithos()
+        kamaki = fake_kamaki(pithos, 4)
+        with open(self.path, 'rb') as f:
+            location = kamaki.upload(f, remote_path='image')
+
+        self.assertEqual(location, 'pithos://user/images/image')
+        self.assertEqual(pithos.objects['image']['hashes'], self._hashes())
+        self.assertEqual(pithos.objects['image']['bytes'], len(self.data))
+        # The zero blocks are uploaded once
+        self.assertEqual(pithos.posts, 22)
+
+        stats = [p for p in kamaki.out.stats if p['name'] == 'upload:image']
+        self.assertEqual(stats[0]['blocks'], 25)
+        self.assertEqual(stats[0]['unique_blocks'], 22)
+        self.assertEqual(stats[0]['zero_blocks'], 4)
+
+    def test_upload_without_hasher_or_size(self):
+        """Small files, like the md5sum files, are uploaded the same way"""
+        pithos = FakePithos()
+        kamaki = fake_kamaki(pithos, 4)
+        with open(self.path, 'rb') as f:
+            kamaki.upload(f, size=4, remote_path='small')
+
+        self.assertEqual(pithos.objects['small']['bytes'], 4)
+
+    def test_upload_with_hasher(self):
+        """Only the missing blocks are read when the hashes are known"""
+        pithos = FakePithos()
+        kamaki = fake_kamaki(pithos, 4)
+        hasher = BlockHasher(BLOCKSIZE, BLOCKHASH)
+        hasher.update(self.data)
+        with open(self.path, 'rb') as f:
+            kamaki.upload(f, len(self.data), 'image', hasher=hasher)
+
+        self.assertEqual(pithos.objects['image']['hashes'], self._hashes())
+
+    def _hashed(self, kamaki):
+        """Returns True if the last upload computed the block hashes"""
+        return 'hash' in [p['name'] for p in kamaki.out.stats]
+
+    def _manifests(self):
+        """Returns the manifests in the cache directory"""
+        cache = os.path.join(os.environ['XDG_CACHE_HOME'],
+                             'snf-image-creator')
+        if not os.path.isdir(cache):
+            return []
+        return [n for n in os.listdir(cache) if n.startswith('hashmap-')]
+
+    def _upload(self, pithos, path=None):
+        """Uploads a file and returns True if its block hashes were
+        computed
+        """
+        kamaki = fake_kamaki(pithos, 4)
+        with open(path or self.path, 'rb') as f:
+            kamaki.upload(f, remote_path='image')
+        return self._hashed(kamaki)
+
+    def test_manifest_reuse(self):
+        """The block hashes of a file are reused if an upload of the file
+        fails, and the manifest is removed once the file is uploaded
+        """
+        pithos = FakePithos(fail=True)
+        self.assertRaises(IOError, self._upload, pithos)
+        self.assertEqual(len(self._manifests()), 1)
+
+        pithos = FakePithos()
+        self.assertFalse(self._upload(pithos))
+        self.assertEqual(pithos.objects['image']['hashes'], self._hashes())
+        self.assertEqual(self._manifests(), [])
+
+        self.assertTrue(self._upload(FakePithos()))
+
+    def test_manifest_of_modified_file(self):
+        """The manifest is not reused if the file is modified"""
+        self.assertRaises(IOError, self._upload, FakePithos(fail=True))
+
+        self.data = self.data[:-4] + 'TAIL'
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        os.utime(self.path, (100, 100))
+
+        pithos = FakePithos()
+        self.assertTrue(self._upload(pithos))
+        self.assertEqual(pithos.objects['image']['hashes'], self._hashes())
+
+    def test_no_manifest_for_other_files(self):
+        """Data that are not read from a regular file have no manifest"""
+        kamaki = fake_kamaki(FakePithos(fail=True), 4)
+        self.assertRaises(IOError, kamaki.upload,
+                          StringIO.StringIO(self.data), len(self.data),
+                          'image')
+        self.assertEqual(self._manifests(), [])
+
+    def test_expired_manifests_pruned(self):
+        """Expired manifests of other files are removed"""
+        self.assertRaises(IOError, self._upload, FakePithos(fail=True))
+        cache = os.path.join(os.environ['XDG_CACHE_HOME'],
+                             'snf-image-creator')
+        stale = os.path.join(cache, self._manifests()[0])
+        os.utime(stale, (0, 0))
+
+        other = os.path.join(self.tmp, 'other.diskdump')
+        shutil.copy(self.path, other)
+        self.assertRaises(IOError, self._upload, FakePithos(fail=True),
+                          other)
+        self.assertEqual(len(self._manifests()), 1)
+        self.assertFalse(os.path.exists(stale))
+
+    def test_parallel_upload(self):
+        """The missing blocks are uploaded by the workers in parallel"""
+        for workers in (1, 4):
+            pithos = FakePithos(gather=workers)
+            kamaki = fake_kamaki(pithos, workers)
+            with open(self.path, 'rb') as f:
+                kamaki.upload(f, remote_path='image')
+
+            self.assertEqual(pithos.max_active, workers)
+            self.assertEqual(pithos.posts, 22)
+            self.assertEqual(pithos.objects['image']['hashes'],
+                             self._hashes())
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
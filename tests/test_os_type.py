@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the file actions of the OSBase class"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from image_creator.image import InspectedGuestFS
+from image_creator.os_type import OSBase, file_type
+
+
+class FakeGuestFS(object):
+    """A guestfs handle that serves the directory tree of the host and
+    records the file actions instead of performing them.
+    """
+    def __init__(self):
+        self.removed = []
+        self.commands = []
+        self.written = {}
+
+    def is_dir(self, path):
+        return os.path.isdir(path) and not os.path.islink(path)
+
+    def readdir(self, directory):
+        entries = [{'name': '.', 'ftyp': 'd'}, {'name': '..', 'ftyp': 'd'}]
+        for name in os.listdir(directory):
+            mode = os.lstat(os.path.join(directory, name)).st_mode
+            entries.append({'name': name, 'ftyp': file_type(mode)})
+        return entries
+
+    def find0(self, directory, output):
+        names = []
+        for dirpath, dirnames, filenames in os.walk(directory):
+            rel = os.path.relpath(dirpath, directory)
+            for name in dirnames + filenames:
+                names.append(name if rel == '.' else "%s/%s" % (rel, name))
+        with open(output, 'w') as f:
+            f.write('\0'.join(names) + '\0')
+
+    def lstatlist(self, directory, names):
+        # The old stat structure has no st_ prefix in the field names
+        return [{'mode': os.lstat(os.path.join(directory, n)).st_mode}
+                for n in names]
+
+    def rm(self, path):
+        self.removed.append(path)
+
+    def rm_rf(self, path):
+        self.removed.append(path)
+
+    def write(self, path, content):
+        self.written[path] = content
+
+    def umount_all(self):
+        pass
+
+    def sh(self, command):
+        self.commands.append(command)
+
+
+class FakeOutput(object):
+    """An output that ignores everything"""
+    def warn(self, msg):
+        pass
+
+
+class FakeImage(object):
+    """An image whose guestfs handle is wrapped like the one of Image"""
+    def __init__(self, handle):
+        self.g = InspectedGuestFS(handle)
+
+    def invalidate_dir_cache(self):
+        pass
+
+
+def fake_os(handle, shell_support):
+    """Returns an OSBase instance that works on a fake guestfs handle"""
+    os_type = OSBase.__new__(OSBase)
+    os_type.image = FakeImage(handle)
+    os_type.out = FakeOutput()
+    os_type._shell_support = shell_support
+    os_type._mount_warnings = []
+    os_type._mounted = False
+    os_type._files = {}
+    os_type._files_stats = {'accesses': 0, 'calls': 0}
+    os_type._do_mount = lambda readonly: True
+    os_type._do_umount = lambda: None
+    return os_type
+
+
+class TestForeachFile(unittest.TestCase):
+    """Tests for OSBase._foreach_file()"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'a', 'b'))
+        for path in ('f1', 'a/f2', 'a/b/f3'):
+            open(os.path.join(self.root, path), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_list_tree_with_lstatlist(self):
+        g = FakeGuestFS()
+        os_type = fake_os(g, False)
+        count = os_type._foreach_file(self.root, g.rm_rf, ftype='r')
+
+        self.assertEqual(count, 3)
+        self.assertEqual(
+            sorted(g.removed),
+            sorted(os.path.join(self.root, p) for p in ('f1', 'a/f2',
+                                                        'a/b/f3')))
+
+    def test_bulk_action(self):
+        g = FakeGuestFS()
+        os_type = fake_os(g, True)
+        count = os_type._foreach_file(self.root, os_type.image.g.rm_rf)
+
+        self.assertEqual(count, 5)
+        self.assertEqual(g.removed, [])
+        self.assertEqual(len(g.commands), 1)
+        self.assertTrue(g.commands[0].startswith('rm -rf -- '))
+
+    def test_bulk_action_without_shell(self):
+        g = FakeGuestFS()
+        os_type = fake_os(g, False)
+        count = os_type._foreach_file(self.root, os_type.image.g.rm_rf)
+
+        self.assertEqual(count, 5)
+        self.assertEqual(len(g.removed), 5)
+        self.assertEqual(g.commands, [])
+
+
+class TestFileOverlay(unittest.TestCase):
+    """Tests for the guest file overlay of OSBase"""
+
+    def test_removed_file_not_written_back(self):
+        """A modified file that gets removed is not written back when the
+        medium is unmounted
+        """
+        g = FakeGuestFS()
+        os_type = fake_os(g, False)
+        with os_type.mount(silent=True):
+            os_type._write_file('/etc/passwd', 'root:x:0:0::/root:/bin/sh\n')
+            os_type._write_file('/etc/group', 'root:x:0:\n')
+            os_type._rm('/etc/passwd')
+
+        self.assertEqual(g.removed, ['/etc/passwd'])
+        self.assertEqual(g.written.keys(), ['/etc/group'])
+
+    def test_removed_directory_not_written_back(self):
+        """The modified files under directories removed in bulk are not
+        written back when the medium is unmounted
+        """
+        root = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(root, 'home'))
+            g = FakeGuestFS()
+            os_type = fake_os(g, True)
+            with os_type.mount(silent=True):
+                os_type._write_file("%s/home/.profile" % root, 'umask 022\n')
+                os_type._foreach_file(root, os_type.image.g.rm_rf)
+        finally:
+            shutil.rmtree(root)
+
+        self.assertEqual(len(g.commands), 1)
+        self.assertEqual(g.written, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the remote command execution of the Windows VM"""
+
+import unittest
+
+from image_creator.os_type.windows.vm import VM
+from image_creator.os_type.windows.winexe import WinexeSession
+
+DISKPART = r'cmd /Q /V:ON /C "SET SCRIPT=%TEMP%\QUERYMAX_%RANDOM%.TXT & ' \
+    r'ECHO SHRINK QUERYMAX > %SCRIPT% & DISKPART /S %SCRIPT%"'
+
+
+class FakeSession(WinexeSession):
+    """A remote shell that records the commands it runs"""
+    def __init__(self):
+        self.commands = []
+
+    def batch(self, commands, timeout=0):
+        self.commands.extend(commands)
+        return [("", "", 0) for _ in commands]
+
+    def close(self):
+        pass
+
+
+class FakeWinEXE(object):
+    """A winexe command that records the commands it runs"""
+    def __init__(self, commands):
+        self.commands = commands
+
+    def run(self, command, timeout=0):
+        self.commands.append(command)
+        return ("", "", 0)
+
+
+def fake_vm():
+    """Returns a VM instance with an open fake session"""
+    vm = VM.__new__(VM)
+    vm._session = FakeSession()
+    vm.winexe_commands = []
+    vm._winexe = lambda: FakeWinEXE(vm.winexe_commands)
+    return vm
+
+
+class RexecTestCase(unittest.TestCase):
+    """Tests for VM.rexec() and VM.rexec_batch()"""
+
+    def test_session(self):
+        """Plain commands run in the session"""
+        vm = fake_vm()
+        vm.rexec('VER')
+        vm.rexec_batch(['VER', 'VOL C:'])
+
+        self.assertEqual(vm._session.commands, ['VER', 'VER', 'VOL C:'])
+        self.assertEqual(vm.winexe_commands, [])
+
+    def test_environment_variables(self):
+        """Commands referencing environment variables do not run in the
+        session, which would expand them in its own environment
+        """
+        vm = fake_vm()
+        vm.rexec(DISKPART)
+        vm.rexec_batch(['VER', 'ECHO %PATH%'])
+
+        self.assertEqual(vm._session.commands, ['VER'])
+        self.assertEqual(vm.winexe_commands, [DISKPART, 'ECHO %PATH%'])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :